@@ -0,0 +1,522 @@
+import argparse
+import csv
+import difflib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+from caption import Caption, load_config
+from utils.image import get_image_paths, image_process, image_process_gbr, image_process_image
+from utils.inference import write_caption_file
+from utils.logger import Logger
+from utils.metrics import METRICS
+
+# (extension, PIL mode) of synthetic images, covers alpha, grayscale and every supported format
+BENCHMARK_IMAGE_TYPES = [
+    ("png", "RGBA"),
+    ("png", "RGB"),
+    ("jpg", "RGB"),
+    ("jpeg", "L"),
+    ("webp", "RGBA"),
+    ("bmp", "RGB"),
+]
+BENCHMARK_WD_SIZE = 448
+BENCHMARK_WD_GENERAL_TAGS = 200
+BENCHMARK_WD_CHARACTER_TAGS = 50
+
+
+def build_images(
+        images_path: Path,
+        count: int,
+        seed: int = 0,
+):
+    # Mixed sizes, formats and alpha, a quarter of images in a sub folder for recursive search
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(images_path / "sub", exist_ok=True)
+    for index in range(count):
+        extension, mode = BENCHMARK_IMAGE_TYPES[index % len(BENCHMARK_IMAGE_TYPES)]
+        width, height = (int(size) for size in rng.integers(64, 1536, size=2))
+        gradient = numpy.linspace(0, 255, width, dtype=numpy.float32)[None, :, None]
+        noise = rng.normal(0, 24, (height, width, 4)).astype(numpy.float32)
+        pixels = numpy.clip(gradient + noise + rng.integers(0, 128, 4), 0, 255).astype(numpy.uint8)
+        image = Image.fromarray(pixels, "RGBA").convert(mode)
+        folder = images_path / "sub" if index % 4 == 3 else images_path
+        image.save(folder / f'{index:05d}.{extension}')
+
+
+def build_wd_model(wd_path: Path):
+    # Tiny tagger with the same input and output layout as WD models
+    try:
+        import onnx
+        from onnx import helper, numpy_helper, TensorProto
+    except ImportError as ie:
+        print(f'Import onnx Failed!\nDetails: {ie}')
+        raise ImportError
+
+    os.makedirs(wd_path, exist_ok=True)
+    num_tags = 4 + BENCHMARK_WD_GENERAL_TAGS + BENCHMARK_WD_CHARACTER_TAGS
+    rng = numpy.random.default_rng(0)
+    weights = numpy_helper.from_array(rng.normal(0, 0.5, (3, num_tags)).astype(numpy.float32), "weights")
+    axes = numpy_helper.from_array(numpy.array([1, 2], dtype=numpy.int64), "axes")
+    graph = helper.make_graph(
+        [helper.make_node("ReduceMean", ["input", "axes"], ["mean"], keepdims=0),
+         helper.make_node("MatMul", ["mean", "weights"], ["logits"]),
+         helper.make_node("Sigmoid", ["logits"], ["output"])],
+        "benchmark_tagger",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", BENCHMARK_WD_SIZE, BENCHMARK_WD_SIZE, 3])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", num_tags])],
+        [weights, axes]
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 9
+    onnx.save(model, wd_path / "model.onnx")
+
+    with open(wd_path / "selected_tags.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tag_id", "name", "category", "count"])
+        for index, rating in enumerate(["general", "sensitive", "questionable", "explicit"]):
+            writer.writerow([index, rating, 9, 0])
+        for index in range(BENCHMARK_WD_GENERAL_TAGS):
+            writer.writerow([4 + index, f'tag_{index}', 0, 0])
+        for index in range(BENCHMARK_WD_CHARACTER_TAGS):
+            writer.writerow([4 + BENCHMARK_WD_GENERAL_TAGS + index, f'character_{index}_(series)', 4, 0])
+
+
+def build_char_tokenizer(specials: list[str], **kwargs):
+    # One token per character, no tokenizer files need to be downloaded
+    try:
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import PreTrainedTokenizerFast
+    except ImportError as ie:
+        print(f'Import transformers Failed!\nDetails: {ie}')
+        raise ImportError
+
+    vocab = {token: index for index, token in enumerate(specials + [chr(c) for c in range(32, 127)] + ["\n"])}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="?"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.add_special_tokens(specials)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, model_input_names=["input_ids", "attention_mask"],
+                                   **kwargs), vocab
+
+
+def build_joy_models(joy_path: Path):
+    # Tiny random SigLIP, image adapter and Llama with Joy's folder layout
+    try:
+        import sentencepiece
+        import torch
+        from transformers import (LlamaConfig, LlamaForCausalLM, SiglipConfig, SiglipImageProcessor, SiglipModel,
+                                  SiglipProcessor, SiglipTokenizer)
+    except ImportError as ie:
+        print(f'Import transformers Failed!\nDetails: {ie}')
+        raise ImportError
+
+    torch.manual_seed(0)
+    tokenizer, vocab = build_char_tokenizer(["<|begin_of_text|>", "<|end_of_text|>"],
+                                            bos_token="<|begin_of_text|>", eos_token="<|end_of_text|>")
+    llm = LlamaForCausalLM(LlamaConfig(vocab_size=len(vocab), hidden_size=64, intermediate_size=128,
+                                       num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                                       bos_token_id=0, eos_token_id=1))
+    llm.save_pretrained(joy_path / "llm")
+    tokenizer.save_pretrained(joy_path / "llm")
+
+    clip = SiglipModel(SiglipConfig(vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                                       num_attention_heads=2, image_size=56, patch_size=14)))
+    clip.save_pretrained(joy_path / "clip")
+    # SigLIP processor needs a sentencepiece tokenizer even though only images are processed
+    sentencepiece.SentencePieceTrainer.train(sentence_iterator=iter(["a photo of a cat", "an image of a dog"] * 64),
+                                             model_prefix=str(joy_path / "clip" / "spiece"), vocab_size=20,
+                                             minloglevel=2)
+    SiglipProcessor(image_processor=SiglipImageProcessor(size={"height": 56, "width": 56}),
+                    tokenizer=SiglipTokenizer(str(joy_path / "clip" / "spiece.model"))).save_pretrained(joy_path / "clip")
+
+    os.makedirs(joy_path / "image_adapter", exist_ok=True)
+    torch.save({"linear1.weight": torch.randn(64, 32) * 0.1, "linear1.bias": torch.zeros(64),
+                "linear2.weight": torch.randn(64, 64) * 0.1, "linear2.bias": torch.zeros(64)},
+               joy_path / "image_adapter" / "image_adapter.pt")
+
+
+def build_llama_model(llama_path: Path):
+    # Tiny random Llama-3.2 Vision with Meta's chat template layout
+    try:
+        import torch
+        from transformers import MllamaConfig, MllamaForConditionalGeneration, MllamaImageProcessor, MllamaProcessor
+    except ImportError as ie:
+        print(f'Import transformers Failed!\nDetails: {ie}')
+        raise ImportError
+
+    torch.manual_seed(0)
+    tokenizer, vocab = build_char_tokenizer(
+        ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>",
+         "<|image|>", "<|finetune_right_pad_id|>"],
+        bos_token="<|begin_of_text|>", eos_token="<|eot_id|>", pad_token="<|finetune_right_pad_id|>")
+    tokenizer.chat_template = (
+        "{{ bos_token }}{% for m in messages %}<|start_header_id|>{{ m['role'] }}<|end_header_id|>\n\n"
+        "{% if m['content'] is string %}{{ m['content'] }}{% else %}{% for c in m['content'] %}"
+        "{% if c['type'] == 'image' %}<|image|>{% else %}{{ c['text'] }}{% endif %}{% endfor %}{% endif %}"
+        "<|eot_id|>{% endfor %}{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+    )
+    processor = MllamaProcessor(image_processor=MllamaImageProcessor(size={"height": 56, "width": 56},
+                                                                     max_image_tiles=2),
+                                tokenizer=tokenizer)
+    processor.chat_template = tokenizer.chat_template
+    config = MllamaConfig(
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_global_layers=1,
+                           attention_heads=2, image_size=56, patch_size=14, max_num_tiles=2, vision_output_dim=64,
+                           intermediate_layers_indices=[0], supported_aspect_ratios=[[1, 1], [1, 2], [2, 1]]),
+        text_config=dict(vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=4,
+                         num_attention_heads=4, num_key_value_heads=2, cross_attention_layers=[1],
+                         rope_scaling={"rope_type": "default"}, bos_token_id=0, eos_token_id=vocab["<|eot_id|>"],
+                         pad_token_id=vocab["<|finetune_right_pad_id|>"]),
+        image_token_index=vocab["<|image|>"]
+    )
+    model = MllamaForConditionalGeneration(config)
+    model.generation_config.pad_token_id = vocab["<|finetune_right_pad_id|>"]
+    model.generation_config.eos_token_id = vocab["<|eot_id|>"]
+    model.save_pretrained(llama_path)
+    processor.save_pretrained(llama_path)
+
+
+def time_stage(
+        func,
+        items: int,
+        repeat: int,
+) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.monotonic()
+        func()
+        seconds.append(time.monotonic() - start_time)
+    return {
+        "items": items,
+        "seconds": seconds,
+        "best": min(seconds),
+        "mean": sum(seconds) / len(seconds),
+        "per_item_ms": min(seconds) / max(items, 1) * 1000,
+    }
+
+
+def get_versions() -> dict:
+    versions = {"python": platform.python_version(), "numpy": numpy.__version__, "pillow": Image.__version__}
+    for module_name in ["onnxruntime", "torch", "transformers"]:
+        try:
+            versions[module_name] = __import__(module_name).__version__
+        except ImportError:
+            versions[module_name] = None
+    try:
+        versions["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                                            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        versions["commit"] = None
+    return versions
+
+
+def get_benchmark_args(
+        work_path: Path,
+        images_path: Path,
+        caption_method: str,
+        run_method: str,
+        use_gpu: bool,
+) -> dict:
+    args = load_config(os.path.join(Path(__file__).parent, 'config.example.toml'))
+    args.update({
+        "data_path": str(images_path),
+        "recursive": True,
+        "custom_caption_save_path": str(work_path / "captions" / f'{caption_method}_{run_method}'),
+        "caption_method": caption_method,
+        "run_method": run_method,
+        "log_level": "WARNING",
+        "save_logs": False,
+        "models_save_path": str(work_path / "models"),
+        "wd_model_name": "benchmark-wd",
+        "wd_force_use_cpu": not use_gpu,
+        "wd_file_action": "overwrite",
+        "llm_model_name": "benchmark-llm",
+        "llm_use_cpu": not use_gpu,
+        "llm_qnt": "none",
+        "llm_max_tokens": 32,
+        "llm_file_action": "overwrite",
+    })
+    return args
+
+
+def run_caption(
+        args: dict,
+        models_path: Path,
+        repeat: int,
+        items: int,
+) -> dict:
+    try:
+        import torch
+    except ImportError:
+        torch = None
+
+    my_caption = Caption(args)
+    my_caption.wd_model_path = models_path / "wd" / "model.onnx"
+    my_caption.wd_tags_csv_path = models_path / "wd" / "selected_tags.csv"
+    my_caption.image_adapter_path = models_path / "joy" / "image_adapter" / "image_adapter.pt"
+    my_caption.clip_path = models_path / "joy" / "clip"
+    my_caption.llm_path = models_path / "joy" / "llm"
+    my_caption.llama_path = models_path / "llama"
+
+    start_time = time.monotonic()
+    my_caption.load_models(args)
+    load_seconds = time.monotonic() - start_time
+
+    def run_inference():
+        if torch is not None:
+            torch.manual_seed(0)
+        my_caption.run_inference(dict(args))
+
+    result = time_stage(run_inference, items, repeat)
+    result["load_seconds"] = load_seconds
+    my_caption.unload_models()
+    return result
+
+
+def read_captions(
+        captions_path: Path,
+        extension: str,
+) -> dict:
+    return {path.relative_to(captions_path).as_posix(): path.read_text(encoding="utf-8")
+            for path in sorted(captions_path.rglob(f'*{extension}'))}
+
+
+def get_caption_similarity(
+        captions: dict,
+        reference_captions: dict,
+) -> float:
+    # Mean word sequence similarity of captions written for the same images
+    ratios = [difflib.SequenceMatcher(None, reference_captions[name].split(), caption.split()).ratio()
+              for name, caption in captions.items() if name in reference_captions]
+    return sum(ratios) / len(ratios) if ratios else 0.0
+
+
+def run_cpu_dtypes(
+        work_path: Path,
+        images_path: Path,
+        models_path: Path,
+        method: str,
+        cpu_dtypes: list[str],
+        repeat: int,
+        items: int,
+) -> dict:
+    # Same tiny LLM on CPU with each llm_cpu_dtype, tokens/sec and captions are compared with fp32
+    caption_method = f'wd+{method}'
+    results = {}
+    reference_captions = {}
+    for cpu_dtype in ["fp32"] + [cpu_dtype for cpu_dtype in cpu_dtypes if cpu_dtype != "fp32"]:
+        print(f'Running {caption_method} on CPU with {cpu_dtype}...')
+        args = get_benchmark_args(work_path, images_path, caption_method, "sync", False)
+        args["custom_caption_save_path"] = str(work_path / "captions" / f'{caption_method}_cpu_{cpu_dtype}')
+        args["llm_cpu_dtype"] = cpu_dtype
+        result = run_caption(args, models_path, repeat, items)
+        # Metrics hold the last timed run
+        summary = METRICS.summary()
+        generated_tokens = summary["counters"].get("llm_generated_tokens", 0)
+        llm_seconds = summary["stages"].get("llm_inference", {}).get("seconds", 0.0)
+        result["generated_tokens"] = generated_tokens
+        result["tokens_per_second"] = generated_tokens / llm_seconds if llm_seconds > 0 else 0.0
+        captions = read_captions(Path(args["custom_caption_save_path"]), args["llm_caption_extension"])
+        if cpu_dtype == "fp32":
+            reference_captions = captions
+        result["similarity"] = get_caption_similarity(captions, reference_captions)
+        results[f'cpu_dtype_{caption_method}_{cpu_dtype}'] = result
+    return results
+
+
+def check_cpu_dtypes(
+        stages: dict,
+        min_similarity: float,
+) -> bool:
+    failed = False
+    print('\nCPU dtypes compared with fp32:')
+    for stage_name, stage in stages.items():
+        if not stage_name.startswith("cpu_dtype_"):
+            continue
+        reference = stages[stage_name.rsplit("_", 1)[0] + "_fp32"]
+        speedup = stage["tokens_per_second"] / reference["tokens_per_second"] \
+            if reference["tokens_per_second"] > 0 else 0.0
+        mark = "LOW SIMILARITY" if stage["similarity"] < min_similarity else ""
+        failed = failed or stage["similarity"] < min_similarity
+        print(f'{stage_name:<28} {stage["tokens_per_second"]:>9.1f}tok/s  x{speedup:.2f}  '
+              f'similarity {stage["similarity"]:.2f} {mark}')
+    return failed
+
+
+def compare_results(
+        results: dict,
+        baseline_file: str,
+        threshold: float,
+) -> bool:
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressed = False
+    print(f'\nCompared with {baseline_file} (commit {baseline["meta"]["versions"].get("commit")}):')
+    for stage_name, stage in results["stages"].items():
+        baseline_stage = baseline["stages"].get(stage_name)
+        if baseline_stage is None or baseline_stage["best"] <= 0:
+            print(f'{stage_name:<28} {stage["best"]:>9.3f}s  (new)')
+            continue
+        ratio = stage["best"] / baseline_stage["best"]
+        mark = "REGRESSION" if ratio > threshold else ""
+        regressed = regressed or ratio > threshold
+        print(f'{stage_name:<28} {stage["best"]:>9.3f}s  {baseline_stage["best"]:>9.3f}s  x{ratio:.2f} {mark}')
+    return regressed
+
+
+def main(args: argparse.Namespace):
+    work_path = Path(args.work_path).absolute()
+    images_path = work_path / "images"
+    models_path = work_path / "models"
+    if args.rebuild and os.path.exists(work_path):
+        shutil.rmtree(work_path)
+
+    # Synthetic data and models are reused by later runs, so commits are compared on the same inputs
+    if not os.path.isdir(images_path):
+        print(f'Building {args.images} synthetic images in {str(images_path)}...')
+        build_images(images_path, args.images, args.seed)
+    if not os.path.isfile(models_path / "wd" / "model.onnx"):
+        print('Building tiny WD model...')
+        build_wd_model(models_path / "wd")
+    if "joy" in args.methods and not os.path.isdir(models_path / "joy" / "llm"):
+        print('Building tiny Joy models...')
+        build_joy_models(models_path / "joy")
+    if "llama" in args.methods and not os.path.isdir(models_path / "llama"):
+        print('Building tiny Llama models...')
+        build_llama_model(models_path / "llama")
+
+    logger = Logger("WARNING", None).logger
+    image_paths = get_image_paths(logger, images_path, recursive=True)
+    results = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "gpu": args.gpu,
+            "images": len(image_paths),
+            "repeat": args.repeat,
+            "versions": get_versions(),
+        },
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    # Image discovery and preprocessing
+    stages["get_image_paths"] = time_stage(lambda: get_image_paths(logger, images_path, recursive=True),
+                                           len(image_paths), args.repeat)
+    images = []
+
+    def decode_images():
+        images.clear()
+        for image_path in image_paths:
+            image = Image.open(image_path)
+            image.load()
+            images.append(image)
+
+    stages["image_decode"] = time_stage(decode_images, len(image_paths), args.repeat)
+    wd_images = []
+
+    def process_wd_images():
+        wd_images.clear()
+        for image in images:
+            wd_images.append(image_process_gbr(image_process(image, BENCHMARK_WD_SIZE)))
+
+    stages["image_process_wd"] = time_stage(process_wd_images, len(images), args.repeat)
+    stages["image_process_llm"] = time_stage(
+        lambda: [image_process_image(image_process(image, 1024)) for image in images], len(images), args.repeat)
+
+    # Tagger
+    caption_args = get_benchmark_args(work_path, images_path, "wd", "sync", args.gpu)
+    my_caption = Caption(caption_args)
+    my_caption.wd_model_path = models_path / "wd" / "model.onnx"
+    my_caption.wd_tags_csv_path = models_path / "wd" / "selected_tags.csv"
+    my_caption.load_models(caption_args)
+    tag_texts = []
+
+    def get_tags():
+        tag_texts.clear()
+        for wd_image in wd_images:
+            tag_texts.append(my_caption.my_tagger.get_tags(image=wd_image)[0])
+
+    stages["tagger_get_tags"] = time_stage(get_tags, len(wd_images), args.repeat)
+    my_caption.unload_models()
+
+    # Caption files
+    caption_files_path = work_path / "captions" / "write_caption_file"
+    os.makedirs(caption_files_path, exist_ok=True)
+
+    def write_captions():
+        for index, tag_text in enumerate(tag_texts):
+            write_caption_file(logger, caption_files_path / f'{index:05d}.txt', tag_text, "overwrite",
+                               image_paths[index], "WD")
+
+    stages["write_caption_file"] = time_stage(write_captions, len(tag_texts), args.repeat)
+
+    # End to end
+    for method in args.methods:
+        caption_method = "wd" if method == "wd" else f'wd+{method}'
+        for run_method in (["sync"] if method == "wd" else args.run_methods):
+            print(f'Running {caption_method} with {run_method}...')
+            stages[f'run_inference_{caption_method}_{run_method}'] = run_caption(
+                get_benchmark_args(work_path, images_path, caption_method, run_method, args.gpu),
+                models_path, args.repeat, len(image_paths)
+            )
+
+    # CPU LLM dtypes
+    if args.cpu_dtypes and args.gpu:
+        print('Skipping --cpu_dtypes, it only runs without --gpu.')
+    elif args.cpu_dtypes:
+        for method in [method for method in args.methods if method != "wd"]:
+            stages.update(run_cpu_dtypes(work_path, images_path, models_path, method, args.cpu_dtypes,
+                                         args.repeat, len(image_paths)))
+
+    for stage_name, stage in stages.items():
+        print(f'{stage_name:<28} best {stage["best"]:>9.3f}s  {stage["per_item_ms"]:>9.2f}ms/item')
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results saved to {args.output}')
+
+    # Every check is printed before exiting
+    failed = bool(args.cpu_dtypes) and not args.gpu and check_cpu_dtypes(stages, args.min_similarity)
+    if args.baseline and compare_results(results, args.baseline, args.threshold):
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of every caption stage with tiny random models.")
+    parser.add_argument('--work_path', type=str, default="benchmark_data",
+                        help='folder of synthetic images and tiny models, reused between runs')
+    parser.add_argument('--rebuild', action='store_true', help='build synthetic images and models again')
+    parser.add_argument('--images', type=int, default=64, help='number of synthetic images')
+    parser.add_argument('--seed', type=int, default=0, help='seed of synthetic images')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each stage, best one is compared')
+    parser.add_argument('--methods', type=str, nargs='+', default=["wd", "joy", "llama"],
+                        choices=["wd", "joy", "llama"], help='end to end caption methods, always with wd')
+    parser.add_argument('--run_methods', type=str, nargs='+', default=["sync", "queue"],
+                        choices=["sync", "queue"], help='run methods of wd+llm caption')
+    parser.add_argument('--gpu', action='store_true', help='run models on GPU')
+    parser.add_argument('--output', type=str, default="benchmark.json", help='json file of results')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json results of another commit, exit with 1 if any stage is slower than threshold')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio counted as regression')
+    parser.add_argument('--cpu_dtypes', type=str, nargs='*', default=[], choices=["fp32", "bf16", "int8"],
+                        help='run wd+llm on CPU with these llm_cpu_dtype, compared with fp32')
+    parser.add_argument('--min_similarity', type=float, default=0.5,
+                        help='exit with 1 if captions of a CPU dtype are less similar to fp32 ones')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(setup_args())
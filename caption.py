@@ -1,16 +1,22 @@
 import toml
 import os
+import time
 from datetime import datetime
 from pathlib import Path
 
 from PIL import Image
 from tqdm import tqdm
 
+from utils.cache import TagStore
 from utils.download import download_models
 from utils.image import get_image_paths, image_process, image_process_image, image_process_gbr
-from utils.inference import get_caption_file_path, Llama, Joy, Tagger
+from utils.inference import run_caption_pipeline, Llama, Joy, Tagger
 from utils.inference import DEFAULT_SYSTEM_PROMPT, DEFAULT_USER_PROMPT_WITHOUT_WD, DEFAULT_USER_PROMPT_WITH_WD
 from utils.logger import Logger
+from utils.memory import MEMORY_BUDGET, release_memory
+from utils.metrics import METRICS
+from utils.profiler import PROFILER
+from utils.watch import FolderWatcher
 
 def load_config(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -40,6 +46,8 @@ class Caption:
 
         self.llama_path = None
 
+        self.assistant_path = None
+
         self.my_tagger = None
         self.my_joy = None
         self.my_llama = None
@@ -79,6 +87,11 @@ class Caption:
         if args['save_logs']:
             self.my_logger.info(f'Log file will be saved as "{log_file}".')
 
+        # Set before models are loaded, WD session is created with ONNX Runtime profiling
+        PROFILER.setup(self.my_logger, args, run_name=f'Caption_{log_name}' if log_name else "Caption")
+        METRICS.setup_memory(args)
+        MEMORY_BUDGET.setup(self.my_logger, args)
+
     def download_models(
             self,
             args
@@ -137,44 +150,62 @@ class Caption:
                 models_save_path=models_save_path,
             )
 
-    def load_models(
-            self,
-            args
-    ):
-        if self.use_wd:
-            # Load wd models
-            self.my_tagger = Tagger(
-                logger=self.my_logger,
-                args=args,
-                model_path=self.wd_model_path,
-                tags_csv_path=self.wd_tags_csv_path
-            )
-            self.my_tagger.load_model()
-
-        if self.use_joy:
-            # Load joy models
-            self.my_joy = Joy(
-                logger=self.my_logger,
-                args=args,
-                image_adapter_path=self.image_adapter_path,
-                clip_path=self.clip_path,
-                llm_path=self.llm_path
-            )
-            self.my_joy.load_model()
+        if (self.use_joy or self.use_llama) and args.get('llm_assistant', False):
+            # Check assistant model path from json
+            if args.get('llm_assistant_config') is None:
+                assistant_config_file = os.path.join(Path(__file__).parent, 'configs', 'default_assistant.json')
+            else:
+                assistant_config_file = os.path.join(Path(__file__).parent, 'configs', args['llm_assistant_config'])
 
-        elif self.use_llama:
-            self.my_llama = Llama(
+            # Download assistant model
+            self.assistant_path = download_models(
                 logger=self.my_logger,
+                models_type="assistant",
                 args=args,
-                llm_path=self.llama_path,
+                config_file=assistant_config_file,
+                models_save_path=models_save_path,
             )
-            self.my_llama.load_model()
 
-    def run_inference(
+    def load_models(
+            self,
+            args
+    ):
+        with METRICS.memory_stage("load_models"):
+            if self.use_wd:
+                # Load wd models
+                self.my_tagger = Tagger(
+                    logger=self.my_logger,
+                    args=args,
+                    model_path=self.wd_model_path,
+                    tags_csv_path=self.wd_tags_csv_path
+                )
+                self.my_tagger.load_model()
+
+            if self.use_joy:
+                # Load joy models
+                self.my_joy = Joy(
+                    logger=self.my_logger,
+                    args=args,
+                    image_adapter_path=self.image_adapter_path,
+                    clip_path=self.clip_path,
+                    llm_path=self.llm_path,
+                    assistant_path=self.assistant_path
+                )
+                self.my_joy.load_model()
+
+            elif self.use_llama:
+                self.my_llama = Llama(
+                    logger=self.my_logger,
+                    args=args,
+                    llm_path=self.llama_path,
+                    assistant_path=self.assistant_path,
+                )
+                self.my_llama.load_model()
+
+    def set_llm_prompts(
             self,
             args
     ):
-        # Inference
         # Set llm system prompt
         if args['llm_system_prompt'] == "DEFAULT_SYSTEM_PROMPT":
             args['llm_system_prompt'] = DEFAULT_SYSTEM_PROMPT
@@ -186,148 +217,188 @@ class Caption:
                 self.my_logger.info(f"LLM user prompt not defined, using default version with wd tags...")
                 args['llm_user_prompt'] = DEFAULT_USER_PROMPT_WITH_WD
 
-        if self.use_wd and (self.use_joy or self.use_llama):
-            # run
-            if args['run_method']=="sync":
-                image_paths = get_image_paths(logger=self.my_logger,path=Path(args['data_path']),recursive=args['recursive'])
-                pbar = tqdm(total=len(image_paths), smoothing=0.0)
-                for image_path in image_paths:
+    def caption_images(
+            self,
+            images: list[Image.Image],
+            args_list: list[dict],
+    ) -> list[dict]:
+        # Caption images in memory without caption files, for server mode.
+        # Each image has its own args, but LLM system prompt, temperature and max tokens come from the first one,
+        # callers only batch images that share them.
+        results = [{"wd_caption": None, "llm_caption": None, "error": None} for _ in images]
+        llm_rows = []
+        for index, (image, args) in enumerate(zip(images, args_list)):
+            try:
+                tag_text = ""
+                if self.use_wd:
+                    wd_image = image_process(image, self.my_tagger.model_shape_size)
+                    self.my_logger.debug(f"Resized image shape: {wd_image.shape}")
+                    wd_image = image_process_gbr(wd_image)
+                    # Thresholds and tag options are read from tagger args
+                    tagger_args = self.my_tagger.args
+                    self.my_tagger.args = args
                     try:
-                        pbar.set_description('Processing: {}'.format(image_path if len(image_path) <= 40 else
-                                                                     image_path[:15]) + ' ... ' + image_path[-20:])
-                        # Caption file
-                        wd_caption_file = get_caption_file_path(
-                            self.my_logger,
-                            data_path=args['data_path'],
-                            image_path=Path(image_path),
-                            custom_caption_save_path=args['custom_caption_save_path'],
-                            caption_extension=args['wd_caption_extension']
-                        )
-                        llm_caption_file = get_caption_file_path(
-                            self.my_logger,
-                            data_path=args['data_path'],
-                            image_path=Path(image_path),
-                            custom_caption_save_path=args['custom_caption_save_path'],
-                            caption_extension=args['llm_caption_extension']
-                        )
-                        # image to pillow
-                        image = Image.open(image_path)
-                        tag_text = ""
-
-                        if not (args['wd_file_action'] == "skip" and os.path.isfile(wd_caption_file)):
-                            # WD Caption
-                            wd_image = image_process(image, self.my_tagger.model_shape_size)
-                            self.my_logger.debug(f"Resized image shape: {wd_image.shape}")
-                            wd_image = image_process_gbr(wd_image)
-                            tag_text, rating_tag_text, character_tag_text, general_tag_text = self.my_tagger.get_tags(
-                                image=wd_image
-                            )
-
-                            if args['wd_file_action'] == "overwrite":
-                                # Write WD Caption
-                                with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(tag_text)
-                                    self.my_logger.warning(f'wd_file_action is set to overwrite!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"WD Caption path: {wd_caption_file}")
-                                    self.my_logger.debug(f"WD Caption content: {tag_text}")
-                            elif args['wd_file_action'] == "prepend":
-                                with open(wd_caption_file, "rt", encoding="utf-8") as f:
-                                    existing_content = f.read()
-                                with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(tag_text + existing_content)
-                                    self.my_logger.warning(f'wd_file_action is set to prepend!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"WD Caption path: {wd_caption_file}")
-                                    self.my_logger.debug(f"WD Caption content: {tag_text}")
-                            elif args['wd_file_action'] == "append":
-                                with open(wd_caption_file, "at", encoding="utf-8") as f:
-                                    f.write(tag_text)
-                                    self.my_logger.warning(f'wd_file_action is set to append!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"WD Caption path: {wd_caption_file}")
-                                    self.my_logger.debug(f"WD Caption content: {tag_text}")
-                            elif args['wd_file_action'] == "skip" and not os.path.isfile(wd_caption_file):
-                                with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(tag_text)
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"WD Caption path: {wd_caption_file}")
-                                    self.my_logger.debug(f"WD Caption content: {tag_text}")
-                            if args['wd_model_name'].lower().startswith("wd"):
-                                self.my_logger.debug(f"WD Rating tags: {rating_tag_text}")
-                                self.my_logger.debug(f"WD Character tags: {character_tag_text}")
-                            self.my_logger.debug(f"WD General tags: {general_tag_text}")
-                        else:
-                            self.my_logger.warning(f'wd_file_action is set to skip!!! '
-                                                   f'WD Caption file {wd_caption_file} already exists, '
-                                                   f'Skip this caption.')
-
-                        if not (args['llm_file_action'] == "skip" and os.path.isfile(llm_caption_file)):
-                            # LLM
-                            llm_image = image_process(image, args['image_size'])
-                            self.my_logger.debug(f"Resized image shape: {llm_image.shape}")
-                            llm_image = image_process_image(llm_image)
-                            # LLM Caption
-                            caption = ""
-                            if self.use_joy:
-                                caption = self.my_joy.get_caption(
-                                    image=llm_image,
-                                    user_prompt=str(f'{args["llm_user_prompt"]}{tag_text}\n') if not args['llm_caption_without_wd'] else str(f'{args["llm_user_prompt"]}\n'),
-                                    temperature=args['llm_temperature'],
-                                    max_new_tokens=args['llm_max_tokens']
-                                )
-                            elif self.use_llama:
-                                caption = self.my_llama.get_caption(
-                                    image=llm_image,
-                                    system_prompt=DEFAULT_SYSTEM_PROMPT if args['llm_system_prompt'] == DEFAULT_SYSTEM_PROMPT else args['llm_system_prompt'],
-                                    user_prompt=str(f'{args["llm_user_prompt"]}{tag_text}\n') if not args['llm_caption_without_wd'] else str(f'{args["llm_user_prompt"]}\n'),
-                                    temperature=args['llm_temperature'],
-                                    max_new_tokens=args['llm_max_tokens']
-                                )
-                            caption = caption.replace('\n', '')
-
-                            if args['llm_file_action'] == "overwrite":
-                                # Write LLM Caption
-                                with open(llm_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(caption)
-                                    self.my_logger.warning(f'llm_file_action is set to overwrite!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"LLM Caption path: {llm_caption_file}")
-                                    self.my_logger.debug(f"LLM Caption content: {caption}")
-                            elif args['llm_file_action'] == "prepend":
-                                with open(llm_caption_file, "rt", encoding="utf-8") as f:
-                                    existing_content = f.read()
-                                with open(llm_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(caption + existing_content)
-                                    self.my_logger.warning(f'llm_file_action is set to prepend!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"LLM Caption path: {llm_caption_file}")
-                                    self.my_logger.debug(f"LLM Caption content: {caption}")
-                            elif args['llm_file_action'] == "append":
-                                with open(llm_caption_file, "at", encoding="utf-8") as f:
-                                    f.write(caption)
-                                    self.my_logger.warning(f'llm_file_action is set to append!!!')
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"LLM Caption path: {llm_caption_file}")
-                                    self.my_logger.debug(f"LLM Caption content: {caption}")
-                            elif args['llm_file_action'] == "skip" and not os.path.isfile(llm_caption_file):
-                                with open(llm_caption_file, "wt", encoding="utf-8") as f:
-                                    f.write(caption)
-                                    self.my_logger.debug(f"Image path: {image_path}")
-                                    self.my_logger.debug(f"LLM Caption path: {llm_caption_file}")
-                                    self.my_logger.debug(f"LLM Caption content: {caption}")
-                        else:
-                            self.my_logger.warning(f'llm_file_action is set to skip!!! '
-                                                   f'LLM Caption file {llm_caption_file} already exists, '
-                                                   f'Skip this caption.')
-
+                        tag_text, _, _, _ = self.my_tagger.get_tags(image=wd_image)
+                    finally:
+                        self.my_tagger.args = tagger_args
+                    results[index]["wd_caption"] = tag_text
+                    METRICS.count("wd_images")
+
+                if self.use_joy or self.use_llama:
+                    llm_image = image_process(image, args['image_size'])
+                    self.my_logger.debug(f"Resized image shape: {llm_image.shape}")
+                    llm_image = image_process_image(llm_image)
+                    if self.use_wd and not args['llm_caption_without_wd']:
+                        user_prompt = str(f'{args["llm_user_prompt"]}{tag_text}\n')
+                    elif args['llm_user_prompt'] == DEFAULT_USER_PROMPT_WITH_WD:
+                        user_prompt = DEFAULT_USER_PROMPT_WITHOUT_WD
+                    else:
+                        user_prompt = str(f'{args["llm_user_prompt"]}\n')
+                    llm_rows.append((index, llm_image, user_prompt))
+            except Exception as e:
+                self.my_logger.error(f"Failed to caption image {index}, skip it.\nerror info: {e}")
+                results[index]["error"] = str(e)
+                METRICS.count("wd_failed")
+
+        if llm_rows:
+            args = args_list[0]
+            if self.use_joy:
+                for index, llm_image, user_prompt in llm_rows:
+                    try:
+                        results[index]["llm_caption"] = self.my_joy.get_caption(
+                            image=llm_image,
+                            user_prompt=user_prompt,
+                            temperature=args['llm_temperature'],
+                            max_new_tokens=args['llm_max_tokens']
+                        ).replace('\n', '')
+                        METRICS.count("llm_images")
                     except Exception as e:
-                        self.my_logger.error(f"Failed to caption image: {image_path}, skip it.\nerror info: {e}")
-                        continue
+                        self.my_logger.error(f"Failed to caption image {index}, skip it.\nerror info: {e}")
+                        results[index]["error"] = str(e)
+                        METRICS.count("llm_failed")
+            elif self.use_llama:
+                try:
+                    captions = self.my_llama.get_caption_batch(
+                        images=[llm_image for _, llm_image, _ in llm_rows],
+                        system_prompt=str(args['llm_system_prompt']),
+                        user_prompts=[user_prompt for _, _, user_prompt in llm_rows],
+                        temperature=args['llm_temperature'],
+                        max_new_tokens=args['llm_max_tokens']
+                    )
+                    for (index, _, _), caption in zip(llm_rows, captions):
+                        results[index]["llm_caption"] = caption.replace('\n', '')
+                    METRICS.count("llm_images", len(llm_rows))
+                except Exception as e:
+                    for index, _, _ in llm_rows:
+                        self.my_logger.error(f"Failed to caption image {index}, skip it.\nerror info: {e}")
+                        results[index]["error"] = str(e)
+                    METRICS.count("llm_failed", len(llm_rows))
+
+        return results
+
+    def caption_image_paths(
+            self,
+            args,
+            image_paths: list[str]
+    ):
+        # Caption given images with all loaded models in one pipeline, used by sync and watch mode.
+        # WD tags next images while LLM captions current ones, WD tags are passed to LLM in memory.
+        run_caption_pipeline(
+            self.my_logger,
+            args,
+            image_paths,
+            tagger=self.my_tagger if self.use_wd else None,
+            joy=self.my_joy if self.use_joy else None,
+            llama=self.my_llama if self.use_llama else None
+        )
+
+    def run_watch(
+            self,
+            args
+    ):
+        # Keep models loaded and caption new or changed images in data_path
+        watcher = FolderWatcher(
+            logger=self.my_logger,
+            path=Path(args['data_path']),
+            recursive=args['recursive'],
+            debounce=float(args.get('watch_debounce', 2.0))
+        )
+        watch_interval = max(float(args.get('watch_interval', 1.0)), 0.1)
+        watch_batch_size = max(int(args.get('watch_batch_size', 32)), 1)
+        watcher.start()
+        self.my_logger.info(f'Watching {args["data_path"]} for new images, press Ctrl+C to stop...')
+        try:
+            while True:
+                image_paths = watcher.poll()
+                if not image_paths:
+                    time.sleep(watch_interval)
+                    continue
+                batch_size = MEMORY_BUDGET.limit("watch_batch_size", watch_batch_size)
+                for i in range(0, len(image_paths), batch_size):
+                    batch = image_paths[i:i + batch_size]
+                    self.my_logger.info(f'Captioning {len(batch)} new or changed image(s)...')
+                    self.caption_image_paths(args, batch)
+                    watcher.mark_done(batch)
+        except KeyboardInterrupt:
+            self.my_logger.info('Stop watching.')
+        finally:
+            watcher.stop()
+            if self.use_wd:
+                self.my_tagger.log_tag_frequency()
 
-                    pbar.update(1)
+    def start_metrics(
+            self,
+            args
+    ):
+        METRICS.reset()
+        METRICS.start_prometheus(
+            logger=self.my_logger,
+            prometheus_file=args.get('metrics_prometheus_file', ""),
+            prometheus_interval=args.get('metrics_prometheus_interval', 15.0)
+        )
+
+    def finish_metrics(
+            self,
+            args
+    ):
+        METRICS.stop_prometheus()
+        METRICS.log_summary(self.my_logger)
+        metrics_file = args.get('metrics_file', "")
+        if metrics_file:
+            try:
+                METRICS.save_summary(metrics_file)
+                self.my_logger.info(f'Metrics summary saved to {metrics_file}.')
+            except OSError as e:
+                self.my_logger.warning(f'Failed to save metrics summary to {metrics_file}.\nerror info: {e}')
 
-                pbar.close()
+    def run_inference(
+            self,
+            args
+    ):
+        # Inference
+        self.set_llm_prompts(args)
+        self.start_metrics(args)
+        try:
+            self.run_caption(args)
+        finally:
+            self.finish_metrics(args)
+            PROFILER.finish()
+
+    def run_caption(
+            self,
+            args
+    ):
+        if args['run_method'] == "watch":
+            with METRICS.memory_stage("watch"):
+                self.run_watch(args)
+            return
+
+        if self.use_wd and (self.use_joy or self.use_llama):
+            # run
+            if args['run_method']=="sync":
+                image_paths = get_image_paths(logger=self.my_logger,path=Path(args['data_path']),recursive=args['recursive'])
+                with METRICS.memory_stage("sync"):
+                    self.caption_image_paths(args, image_paths)
 
                 if args['wd_tags_frequency']:
                     sorted_tags = sorted(self.my_tagger.tag_freq.items(), key=lambda x: x[1], reverse=True)
@@ -335,42 +406,71 @@ class Caption:
                     for tag, freq in sorted_tags:
                         self.my_logger.info(f'{tag}: {freq}')
             else:
-                pbar = tqdm(total=2, smoothing=0.0)
-                pbar.set_description('Processing with WD model...')
-                self.my_tagger.inference()
-                pbar.update(1)
-                if self.use_joy:
-                    pbar.set_description('Processing with joy model...')
-                    self.my_joy.inference()
-                    pbar.update(1)
-                elif self.use_llama:
-                    pbar.set_description('Processing with Llama model...')
-                    self.my_llama.inference()
+                # Find images once, WD tags are handed to LLM in memory.
+                # Same stage pipeline as sync, run twice with the barrier between: a barrier stage in one pipeline
+                # would hold every decoded image until WD finished all of them, here memory is released instead.
+                image_paths = get_image_paths(logger=self.my_logger,path=Path(args['data_path']),recursive=args['recursive'])
+                tag_store = TagStore(self.my_logger, args.get('queue_tag_store_max_mb', 256))
+                try:
+                    pbar = tqdm(total=2, smoothing=0.0)
+                    pbar.set_description('Processing with WD model...')
+                    with METRICS.memory_stage("wd"):
+                        self.my_tagger.inference(image_paths, tag_store)
                     pbar.update(1)
-                pbar.close()
+                    if MEMORY_BUDGET.enabled:
+                        # Images and garbage of WD stage aren't needed by LLM stage
+                        release_memory()
+                    if self.use_joy:
+                        pbar.set_description('Processing with joy model...')
+                        with METRICS.memory_stage("llm"):
+                            self.my_joy.inference(image_paths, tag_store)
+                        pbar.update(1)
+                    elif self.use_llama:
+                        pbar.set_description('Processing with Llama model...')
+                        with METRICS.memory_stage("llm"):
+                            self.my_llama.inference(image_paths, tag_store)
+                        pbar.update(1)
+                    pbar.close()
+                finally:
+                    tag_store.close()
         else:
             if self.use_wd:
-                self.my_tagger.inference()
+                with METRICS.memory_stage("wd"):
+                    self.my_tagger.inference()
             if self.use_joy and not self.use_llama:
-                self.my_joy.inference()
+                with METRICS.memory_stage("llm"):
+                    self.my_joy.inference()
             elif not self.use_joy and self.use_llama:
-                self.my_llama.inference()
+                with METRICS.memory_stage("llm"):
+                    self.my_llama.inference()
 
     def unload_models(
             self
     ):
         # Unload models
-        if self.use_wd:
-            self.my_tagger.unload_model()
-        if self.use_joy:
-            self.my_joy.unload_model()
-        if self.use_llama:
-            self.my_llama.unload_model()
+        with METRICS.memory_stage("unload_models"):
+            if self.use_wd:
+                self.my_tagger.unload_model()
+            if self.use_joy:
+                self.my_joy.unload_model()
+            if self.use_llama:
+                self.my_llama.unload_model()
+            release_memory()
 
 if __name__ == "__main__":
     args = load_config('config.toml')
     my_caption = Caption(args)
     my_caption.download_models(args)
     my_caption.load_models(args)
-    my_caption.run_inference(args)
+    if args.get('server_mode', False):
+        from utils.server import CaptionServer
+        my_caption.set_llm_prompts(args)
+        my_caption.start_metrics(args)
+        try:
+            CaptionServer(my_caption, args).serve()
+        finally:
+            my_caption.finish_metrics(args)
+            PROFILER.finish()
+    else:
+        my_caption.run_inference(args)
     my_caption.unload_models()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import argparse
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+from tqdm import tqdm
+
+from utils.image import get_image_paths
+from utils.inference import get_caption_file_path
+from utils.logger import Logger
+from utils.tag_index import TagIndex, read_selected_tags
+
+
+def get_index_dir(args: argparse.Namespace) -> Path:
+    # Same default as `wd_tag_index_dir` of caption.py
+    if args.index_dir:
+        return Path(args.index_dir)
+    if args.data_path:
+        return Path(args.data_path) / "tag_index"
+    print('Either --index_dir or --data_path is needed.', file=sys.stderr)
+    sys.exit(2)
+
+
+def build(args: argparse.Namespace):
+    # Index tags of existing WD caption files, images already in the index are replaced
+    logger = Logger("INFO", None).logger
+    index_dir = get_index_dir(args)
+    if args.rebuild and os.path.isdir(index_dir):
+        logger.info(f'Removing old tag index {str(index_dir)}...')
+        shutil.rmtree(index_dir)
+    tag_index = TagIndex(logger, index_dir)
+    if args.tags_csv:
+        tag_index.set_tags(read_selected_tags(logger, args.tags_csv))
+
+    data_path = Path(args.data_path)
+    image_paths = get_image_paths(logger=logger, path=data_path, recursive=args.recursive)
+    start_time = time.monotonic()
+    missing = 0
+    for image_path in tqdm(image_paths, smoothing=0.0, desc="Reading caption files"):
+        caption_file = get_caption_file_path(
+            logger,
+            data_path=data_path,
+            image_path=Path(image_path),
+            custom_caption_save_path=args.custom_caption_save_path,
+            caption_extension=args.caption_extension
+        )
+        if not os.path.isfile(caption_file):
+            missing += 1
+            continue
+        with open(caption_file, "rt", encoding="utf-8") as f:
+            tag_index.add_tag_text(image_path, f.read(), args.caption_separator)
+    if missing:
+        logger.warning(f'{missing} image(s) have no {args.caption_extension} caption file, skipped.')
+    tag_index.save()
+    logger.info(f'Tag index built in {time.monotonic() - start_time:.1f}s.')
+
+
+def query(args: argparse.Namespace):
+    logger = Logger("WARNING", None).logger
+    index_dir = get_index_dir(args)
+    if not os.path.isfile(index_dir / "tags.json"):
+        logger.error(f'Tag index {str(index_dir)} NOT FOUND! Caption with `wd_tag_index` or run `build` first.')
+        sys.exit(1)
+    start_time = time.monotonic()
+    tag_index = TagIndex(logger, index_dir)
+    load_time = time.monotonic() - start_time
+    start_time = time.monotonic()
+    try:
+        image_ids = tag_index.query(" ".join(args.expression), args.threshold)
+    except ValueError:
+        sys.exit(1)
+    query_time = time.monotonic() - start_time
+
+    if not args.count:
+        for image_id in image_ids[:args.limit] if args.limit > 0 else image_ids:
+            print(tag_index.image_paths[image_id])
+    print(f'{len(image_ids)} of {len(tag_index.image_paths)} image(s) matched in {query_time * 1000:.1f}ms '
+          f'(index loaded in {load_time * 1000:.1f}ms).', file=sys.stderr)
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Query images by WD tags with an index of posting lists.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help='build or update tag index from existing WD caption files')
+    build_parser.add_argument('--data_path', type=str, required=True, help='path of images')
+    build_parser.add_argument('--index_dir', type=str, default="",
+                              help='path of tag index, default is `tag_index` in data_path')
+    build_parser.add_argument('--tags_csv', type=str, default="",
+                              help='selected_tags.csv of the WD model, tags keep their ids and order in it')
+    build_parser.add_argument('--custom_caption_save_path', type=str, default="",
+                              help='path of caption files if they are not beside images')
+    build_parser.add_argument('--caption_extension', type=str, default=".wdcaption", help='extension of WD captions')
+    build_parser.add_argument('--caption_separator', type=str, default=", ", help='separator of tags in captions')
+    build_parser.add_argument('--recursive', action='store_true', help='search images in sub folders')
+    build_parser.add_argument('--rebuild', action='store_true', help='remove old tag index first')
+    build_parser.set_defaults(func=build)
+
+    query_parser = subparsers.add_parser("query", help='print paths of images matching a tag expression')
+    query_parser.add_argument('expression', type=str, nargs='+',
+                              help='e.g. `1girl and (outdoors or sky>=0.6) and not monochrome`, '
+                                   'adjacent tags are joined by `and`, `-tag` is `not tag`, '
+                                   'quote tags with spaces or use `_` for them, `(` right after a tag name is '
+                                   'part of it like `hatsune_miku_(vocaloid)`, quote other tags with parentheses')
+    query_parser.add_argument('--data_path', type=str, default="", help='path of images, to find default index')
+    query_parser.add_argument('--index_dir', type=str, default="",
+                              help='path of tag index, default is `tag_index` in data_path')
+    query_parser.add_argument('--threshold', type=float, default=0.0,
+                              help='min probability of tags without their own threshold')
+    query_parser.add_argument('--limit', type=int, default=0, help='print at most this many images, 0 for all')
+    query_parser.add_argument('--count', action='store_true', help='only print number of matched images')
+    query_parser.set_defaults(func=query)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_args()
+    args.func(args)
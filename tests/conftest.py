@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+# Tests import modules the same way caption.py does, from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.logger import Logger
+
+
+@pytest.fixture(scope="session")
+def logger():
+    return Logger("WARNING", None).logger
+
+
+@pytest.fixture(scope="session")
+def llama_path(tmp_path_factory):
+    # Tiny random Llama-3.2 Vision from the offline benchmark, built once per test run
+    benchmark = pytest.importorskip("benchmark")
+    pytest.importorskip("transformers")
+    path = tmp_path_factory.mktemp("models") / "llama"
+    benchmark.build_llama_model(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def joy_path(tmp_path_factory):
+    benchmark = pytest.importorskip("benchmark")
+    pytest.importorskip("transformers")
+    path = tmp_path_factory.mktemp("models") / "joy"
+    benchmark.build_joy_models(path)
+    return path
+
+
+def build_draft_model(llm_path, draft_path):
+    # Tiny causal LM with the tokenizer of `llm_path`, for assisted generation
+    import json
+    import shutil
+
+    import torch
+    from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(1)
+    tokenizer = AutoTokenizer.from_pretrained(llm_path)
+    with open(llm_path / "generation_config.json", "rt", encoding="utf-8") as f:
+        generation_config = json.load(f)
+    model = LlamaForCausalLM(LlamaConfig(vocab_size=len(tokenizer), hidden_size=16, intermediate_size=32,
+                                         num_hidden_layers=1, num_attention_heads=2, num_key_value_heads=1,
+                                         bos_token_id=generation_config.get("bos_token_id"),
+                                         eos_token_id=generation_config.get("eos_token_id"),
+                                         pad_token_id=generation_config.get("pad_token_id")))
+    model.save_pretrained(draft_path)
+    for file_name in ("tokenizer.json", "tokenizer_config.json", "special_tokens_map.json"):
+        shutil.copy(llm_path / file_name, draft_path / file_name)
+    return draft_path
+
+
+@pytest.fixture(scope="session")
+def llama_draft_path(tmp_path_factory, llama_path):
+    return build_draft_model(llama_path, tmp_path_factory.mktemp("models") / "llama_draft")
+
+
+@pytest.fixture(scope="session")
+def joy_draft_path(tmp_path_factory, joy_path):
+    return build_draft_model(joy_path / "llm", tmp_path_factory.mktemp("models") / "joy_draft")
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from utils import download
+from utils.download import check_manifest, get_file_sha256, rank_mirrors, run_download_tasks, url_download, \
+    write_manifest
+
+FILE_SIZE = 300 * 1024
+SEGMENT_SIZE = 64 * 1024
+
+
+class FileServer:
+    def __init__(
+            self,
+            files: dict[str, bytes],
+            ranges: bool = True,
+            ignore_range: bool = False,
+            throttle: float = 0.0
+    ):
+        # Local stand-in for a model site. `ranges` advertises range support, `ignore_range` still answers 200
+        self.files = files
+        self.ranges = ranges
+        self.ignore_range = ignore_range
+        # Seconds to wait after each 4KB sent
+        self.throttle = throttle
+        # Responses are cut once this many body bytes were sent in total
+        self.cut_after = None
+        # File name -> number of next requests answered with 500
+        self.failures = {}
+        self.missing = set()
+        self.requests = []
+        self.sent = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, name: str) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/{name}'
+
+    def total_sent(self) -> int:
+        with self.lock:
+            return sum(self.sent.values())
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self):
+        file_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_file_headers(self) -> tuple[bytes, int, int]:
+                name = self.path.lstrip("/")
+                with file_server.lock:
+                    file_server.requests.append((self.command, name, self.headers.get("Range")))
+                    failures = file_server.failures.get(name, 0)
+                    if failures > 0:
+                        file_server.failures[name] = failures - 1
+                if name in file_server.missing or name not in file_server.files or failures > 0:
+                    self.send_response(404 if failures == 0 else 500)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return b"", 0, -1
+                data = file_server.files[name]
+                start, end = 0, len(data) - 1
+                range_header = self.headers.get("Range")
+                if range_header and file_server.ranges and not file_server.ignore_range:
+                    first, _, last = range_header.removeprefix("bytes=").partition("-")
+                    start, end = int(first), min(int(last) if last else end, end)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f'bytes {start}-{end}/{len(data)}')
+                else:
+                    self.send_response(200)
+                if file_server.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                return data, start, end
+
+            def do_HEAD(self):
+                self.send_file_headers()
+
+            def do_GET(self):
+                data, start, end = self.send_file_headers()
+                name = self.path.lstrip("/")
+                for offset in range(start, end + 1, 4096):
+                    with file_server.lock:
+                        if file_server.cut_after is not None \
+                                and sum(file_server.sent.values()) >= file_server.cut_after:
+                            # Drop the connection in the middle of a response
+                            self.close_connection = True
+                            return
+                        file_server.sent[name] = file_server.sent.get(name, 0) + min(4096, end + 1 - offset)
+                    try:
+                        self.wfile.write(data[offset:min(offset + 4096, end + 1)])
+                    except OSError:
+                        self.close_connection = True
+                        return
+                    if file_server.throttle:
+                        threading.Event().wait(file_server.throttle)
+
+        return Handler
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    # Several segments per test file, and no waiting between retries
+    monkeypatch.setattr(download, "DOWNLOAD_SEGMENT_SIZE", SEGMENT_SIZE)
+    monkeypatch.setattr(download, "DOWNLOAD_CHUNK_SIZE", 4096)
+    monkeypatch.setattr(download, "DOWNLOAD_WRITE_BUFFER", 16 * 1024)
+    monkeypatch.setattr(download, "DOWNLOAD_STATE_INTERVAL", 0.0)
+    monkeypatch.setattr(download, "DOWNLOAD_RETRIES", 2)
+    monkeypatch.setattr(download, "MIRROR_PROBE_SIZE", 16 * 1024)
+    monkeypatch.setattr(download, "time", SimpleNamespace(monotonic=time.monotonic, strftime=time.strftime,
+                                                          sleep=lambda seconds: None))
+
+
+@pytest.fixture
+def data() -> bytes:
+    return os.urandom(FILE_SIZE)
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(*args, **kwargs) -> FileServer:
+        server = FileServer(*args, **kwargs)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.close()
+
+
+def test_interrupted_download_resumes_and_matches_manifest(logger, tmp_path, data, servers):
+    server = servers({"model.safetensors": data})
+    server.cut_after = 100 * 1024
+    with pytest.raises(requests.ConnectionError):
+        url_download(logger, server.url("model.safetensors"), tmp_path, connections=2)
+
+    state_file = tmp_path / "model.safetensors.part.json"
+    with open(state_file, "rt", encoding="utf-8") as f:
+        segments = json.load(f)["segments"]
+    downloaded = sum(segment[2] for segment in segments)
+    assert 0 < downloaded < FILE_SIZE
+    # Stopped in the middle of a segment, not only at segment ends
+    assert any(0 < segment[2] < segment[1] - segment[0] + 1 for segment in segments)
+
+    server.cut_after = None
+    server.sent = {}
+    file_path = url_download(logger, server.url("model.safetensors"), tmp_path, connections=2)
+
+    # Only the missing bytes are requested again
+    assert server.total_sent() == FILE_SIZE - downloaded
+    assert not state_file.exists()
+    assert get_file_sha256(file_path) == hashlib.sha256(data).hexdigest()
+
+    model_site_info = {"llm": {"file_list": {"model.safetensors": server.url("model.safetensors")},
+                               "revision": "main"}}
+    files_path = {("llm", "model.safetensors"): file_path}
+    write_manifest(logger, tmp_path / "manifest.json", "huggingface", "url", model_site_info, files_path)
+    with open(tmp_path / "manifest.json", "rt", encoding="utf-8") as f:
+        assert json.load(f)["files"]["llm/model.safetensors"]["sha256"] == hashlib.sha256(data).hexdigest()
+    assert check_manifest(logger, tmp_path / "manifest.json", "huggingface", model_site_info) == files_path
+
+
+@pytest.mark.parametrize("ranges, ignore_range", [(False, False), (True, True)])
+def test_server_without_range_support_downloads_in_one_stream(logger, tmp_path, data, servers, ranges,
+                                                              ignore_range):
+    server = servers({"model.onnx": data}, ranges=ranges, ignore_range=ignore_range)
+    file_path = url_download(logger, server.url("model.onnx"), tmp_path, connections=4)
+
+    assert get_file_sha256(file_path) == hashlib.sha256(data).hexdigest()
+    assert not (tmp_path / "model.onnx.part").exists()
+    assert not (tmp_path / "model.onnx.part.json").exists()
+    # Last request is the single stream without a range
+    assert server.requests[-1] == ("GET", "model.onnx", None)
+
+
+def test_auto_mirror_skips_missing_file(logger, tmp_path, data, servers):
+    missing = servers({"model.onnx": data})
+    missing.missing.add("model.onnx")
+    mirror = servers({"model.onnx": data})
+    file_path = url_download(logger, mirror.url("model.onnx"), tmp_path, connections=4,
+                             mirrors=[missing.url("model.onnx"), mirror.url("model.onnx")])
+
+    assert get_file_sha256(file_path) == hashlib.sha256(data).hexdigest()
+    assert missing.total_sent() == 0
+
+
+def test_auto_mirror_prefers_faster_mirror(logger, tmp_path, data, servers):
+    slow = servers({"model.onnx": data}, throttle=0.02)
+    fast = servers({"model.onnx": data})
+    session = download.get_download_session()
+    mirrors, total_size, accept_ranges = rank_mirrors(logger, session, [slow.url("model.onnx"),
+                                                                       fast.url("model.onnx")])
+    assert [url for url, _, _ in mirrors] == [fast.url("model.onnx"), slow.url("model.onnx")]
+    assert (total_size, accept_ranges) == (FILE_SIZE, True)
+
+    file_path = url_download(logger, slow.url("model.onnx"), tmp_path, connections=2,
+                             mirrors=[slow.url("model.onnx"), fast.url("model.onnx")])
+    assert get_file_sha256(file_path) == hashlib.sha256(data).hexdigest()
+    assert fast.sent["model.onnx"] > slow.sent["model.onnx"]
+
+
+def test_only_failed_files_are_downloaded_again(logger, tmp_path, servers):
+    files = {name: os.urandom(FILE_SIZE // 3) for name in ("a.bin", "b.bin", "c.bin")}
+    mirrors = [servers(files), servers(files)]
+    # Both mirrors fail the probe of b.bin once, so its first round fails
+    for server in mirrors:
+        server.failures["b.bin"] = 1
+
+    def download_file(name: str):
+        return url_download(logger, mirrors[0].url(name), tmp_path, connections=2,
+                            mirrors=[server.url(name) for server in mirrors])
+
+    results = run_download_tasks(logger, [(name,) for name in files], download_file, workers=3)
+
+    for name, content in files.items():
+        assert get_file_sha256(results[(name,)]) == hashlib.sha256(content).hexdigest()
+    # One probe per mirror and round, b.bin is probed again in the second round
+    probes = [name for server in mirrors for method, name, range_header in server.requests
+              if range_header == f'bytes=0-{download.MIRROR_PROBE_SIZE - 1}']
+    assert {name: probes.count(name) for name in files} == {"a.bin": 2, "b.bin": 4, "c.bin": 2}
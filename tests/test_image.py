@@ -0,0 +1,31 @@
+import os
+
+import pytest
+from PIL import Image
+
+from utils.image import get_image_paths
+from utils.watch import FolderWatcher
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    # Dataset inside a folder named like the index, only folders below data_path are skipped
+    data_path = tmp_path / "tag_index" / "dataset"
+    for name in ["a.png", "sub/b.jpg", "tag_index/c.png", "tag_index.new/d.png", "sub/tag_index.old/e.webp"]:
+        os.makedirs((data_path / name).parent, exist_ok=True)
+        Image.new("RGB", (8, 8), "red").save(data_path / name)
+    return data_path
+
+
+def test_image_search_skips_tag_index(logger, data_path):
+    assert get_image_paths(logger, data_path, recursive=True) == [str(data_path / "a.png"),
+                                                                  str(data_path / "sub" / "b.jpg")]
+
+
+def test_watch_skips_tag_index(logger, data_path):
+    watcher = FolderWatcher(logger, data_path, recursive=True)
+
+    assert watcher.scan() == {str(data_path / "a.png"), str(data_path / "sub" / "b.jpg")}
+    # File system events from a tag index being saved
+    assert not watcher.is_image(str(data_path / "tag_index.new" / "d.png"))
+    assert watcher.is_image(str(data_path / "sub" / "b.jpg"))
@@ -0,0 +1,70 @@
+import pytest
+from PIL import Image
+
+from utils.inference import Joy
+from utils.metrics import METRICS
+
+torch = pytest.importorskip("torch")
+
+
+def load_joy(logger, joy_path, assistant_path=None, **args) -> Joy:
+    joy = Joy(logger, {"llm_use_cpu": True, "llm_dtype": "fp16", "llm_qnt": "none", "llm_cpu_dtype": "fp32",
+                       "llm_model_name": "tiny", "llm_assistant_model_name": "tiny-draft", "image_size": 56,
+                       "llm_user_prompt": "describe the image", "llm_temperature": 0.5, "llm_max_tokens": 8, **args},
+              joy_path / "image_adapter" / "image_adapter.pt", joy_path / "clip", joy_path / "llm", assistant_path)
+    joy.load_model()
+    return joy
+
+
+@pytest.fixture(scope="module")
+def image():
+    return Image.new("RGB", (56, 56), "red")
+
+
+def test_assisted_generation_from_image_embeddings(logger, joy_path, joy_draft_path, image):
+    joy = load_joy(logger, joy_path, joy_draft_path)
+    captions = joy.get_captions(image, ["describe the image", "a"], 0.5, 8, num_samples=2)
+
+    assert [len(samples) for samples in captions] == [2, 2]
+    assert joy.assistant_model is not None
+    assert joy.assistant_stats.generate_calls == 4
+    assert joy.assistant_stats.draft_passes > 0
+
+
+def test_assisted_generation_failure_unloads_assistant(logger, joy_path, joy_draft_path, image):
+    joy = load_joy(logger, joy_path, joy_draft_path)
+
+    def broken_generate(*args, **kwargs):
+        raise RuntimeError("draft model failed")
+
+    joy.assistant_model.generate = broken_generate
+    captions = joy.get_captions(image, ["describe the image"], 0.5, 8)
+
+    # Falls back to normal generation, draft model and the stats hooks on the LLM are gone
+    assert len(captions) == 1 and len(captions[0]) == 1
+    assert joy.assistant_model is None
+    assert joy.assistant_stats is None
+    assert not joy.llm._forward_hooks
+    assert not joy.llm._forward_pre_hooks
+
+
+def test_compile_warm_up_leaves_caches_and_metrics_alone(logger, joy_path, image, tmp_path, monkeypatch):
+    joy = load_joy(logger, joy_path, llm_embedding_cache=True, llm_embedding_cache_dir=str(tmp_path))
+    METRICS.reset()
+    for _ in range(2):
+        joy.get_captions(image, ["describe the image"], 0.5, 8)
+    cache = joy.embedding_cache
+    before = (cache.hits, cache.misses, set(cache.pending) | set(cache.key_to_shard), METRICS.summary()["counters"],
+              {stage: summary["count"] for stage, summary in METRICS.summary()["stages"].items()},
+              joy.repetition_stopped, joy.repetition_tokens_saved)
+    assert before[:2] == (1, 1)
+
+    # Static cache generation and warm-up without the inductor compile time
+    monkeypatch.setattr(torch, "compile", lambda func, **kwargs: func)
+    joy.compile_model()
+
+    assert joy.compiled
+    assert joy.embedding_cache is cache
+    assert (cache.hits, cache.misses, set(cache.pending) | set(cache.key_to_shard), METRICS.summary()["counters"],
+            {stage: summary["count"] for stage, summary in METRICS.summary()["stages"].items()},
+            joy.repetition_stopped, joy.repetition_tokens_saved) == before
@@ -0,0 +1,139 @@
+import pytest
+from PIL import Image
+
+from utils.inference import Llama
+from utils.metrics import METRICS
+
+torch = pytest.importorskip("torch")
+
+
+def load_llama(logger, llama_path, assistant_path=None, **args) -> Llama:
+    llama = Llama(logger, {"llm_use_cpu": True, "llm_dtype": "fp16", "llm_qnt": "none", "llm_cpu_dtype": "fp32",
+                           "llm_model_name": "tiny", "llm_assistant_model_name": "tiny-draft", **args},
+                  llama_path, assistant_path)
+    llama.load_model()
+    # Random init leaves cross attention gates at 0, open them so captions depend on the image
+    for layer in llama.llm.language_model.model.layers:
+        if hasattr(layer, "cross_attn_attn_gate"):
+            layer.cross_attn_attn_gate.data.fill_(1.0)
+            layer.cross_attn_mlp_gate.data.fill_(1.0)
+    return llama
+
+
+@pytest.fixture(scope="module")
+def images():
+    return [Image.new("RGB", (56, 56), color) for color in ("red", "blue", "green")]
+
+
+def test_prefix_cache_matches_batched_generation(logger, llama_path, images):
+    # Two prompt variants of the first image share system turn, image and the start of user prompt
+    rows_images = [images[0], images[0], images[1]]
+    user_prompts = ["describe the colors: 1girl", "describe the colors: sky, cloud", "a"]
+    llama = load_llama(logger, llama_path)
+    expected = llama.get_caption_batch(rows_images, "system prompt", user_prompts, 0.5, 12)
+
+    prefix_llama = load_llama(logger, llama_path, llm_prefix_cache=True)
+    METRICS.reset()
+    captions = prefix_llama.get_caption_batch(rows_images, "system prompt", user_prompts, 0.5, 12)
+
+    assert captions == expected
+    shared_ids = prefix_llama.llm_processor.apply_chat_template(
+        [{"role": "system", "content": "system prompt"},
+         {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": "describe the colors: "}]}])
+    # Prefix ends where the two user prompts differ, the eot of the user turn isn't part of it
+    prefix_length = len(prefix_llama.llm_processor.tokenizer(shared_ids, add_special_tokens=False)["input_ids"]) - 1
+    assert prefix_llama.prefix_tokens_saved == prefix_length
+    assert METRICS.summary()["counters"]["llm_prefix_tokens_saved"] == prefix_length
+
+
+def test_prefix_cache_shares_prompt_between_samples(logger, llama_path, images):
+    llama = load_llama(logger, llama_path, llm_prefix_cache=True)
+    torch.manual_seed(0)
+    captions = llama.get_caption_batch(images[:2], "system prompt", ["a", "bb"], 0.5, 8, num_samples=3)
+
+    assert len(captions) == 6
+    prompt_lengths = [llama.llm_processor(image, llama.llm_processor.apply_chat_template(
+        [{"role": "system", "content": "system prompt"},
+         {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": user_prompt}]}],
+        add_generation_prompt=True), return_tensors="pt")["input_ids"].shape[-1]
+        for image, user_prompt in zip(images[:2], ["a", "bb"])]
+    # All but the last prompt token are prefilled once instead of once per sample
+    assert llama.prefix_tokens_saved == sum((prompt_length - 1) * 2 for prompt_length in prompt_lengths)
+
+
+def test_batched_generation_matches_per_image(logger, llama_path, images):
+    # User prompts of different lengths, so shorter rows are left padded in the batch
+    user_prompts = ["a", "describe the image", "tags: 1girl, solo"]
+    llama = load_llama(logger, llama_path)
+    # Random weights rarely pick eos, so a token the first image generates early also ends captions,
+    # rows then finish at different steps and are padded after their eos
+    input_text = llama.llm_processor.apply_chat_template(
+        [{"role": "system", "content": "system prompt"},
+         {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": user_prompts[0]}]}],
+        add_generation_prompt=True)
+    inputs = llama.llm_processor(images[0], input_text, return_tensors="pt")
+    output = llama.llm.generate(**inputs, max_new_tokens=4, temperature=0.5)
+    llama.llm.generation_config.eos_token_id = [llama.llm.generation_config.eos_token_id, int(output[0][-1])]
+
+    METRICS.reset()
+    single = [llama.get_caption(image, "system prompt", user_prompt, 0.5, 16)
+              for image, user_prompt in zip(images, user_prompts)]
+    generated_tokens = METRICS.summary()["counters"]["llm_generated_tokens"]
+    batched = llama.get_caption_batch(images, "system prompt", user_prompts, 0.5, 16)
+
+    assert batched == single
+    assert len(set(batched)) > 1
+    assert METRICS.summary()["counters"]["llm_generated_tokens"] == generated_tokens * 2
+
+
+def test_single_image_decodes_like_generate(logger, llama_path, images):
+    llama = load_llama(logger, llama_path)
+    input_text = llama.llm_processor.apply_chat_template(
+        [{"role": "system", "content": "system prompt"},
+         {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": "describe the image"}]}],
+        add_generation_prompt=True)
+    inputs = llama.llm_processor(images[0], input_text, return_tensors="pt")
+    # Generation ends on an eos token other than `<|eot_id|>`
+    output = llama.llm.generate(**inputs, max_new_tokens=5, temperature=0.5)
+    llama.llm.generation_config.eos_token_id = [llama.llm.generation_config.eos_token_id, int(output[0][-1])]
+    caption = llama.get_caption(images[0], "system prompt", "describe the image", 0.5, 16)
+
+    # Decoded the way a single `generate` output always was: eos and special tokens kept, then `<|eot_id|>` stripped
+    output = llama.llm.generate(**inputs, max_new_tokens=16, temperature=0.5)
+    content = llama.llm_processor.decode(output[0][inputs["input_ids"].shape[-1]:]).rstrip("<|eot_id|>")
+    assert caption == '.'.join(dict.fromkeys(content.split(".")))
+
+
+def test_assisted_generation_matches_greedy(logger, llama_path, llama_draft_path, images):
+    user_prompts = ["a", "describe the image"]
+    llama = load_llama(logger, llama_path)
+    expected = [llama.get_caption(image, "system prompt", user_prompt, 0.5, 16)
+                for image, user_prompt in zip(images, user_prompts)]
+
+    assisted_llama = load_llama(logger, llama_path, llama_draft_path)
+    captions = assisted_llama.get_caption_batch(images[:2], "system prompt", user_prompts, 0.5, 16)
+
+    assert captions == expected
+    assert assisted_llama.assistant_model is not None
+    assert assisted_llama.assistant_stats.generate_calls == 2
+    assert assisted_llama.assistant_stats.draft_passes > 0
+
+
+def test_assisted_generation_failure_unloads_assistant(logger, llama_path, llama_draft_path, images):
+    llama = load_llama(logger, llama_path)
+    expected = llama.get_caption(images[0], "system prompt", "a", 0.5, 16)
+
+    assisted_llama = load_llama(logger, llama_path, llama_draft_path)
+
+    def broken_generate(*args, **kwargs):
+        raise RuntimeError("draft model failed")
+
+    assisted_llama.assistant_model.generate = broken_generate
+    caption = assisted_llama.get_caption(images[0], "system prompt", "a", 0.5, 16)
+
+    # Falls back to normal generation, draft model and the stats hooks on the LLM are gone
+    assert caption == expected
+    assert assisted_llama.assistant_model is None
+    assert assisted_llama.assistant_stats is None
+    assert not assisted_llama.llm._forward_hooks
+    assert not assisted_llama.llm._forward_pre_hooks
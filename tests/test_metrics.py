@@ -0,0 +1,34 @@
+import threading
+
+from utils.metrics import Metrics
+
+
+def test_suspend_only_skips_its_own_thread():
+    metrics = Metrics()
+    suspended = threading.Event()
+    resume = threading.Event()
+
+    def warm_up():
+        with metrics.suspend():
+            with metrics.suspend():
+                metrics.count("llm_generated_tokens", 100)
+            # Still suspended after the nested one ends
+            metrics.observe("llm_inference", 1.0)
+            suspended.set()
+            resume.wait(10)
+            metrics.count("llm_generated_tokens", 100)
+        metrics.count("llm_images")
+
+    thread = threading.Thread(target=warm_up)
+    thread.start()
+    suspended.wait(10)
+    # Captioning in another thread while the warm-up is suspended
+    metrics.count("llm_generated_tokens", 8)
+    metrics.observe("llm_inference", 0.5)
+    resume.set()
+    thread.join()
+
+    summary = metrics.summary()
+    assert summary["counters"] == {"llm_generated_tokens": 8, "llm_images": 1}
+    assert summary["stages"]["llm_inference"]["count"] == 1
+    assert not metrics.is_suspended()
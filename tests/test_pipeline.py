@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from utils.pipeline import Pipeline, Stage
+
+
+def test_multi_worker_stage_keeps_input_order(logger):
+    # Every third image decodes slowly, so the other worker finishes later images first
+    def decode(item: dict) -> dict:
+        time.sleep(0.03 if item["index"] % 3 == 0 else 0.001)
+        item["decoded_by"] = threading.current_thread().name
+        return item
+
+    batches = []
+
+    def tag(items: list[dict]) -> list[dict]:
+        batches.append([item["index"] for item in items])
+        return items
+
+    written = []
+
+    def write(item: dict) -> dict:
+        written.append(item["index"])
+        return item
+
+    stages = [
+        Stage("decode", decode, workers=2),
+        Stage("wd", tag, batch_size=4),
+        Stage("write", write),
+    ]
+    Pipeline(logger, stages, queue_size=2).run([{"image_path": str(index), "index": index} for index in range(30)])
+
+    assert written == list(range(30))
+    assert [index for batch in batches for index in batch] == list(range(30))
+    assert batches[0] == [0, 1, 2, 3]
+
+
+def test_multi_worker_stage_order_with_skipped_and_failed_items(logger):
+    def decode(item: dict):
+        time.sleep(0.02 if item["index"] % 4 == 0 else 0.001)
+        if item["index"] % 5 == 0:
+            return None
+        if item["index"] % 7 == 0:
+            raise ValueError("broken image")
+        return item
+
+    written = []
+
+    def write(item: dict) -> dict:
+        written.append(item["index"])
+        return item
+
+    stages = [Stage("decode", decode, workers=3), Stage("write", write)]
+    Pipeline(logger, stages, queue_size=2).run([{"image_path": str(index), "index": index} for index in range(40)])
+
+    assert written == [index for index in range(40) if index % 5 != 0 and index % 7 != 0]
+
+
+def test_worker_crash_is_raised(logger):
+    def decode(item: dict) -> dict:
+        if item["index"] == 3:
+            raise SystemExit("worker crashed")
+        return item
+
+    stages = [Stage("decode", decode, workers=2), Stage("write", lambda item: item)]
+    with pytest.raises(SystemExit):
+        Pipeline(logger, stages).run([{"image_path": str(index), "index": index} for index in range(10)])
+
+
+def test_stage_memory_leaves_process_peaks_alone(logger):
+    tracemalloc = pytest.importorskip("tracemalloc")
+    from utils.metrics import METRICS
+
+    METRICS.setup_memory({})
+    tracemalloc.start()
+    try:
+        peak_buffer = bytearray(32 * 1024 * 1024)
+        del peak_buffer
+        stages = [Stage("decode", lambda item: item, workers=2), Stage("write", lambda item: item)]
+        Pipeline(logger, stages).run([{"image_path": str(index)} for index in range(20)])
+        # Pipeline stages sample RSS themselves, the peak of an enclosing stage isn't reset under it
+        assert tracemalloc.get_traced_memory()[1] >= 32 * 1024 * 1024
+    finally:
+        tracemalloc.stop()
+    memory = METRICS.summary()["memory"]["stages"]
+    assert memory["pipeline_decode"]["calls"] == 20
+    assert memory["pipeline_write"]["calls"] == 20
+    assert "tracemalloc_peak_mb" not in memory["pipeline_decode"]
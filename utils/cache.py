@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from utils.logger import Logger
+from utils.memory import MEMORY_BUDGET
+
+EMBEDDING_CACHE_SHARD_SIZE = 128 * 1024 * 1024
+# Least recently used results are removed until the cache is below this fraction of max size
+RESULT_CACHE_EVICT_FRACTION = 0.9
+
+
+class EmbeddingCache:
+    def __init__(
+            self,
+            logger: Logger,
+            cache_dir: Union[str, Path],
+            max_size_mb: int = 4096,
+    ):
+        self.logger = logger
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(max_size_mb) * 1024 * 1024
+        self.index_file = self.cache_dir / "index.json"
+
+        # shard name -> {"size": bytes, "keys": [entry keys]}, oldest shard first
+        self.shards = {}
+        self.key_to_shard = {}
+        # Entries not written to a shard yet
+        self.pending = {}
+        self.pending_size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.shards = json.load(f)["shards"]
+            except (OSError, ValueError, KeyError) as e:
+                self.logger.warning(f'Embedding cache index {self.index_file} is broken, cache will be rebuilt.\n'
+                                    f'error info: {e}')
+                self.shards = {}
+            for shard_name in list(self.shards.keys()):
+                if not os.path.isfile(self.cache_dir / shard_name):
+                    del self.shards[shard_name]
+                    continue
+                for key in self.shards[shard_name]["keys"]:
+                    self.key_to_shard[key] = shard_name
+
+        self.logger.info(f'Embedding cache: {len(self.key_to_shard)} entries in {str(self.cache_dir)}')
+
+    def get(self, key: str):
+        try:
+            from safetensors import safe_open
+        except ImportError as ie:
+            self.logger.error(f'Import safetensors Failed!\nDetails: {ie}')
+            raise ImportError
+
+        if key in self.pending:
+            self.hits += 1
+            return self.pending[key]
+
+        shard_name = self.key_to_shard.get(key)
+        if shard_name is None:
+            self.misses += 1
+            return None
+
+        try:
+            with safe_open(self.cache_dir / shard_name, framework="pt", device="cpu") as shard:
+                tensor = shard.get_tensor(key)
+        except Exception as e:
+            self.logger.warning(f'Failed to read embedding from {shard_name}, will compute it again.\n'
+                                f'error info: {e}')
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return tensor
+
+    def put(self, key: str, tensor):
+        try:
+            import torch
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
+
+        if key in self.pending or key in self.key_to_shard:
+            return
+        tensor = tensor.detach().to(device="cpu", dtype=torch.float16).contiguous()
+        self.pending[key] = tensor
+        self.pending_size += tensor.numel() * tensor.element_size()
+
+        # Write early when memory is close to max_memory_mb
+        if self.pending_size >= min(EMBEDDING_CACHE_SHARD_SIZE, self.max_size) or MEMORY_BUDGET.under_pressure():
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            from safetensors.torch import save_file
+        except ImportError as ie:
+            self.logger.error(f'Import safetensors Failed!\nDetails: {ie}')
+            raise ImportError
+
+        shard_name = f'shard_{time.time_ns()}.safetensors'
+        save_file(self.pending, self.cache_dir / shard_name)
+        self.shards[shard_name] = {
+            "size": os.path.getsize(self.cache_dir / shard_name),
+            "keys": list(self.pending.keys())
+        }
+        for key in self.pending.keys():
+            self.key_to_shard[key] = shard_name
+        self.logger.debug(f'Embedding cache: wrote {len(self.pending)} entries to {shard_name}')
+        self.pending = {}
+        self.pending_size = 0
+
+        # Evict oldest shards until the cache fits in max size
+        while len(self.shards) > 1 and sum(shard["size"] for shard in self.shards.values()) > self.max_size:
+            oldest_shard_name = next(iter(self.shards))
+            for key in self.shards.pop(oldest_shard_name)["keys"]:
+                if self.key_to_shard.get(key) == oldest_shard_name:
+                    del self.key_to_shard[key]
+            try:
+                os.remove(self.cache_dir / oldest_shard_name)
+            except OSError:
+                pass
+            self.logger.debug(f'Embedding cache: evicted {oldest_shard_name}')
+
+        temp_index_file = self.index_file.with_suffix(".json.tmp")
+        with open(temp_index_file, 'w', encoding='utf-8') as f:
+            json.dump({"shards": self.shards}, f)
+        os.replace(temp_index_file, self.index_file)
+
+    def close(self):
+        self.flush()
+        self.logger.info(f'Embedding cache: {self.hits} hit(s), {self.misses} miss(es).')
+
+
+def get_files_fingerprint(
+        paths: list[Union[str, Path]],
+        extensions: Optional[tuple[str, ...]] = None,
+) -> str:
+    # Identify model weights by file name, size and modification time, hashing GBs of weights is too slow.
+    fingerprint = []
+    for path in paths:
+        files = [path] if os.path.isfile(path) else \
+            sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file in files:
+            if extensions is None or str(file).endswith(extensions):
+                stat = os.stat(file)
+                fingerprint.append(f'{os.path.basename(file)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return ";".join(fingerprint)
+
+
+class TagStore:
+    def __init__(
+            self,
+            logger: Logger,
+            max_size_mb: int = 256,
+    ):
+        # WD tags handed from WD stage to LLM stage in queue mode, stored as utf-8 bytes
+        self.logger = logger
+        self.max_size_mb = max_size_mb
+        self.max_size = int(float(max_size_mb) * 1024 * 1024)
+        self.tags = {}
+        self.size = 0
+        # Tags past max size are appended to a temp file, image path -> (offset, length)
+        self.spill_file = None
+        self.spilled = {}
+
+    def put(self, key: str, tag_text: str):
+        data = tag_text.encode("utf-8")
+        if key in self.tags:
+            self.size -= len(self.tags.pop(key))
+        self.spilled.pop(key, None)
+
+        # Spill early when memory is close to max_memory_mb
+        if self.size + len(data) <= self.max_size and not MEMORY_BUDGET.under_pressure():
+            self.tags[key] = data
+            self.size += len(data)
+            return
+
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="wd_tags_")
+            self.logger.info(f'WD tags exceed {self.max_size_mb}MB or memory is low, spilling to disk.')
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spilled[key] = (self.spill_file.tell(), len(data))
+        self.spill_file.write(data)
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self.tags:
+            return self.tags[key].decode("utf-8")
+        if key in self.spilled:
+            offset, length = self.spilled[key]
+            self.spill_file.seek(offset)
+            return self.spill_file.read(length).decode("utf-8")
+        return None
+
+    def close(self):
+        self.logger.debug(f'Tag store: {len(self.tags)} in memory, {len(self.spilled)} spilled to disk.')
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.tags = {}
+        self.spilled = {}
+        self.size = 0
+
+
+class ResultCache:
+    def __init__(
+            self,
+            logger: Logger,
+            cache_dir: Union[str, Path],
+            max_size_mb: int = 1024,
+    ):
+        # WD tags and LLM captions keyed by image content, model and options changing the output.
+        # Kept in sqlite so several runs can share it, least recently used results are removed past max size.
+        self.logger = logger
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(float(max_size_mb) * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Used by all pipeline stages, calls are serialized by lock
+        self.db = sqlite3.connect(str(self.cache_dir / "results.sqlite"), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                        "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.db.commit()
+        count, self.size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        self.logger.info(f'Result cache: {count} entries, {self.size / 1024 / 1024:.1f}MB in {str(self.cache_dir)}')
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(key) + len(value.encode("utf-8"))
+        with self.lock:
+            old_row = self.db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO results (key, value, size, used) VALUES (?, ?, ?, ?)",
+                            (key, value, size, time.time()))
+            self.size += size - (old_row[0] if old_row is not None else 0)
+            if self.size > self.max_size:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        # Other runs may have written too, start from the real size
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        target_size = self.max_size * RESULT_CACHE_EVICT_FRACTION
+        evicted = 0
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY used").fetchall():
+            if self.size <= target_size:
+                break
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.size -= size
+            evicted += 1
+        self.logger.debug(f'Result cache: evicted {evicted} entries')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+        self.logger.info(f'Result cache: {self.hits} hit(s), {self.misses} miss(es).')
@@ -1,73 +1,627 @@
 import argparse
+import hashlib
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union, Optional
+from typing import Callable, Union, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 from utils.logger import Logger
 
 
+# Bytes of one ranged request, a connection takes the next segment when it finishes one
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WRITE_BUFFER = 8 * 1024 * 1024
+DOWNLOAD_RETRIES = 5
+# Seconds between saves of segment progress
+DOWNLOAD_STATE_INTERVAL = 1.0
+# Rounds of downloading files that failed, other files are not downloaded again
+DOWNLOAD_FILE_RETRIES = 3
+# Written in each model's save path after download, models are checked from it without network
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+# Sites tried by `auto` model site, the first one present in config is the primary one in manifest
+MODEL_SITES = ["huggingface", "modelscope"]
+# Bytes read from each mirror to compare their speed
+MIRROR_PROBE_SIZE = 256 * 1024
+# Consecutive failed segments before a mirror is left for the others
+MIRROR_MAX_FAILURES = 2
+
+
+class DownloadProgress:
+    def __init__(
+            self,
+            desc: str
+    ):
+        # One progress bar for all files downloaded at the same time, total grows when a file's size is known
+        self.pbar = tqdm(total=0, initial=0, unit='B', unit_divisor=1024, unit_scale=True, dynamic_ncols=True,
+                         desc=desc)
+        self.lock = threading.Lock()
+
+    def add_total(self, size: int):
+        with self.lock:
+            self.pbar.total += size
+            self.pbar.refresh()
+
+    def update(self, size: int):
+        with self.lock:
+            self.pbar.update(size)
+
+    def close(self):
+        self.pbar.close()
+
+
+def get_download_session(pool_size: int = 8) -> requests.Session:
+    # Connections are reused by every file and segment
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_download_headers(
+        logger: Logger,
+        url: str
+) -> dict:
+    hf_token = os.environ.get("HF_TOKEN")
+    if "huggingface.co" in url and hf_token:
+        logger.info(f"Loading huggingface token from environment variable")
+        return {"Authorization": f"Bearer {hf_token}"}
+    return {}
+
+
+def get_remote_file_info(
+        session: requests.Session,
+        url: str,
+        headers: dict
+) -> tuple[int, bool]:
+    # Size and range support of remote file, size is 0 if unknown
+    try:
+        response = session.head(url, headers=headers, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException:
+        # Some servers don't answer HEAD, read headers of a GET instead
+        response = session.get(url, headers=headers, stream=True, timeout=30)
+        response.close()
+        response.raise_for_status()
+    total_size = int(response.headers.get('content-length', 0))
+    accept_ranges = response.headers.get('accept-ranges', "").lower() == "bytes"
+    return total_size, accept_ranges
+
+
+def probe_mirror(
+        session: requests.Session,
+        url: str,
+        headers: dict
+) -> tuple[float, int, bool]:
+    # Speed(bytes per second) of a small range request, size and range support of remote file
+    start_time = time.monotonic()
+    with session.get(url, stream=True, timeout=30,
+                     headers={**headers, "Range": f'bytes=0-{MIRROR_PROBE_SIZE - 1}'}) as response:
+        response.raise_for_status()
+        received = 0
+        for data in response.iter_content(chunk_size=64 * 1024):
+            received += len(data)
+            if received >= MIRROR_PROBE_SIZE:
+                break
+    speed = received / max(time.monotonic() - start_time, 1e-6)
+    if response.status_code == 206:
+        total_size = int(response.headers.get('content-range', "").rpartition("/")[2] or 0)
+        return speed, total_size, True
+    return speed, int(response.headers.get('content-length', 0)), False
+
+
+class DownloadMirrors:
+    def __init__(
+            self,
+            logger: Logger,
+            mirrors: list[tuple[str, dict, float]]
+    ):
+        # url, headers, speed. Each segment goes to the mirror with least connections for its speed
+        self.logger = logger
+        self.mirrors = [{"url": url, "headers": headers, "speed": max(speed, 1.0), "active": 0, "failures": 0,
+                         "enabled": True, "downloaded": 0} for url, headers, speed in mirrors]
+        self.lock = threading.Lock()
+
+    def acquire(self) -> dict:
+        with self.lock:
+            mirror = min([mirror for mirror in self.mirrors if mirror["enabled"]],
+                         key=lambda m: (m["active"] + 1) / m["speed"])
+            mirror["active"] += 1
+            return mirror
+
+    def release(
+            self,
+            mirror: dict,
+            failed: bool = False
+    ):
+        with self.lock:
+            mirror["active"] -= 1
+            mirror["failures"] = mirror["failures"] + 1 if failed else 0
+        if mirror["failures"] >= MIRROR_MAX_FAILURES:
+            self.disable(mirror, f'{mirror["failures"]} segments failed')
+
+    def disable(
+            self,
+            mirror: dict,
+            reason: str
+    ) -> bool:
+        # The last mirror is never left, False if there is no other one
+        with self.lock:
+            others = [m for m in self.mirrors if m["enabled"] and m is not mirror]
+            if not others or not mirror["enabled"]:
+                return bool(others)
+            mirror["enabled"] = False
+        self.logger.warning(f'{reason} from {mirror["url"]}, downloading from other mirror...')
+        return True
+
+    def add_downloaded(
+            self,
+            mirror: dict,
+            size: int
+    ):
+        with self.lock:
+            mirror["downloaded"] += size
+
+    def summary(self) -> str:
+        total = max(sum(mirror["downloaded"] for mirror in self.mirrors), 1)
+        return ", ".join(f'{mirror["url"]}: {mirror["downloaded"] / total:.0%}' for mirror in self.mirrors)
+
+
+def rank_mirrors(
+        logger: Logger,
+        session: requests.Session,
+        urls: list[str]
+) -> tuple[list[tuple[str, dict, float]], int, bool]:
+    # Probe all mirrors at the same time, fastest first. Mirrors failed or not matching fastest one's size are left
+    sources = [(url, get_download_headers(logger, url)) for url in urls]
+    probed = []
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {executor.submit(probe_mirror, session, url, headers): (url, headers) for url, headers in sources}
+        for future in as_completed(futures):
+            url, headers = futures[future]
+            try:
+                speed, total_size, accept_ranges = future.result()
+            except requests.RequestException as e:
+                logger.warning(f'Mirror {url} failed.\nerror info: {e}')
+                continue
+            logger.debug(f'Mirror {url}: {speed / 1024 / 1024:.2f}MB/s')
+            probed.append((url, headers, speed, total_size, accept_ranges))
+    if not probed:
+        logger.error(f'All mirrors of {os.path.basename(urls[0])} failed!')
+        raise requests.ConnectionError(f'All mirrors of {urls[0]} failed')
+
+    probed.sort(key=lambda mirror: mirror[2], reverse=True)
+    _, _, _, total_size, accept_ranges = probed[0]
+    mirrors = []
+    for url, headers, speed, size, ranges in probed:
+        if size != total_size:
+            logger.warning(f'Size of {url} is {size}, not match with {probed[0][0]} {total_size}, skip it.')
+        elif not accept_ranges or ranges:
+            mirrors.append((url, headers, speed))
+    return mirrors, total_size, accept_ranges
+
+
+def read_download_state(
+        state_file: str,
+        url: str,
+        total_size: int
+) -> Optional[list[list[int]]]:
+    # Segments of an unfinished download, [start, end, downloaded bytes], None if it's not the same file
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("total_size") != total_size:
+        return None
+    return state.get("segments")
+
+
+def write_download_state(
+        state_file: str,
+        url: str,
+        total_size: int,
+        segments: list[list[int]]
+):
+    temp_state_file = f'{state_file}.tmp'
+    with open(temp_state_file, 'w', encoding='utf-8') as f:
+        json.dump({"url": url, "total_size": total_size, "segments": segments}, f)
+    os.replace(temp_state_file, state_file)
+
+
+def download_segments(
+        logger: Logger,
+        session: requests.Session,
+        url: str,
+        part_file: str,
+        state_file: str,
+        total_size: int,
+        connections: int,
+        update: Callable[[int], None],
+        mirrors: DownloadMirrors
+):
+    segments = read_download_state(state_file, url, total_size) if os.path.isfile(part_file) else None
+    if segments is None:
+        segments = [[start, min(start + DOWNLOAD_SEGMENT_SIZE, total_size) - 1, 0]
+                    for start in range(0, total_size, DOWNLOAD_SEGMENT_SIZE)]
+        # Preallocate, segments are written at their offsets
+        with open(part_file, 'wb') as f:
+            f.truncate(total_size)
+        write_download_state(state_file, url, total_size, segments)
+    else:
+        logger.info(f'Resuming download of {os.path.basename(part_file)}...')
+    update(sum(segment[2] for segment in segments))
+
+    lock = threading.Lock()
+    state_time = [time.monotonic()]
+
+    def save_progress(segment: list[int], mirror: dict, size: int):
+        mirrors.add_downloaded(mirror, size)
+        with lock:
+            segment[2] += size
+            update(size)
+            if time.monotonic() - state_time[0] >= DOWNLOAD_STATE_INTERVAL:
+                write_download_state(state_file, url, total_size, segments)
+                state_time[0] = time.monotonic()
+
+    def download_segment(segment: list[int]):
+        for retry in range(DOWNLOAD_RETRIES):
+            start, end, downloaded = segment
+            if start + downloaded > end:
+                return
+            mirror = mirrors.acquire()
+            try:
+                response = session.get(mirror["url"], stream=True, timeout=60,
+                                       headers={**mirror["headers"], "Range": f'bytes={start + downloaded}-{end}'})
+                response.raise_for_status()
+                if response.status_code != 206:
+                    response.close()
+                    if mirrors.disable(mirror, 'Server ignored range request'):
+                        continue
+                    raise ValueError(f'Server ignored range request of {mirror["url"]}')
+                # Progress is only saved for bytes already written, so a killed download resumes correctly
+                buffer = bytearray()
+                with open(part_file, 'r+b') as f:
+                    f.seek(start + downloaded)
+                    try:
+                        for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            buffer += data[:end + 1 - start - segment[2] - len(buffer)]
+                            if len(buffer) >= DOWNLOAD_WRITE_BUFFER:
+                                f.write(buffer)
+                                f.flush()
+                                save_progress(segment, mirror, len(buffer))
+                                buffer = bytearray()
+                    finally:
+                        if buffer:
+                            f.write(buffer)
+                            f.flush()
+                            save_progress(segment, mirror, len(buffer))
+                if start + segment[2] > end:
+                    return
+                raise requests.ConnectionError(f'Connection closed at {start + segment[2]} of segment {start}-{end}')
+            except requests.RequestException as e:
+                logger.warning(f'Segment {start}-{end} of {mirror["url"]} failed, '
+                               f'retry {retry + 1}/{DOWNLOAD_RETRIES}.\nerror info: {e}')
+                # Released before waiting, so the next try can go to another mirror
+                mirrors.release(mirror, failed=True)
+                mirror = None
+                time.sleep(min(2 ** retry, 30))
+            finally:
+                if mirror is not None:
+                    mirrors.release(mirror)
+        raise requests.ConnectionError(f'Failed to download segment {segment[0]}-{segment[1]} of {url}')
+
+    with ThreadPoolExecutor(max_workers=max(connections, 1)) as executor:
+        try:
+            for future in [executor.submit(download_segment, segment) for segment in segments
+                           if segment[0] + segment[2] <= segment[1]]:
+                future.result()
+        finally:
+            with lock:
+                write_download_state(state_file, url, total_size, segments)
+
+
+def download_stream(
+        session: requests.Session,
+        url: str,
+        headers: dict,
+        part_file: str,
+        update: Callable[[int], None]
+):
+    # Single connection, for servers without size or range support
+    response = session.get(url, stream=True, headers=headers, timeout=60)
+    response.raise_for_status()
+    with open(part_file, 'wb', buffering=DOWNLOAD_WRITE_BUFFER) as f:
+        for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if data:
+                f.write(data)
+                update(len(data))
+
+
 def url_download(
         logger: Logger,
         url: str,
         local_dir: Union[str, Path],
         skip_local_file_exist: bool = True,
         force_download: bool = False,
-        force_filename: Optional[str] = None
+        force_filename: Optional[str] = None,
+        connections: int = 8,
+        session: Optional[requests.Session] = None,
+        progress: Optional[DownloadProgress] = None,
+        mirrors: Optional[list[str]] = None
 ) -> Path:
-    # Download file via url by requests library
+    # Download file via url by requests library, with parallel range requests when server supports them.
+    # Data goes to `<file>.part` and per segment progress to `<file>.part.json`, so a broken download resumes.
+    # `mirrors` are other urls of same file, segments are split across them by their speed.
     filename = os.path.basename(url) if not force_filename else force_filename
     local_file = os.path.join(local_dir, filename)
+    part_file = f'{local_file}.part'
+    state_file = f'{part_file}.json'
 
-    hf_token = os.environ.get("HF_TOKEN")
-    if hf_token:
-        logger.info(f"Loading huggingface token from environment variable")
-    response = requests.get(url, stream=True, headers={
-        "Authorization": f"Bearer {hf_token}"} if "huggingface.co" in url and hf_token else None)
-    total_size = int(response.headers.get('content-length', 0))
+    if not force_download and os.path.isfile(local_file) and skip_local_file_exist:
+        logger.info(f"`skip_local_file_exist` is Enable, Skipping download {local_file}...")
+        return Path(local_file)
+
+    session = session if session is not None else get_download_session(connections)
+    if mirrors and len(mirrors) > 1:
+        sources, total_size, accept_ranges = rank_mirrors(logger, session, mirrors)
+    else:
+        headers = get_download_headers(logger, url)
+        total_size, accept_ranges = get_remote_file_info(session, url, headers)
+        sources = [(url, headers, 1.0)]
 
     def download_progress():
-        desc = 'Downloading {}'.format(filename)
+        file_progress = progress if progress is not None else DownloadProgress(f'Downloading {filename}')
+        file_progress.add_total(total_size)
+        # Bytes of this file counted in progress, taken back if it's downloaded again from start
+        counted = [0]
 
-        if total_size > 0:
-            pbar = tqdm(total=total_size, initial=0, unit='B', unit_divisor=1024, unit_scale=True,
-                        dynamic_ncols=True,
-                        desc=desc)
-        else:
-            pbar = tqdm(initial=0, unit='B', unit_divisor=1024, unit_scale=True, dynamic_ncols=True, desc=desc)
+        def update(size: int):
+            counted[0] += size
+            file_progress.update(size)
 
         if not os.path.exists(local_dir):
             os.makedirs(local_dir, exist_ok=True)
 
-        with open(local_file, 'ab') as download_file:
-            for data in response.iter_content(chunk_size=1024):
-                if data:
-                    download_file.write(data)
-                    pbar.update(len(data))
-        pbar.close()
+        try:
+            if total_size > 0 and accept_ranges:
+                download_mirrors = DownloadMirrors(logger, sources)
+                try:
+                    download_segments(logger, session, url, part_file, state_file, total_size, connections,
+                                      update, download_mirrors)
+                except ValueError as e:
+                    logger.warning(f'{e}, will download it with one connection...')
+                    update(-counted[0])
+                    download_stream(session, sources[0][0], sources[0][1], part_file, update)
+                if len(sources) > 1:
+                    logger.info(f'Downloaded {filename} from {download_mirrors.summary()}')
+            else:
+                download_stream(session, sources[0][0], sources[0][1], part_file, update)
+
+            if total_size > 0 and os.path.getsize(part_file) != total_size:
+                logger.error(f'Size of downloaded "{part_file}" is {os.path.getsize(part_file)}, '
+                             f'but "{url}" is {total_size}!')
+                raise IOError
+        except BaseException:
+            # Counted again by the retry
+            file_progress.update(-counted[0])
+            file_progress.add_total(-total_size)
+            raise
+        finally:
+            if progress is None:
+                file_progress.close()
+
+        os.replace(part_file, local_file)
+        if os.path.isfile(state_file):
+            os.remove(state_file)
 
     if not force_download and os.path.isfile(local_file):
-        if os.path.exists(local_file) and skip_local_file_exist:
-           logger.info(f"`skip_local_file_exist` is Enable, Skipping download {local_file}...")
+        if total_size == 0:
+            logger.info(
+                f'"{local_file}" already exist, but can\'t get its size from "{url}". Won\'t download it.')
+        elif os.path.getsize(local_file) == total_size:
+            logger.info(f'"{local_file}" already exist, and its size match with "{url}".')
         else:
-            if total_size == 0:
-                logger.info(
-                    f'"{local_file}" already exist, but can\'t get its size from "{url}". Won\'t download it.')
-            elif os.path.getsize(local_file) == total_size:
-                logger.info(f'"{local_file}" already exist, and its size match with "{url}".')
-            else:
-                logger.info(
-                    f'"{local_file}" already exist, but its size not match with "{url}"!\nWill download this file '
-                    f'again...')
-                download_progress()
+            logger.info(
+                f'"{local_file}" already exist, but its size not match with "{url}"!\nWill download this file '
+                f'again...')
+            download_progress()
     else:
+        if force_download and os.path.isfile(state_file):
+            os.remove(state_file)
         download_progress()
 
     return Path(os.path.join(local_dir, filename))
 
+
+def run_download_tasks(
+        logger: Logger,
+        tasks: list[tuple],
+        download_func: Callable,
+        workers: int
+) -> dict:
+    # Download files in a bounded pool, only files failed in a round are tried again in the next one
+    results = {}
+    pending = list(tasks)
+    for download_round in range(DOWNLOAD_FILE_RETRIES + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(pending)), 1)) as executor:
+            futures = {executor.submit(download_func, *task): task for task in pending}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    results[task] = future.result()
+                except Exception as e:
+                    logger.warning(f'Download "{task[-1]}" failed.\nerror info: {e}')
+                    failed.append(task)
+        if not failed:
+            return results
+        pending = [task for task in tasks if task in failed]
+        if download_round < DOWNLOAD_FILE_RETRIES:
+            logger.warning(f'Retrying {len(pending)} failed file(s) '
+                           f'({download_round + 1}/{DOWNLOAD_FILE_RETRIES})...')
+
+    logger.error(f'Download {", ".join(task[-1] for task in pending)} failed after '
+                 f'{DOWNLOAD_FILE_RETRIES} retries!')
+    raise ConnectionError
+
+
+def get_file_sha256(file_path: Union[str, Path]) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for data in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def get_resolved_revision(
+        file_path: Union[str, Path],
+        revision: str
+) -> str:
+    # SDK cache keeps files in `snapshots/<commit hash>/`, local dirs of huggingface_hub keep it in metadata
+    parts = Path(file_path).parts
+    if "snapshots" in parts[:-1]:
+        return parts[parts.index("snapshots") + 1]
+    metadata_file = Path(file_path).parent / ".cache" / "huggingface" / "download" / f'{Path(file_path).name}.metadata'
+    if metadata_file.is_file():
+        try:
+            with open(metadata_file, "rt", encoding="utf-8") as f:
+                return f.readline().strip() or revision
+        except OSError:
+            pass
+    return revision
+
+
+def get_file_source(
+        sub_model_info: dict[str],
+        filename: str,
+        download_method: str
+) -> str:
+    if download_method == "url":
+        return sub_model_info["file_list"][filename]
+    return f'{sub_model_info["repo_id"]}/{sub_model_info["subfolder"]}/{filename}'.replace("//", "/")
+
+
+def get_models_path(
+        model_site_info: dict[str],
+        files_path: dict
+) -> list:
+    # Path of last file in each sub model
+    models_path = []
+    for sub_model_name in model_site_info:
+        sub_model_path = ""
+        for filename in model_site_info[sub_model_name]["file_list"]:
+            sub_model_path = files_path[(sub_model_name, filename)]
+        models_path.append(sub_model_path)
+    return models_path
+
+
+def read_manifest(manifest_path: Path) -> dict:
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with open(manifest_path, "rt", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if manifest.get("version") == MANIFEST_VERSION else {}
+
+
+def check_manifest(
+        logger: Logger,
+        manifest_path: Path,
+        model_site: str,
+        model_site_info: dict[str]
+) -> Optional[dict]:
+    # Paths of all files when manifest covers current config and every file is still there, otherwise None
+    manifest = read_manifest(manifest_path)
+    if manifest.get("model_site") != model_site:
+        return None
+    entries = manifest.get("files", {})
+    files_path = {}
+    changed = False
+    for sub_model_name, sub_model_info in model_site_info.items():
+        for filename in sub_model_info["file_list"]:
+            entry = entries.get(f'{sub_model_name}/{filename}')
+            if entry is None or entry["revision"] != sub_model_info["revision"] \
+                    or entry["source"] != get_file_source(sub_model_info, filename, manifest["download_method"]):
+                return None
+            file_path = Path(entry["path"]) if os.path.isabs(entry["path"]) else manifest_path.parent / entry["path"]
+            if not file_path.is_file() or os.path.getsize(file_path) != entry["size"]:
+                logger.warning(f'"{str(file_path)}" is missing or its size not match with manifest.')
+                return None
+            if os.path.getmtime(file_path) != entry["mtime"]:
+                # Copied or touched, hash tells if content is still the same
+                if get_file_sha256(file_path) != entry["sha256"]:
+                    logger.warning(f'"{str(file_path)}" sha256 not match with manifest.')
+                    return None
+                entry["mtime"] = os.path.getmtime(file_path)
+                changed = True
+            files_path[(sub_model_name, filename)] = file_path
+    if changed:
+        with open(manifest_path, "wt", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return files_path
+
+
+def write_manifest(
+        logger: Logger,
+        manifest_path: Path,
+        model_site: str,
+        download_method: str,
+        model_site_info: dict[str],
+        files_path: dict
+):
+    # Hashes of files not changed since last manifest are reused
+    old_entries = read_manifest(manifest_path).get("files", {})
+    entries = {}
+    for (sub_model_name, filename), file_path in files_path.items():
+        file_path = Path(file_path)
+        sub_model_info = model_site_info[sub_model_name]
+        key = f'{sub_model_name}/{filename}'
+        try:
+            relative_path = file_path.resolve().relative_to(manifest_path.parent.resolve())
+            entry_path = relative_path.as_posix()
+        except ValueError:
+            entry_path = str(file_path)
+        size, mtime = os.path.getsize(file_path), os.path.getmtime(file_path)
+        old_entry = old_entries.get(key, {})
+        if old_entry.get("path") == entry_path and old_entry.get("size") == size and old_entry.get("mtime") == mtime:
+            sha256 = old_entry["sha256"]
+        else:
+            sha256 = get_file_sha256(file_path)
+        entries[key] = {
+            "path": entry_path,
+            "size": size,
+            "mtime": mtime,
+            "sha256": sha256,
+            "source": get_file_source(sub_model_info, filename, download_method),
+            "revision": sub_model_info["revision"],
+            "resolved_revision": get_resolved_revision(file_path, sub_model_info["revision"]),
+        }
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "model_site": model_site,
+        "download_method": download_method,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "files": entries,
+    }
+    os.makedirs(manifest_path.parent, exist_ok=True)
+    with open(f'{manifest_path}.tmp', "wt", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    logger.debug(f'Manifest saved to {str(manifest_path)}')
+
+
 def download_models(
         logger: Logger,
         models_type: str,
@@ -90,6 +644,10 @@ def download_models(
             elif models_type in ["joy", "llama"]:
                 model_name = list(datas.keys())[0] if args['llm_model_name'] is None else args['llm_model_name']
                 args['llm_model_name'] = model_name
+            elif models_type == "assistant":
+                model_name = list(datas.keys())[0] if args.get('llm_assistant_model_name') is None \
+                    else args['llm_assistant_model_name']
+                args['llm_assistant_model_name'] = model_name
             else:
                 logger.error("Invalid model type!")
                 raise ValueError
@@ -117,11 +675,20 @@ def download_models(
             skip_local_file_exist: bool = True,
             force_download: bool = False
     ):
-        if model_site not in ["huggingface","modelscope"]:
+        if model_site not in ["huggingface","modelscope","auto"]:
             logger.error('Invalid model site!')
             raise ValueError
 
-        model_site_info = model_info[model_site]
+        if model_site == "auto":
+            # Files are downloaded from all sites at the same time, SDKs can't do this
+            if download_method == "sdk":
+                logger.info('model_site is auto, will download models from all sites with URL method.')
+                download_method = "url"
+            mirror_sites = [site for site in MODEL_SITES if site in model_info]
+            model_site_info = model_info[mirror_sites[0]]
+        else:
+            mirror_sites = [model_site]
+            model_site_info = model_info[model_site]
         try:
             if download_method == "sdk":
                 if model_site == "huggingface":
@@ -137,7 +704,7 @@ def download_models(
                 logger.warning('modelscope not installed or download via it failed, '
                                'retrying with URL method to download...')
 
-            models_path = download_choice(
+            return download_choice(
                 model_info,
                 model_site,
                 models_save_path,
@@ -146,64 +713,96 @@ def download_models(
                 skip_local_file_exist=skip_local_file_exist,
                 force_download=force_download
             )
-            return models_path
 
-        models_path = []
-        for sub_model_name in model_site_info:
+        download_workers = max(int(args.get('download_workers', 4)), 1)
+        connections = int(args.get('download_connections', 8))
+        session, progress = None, None
+        if download_method.lower() != 'sdk':
+            # All files share one connection pool and one progress bar
+            session = get_download_session(download_workers * max(connections, 1))
+            progress = DownloadProgress(f'Downloading {model_name}')
+
+        def download_file(sub_model_name: str, filename: str):
             sub_model_info = model_site_info[sub_model_name]
-            sub_model_path = ""
-
-            for filename in sub_model_info["file_list"]:
-                if download_method.lower() == 'sdk':
-                    if model_site == "huggingface":
-                        logger.info(f'Will download "{filename}" from huggingface repo: "{sub_model_info["repo_id"]}".')
-                        sub_model_path = hf_hub_download(
-                            repo_id=sub_model_info["repo_id"],
-                            filename=filename,
-                            subfolder=sub_model_info["subfolder"] if sub_model_info["subfolder"] != "" else None,
-                            repo_type=sub_model_info["repo_type"],
-                            revision=sub_model_info["revision"],
-                            local_dir=os.path.join(models_save_path, sub_model_name) if not use_sdk_cache else None,
-                            local_files_only=skip_local_file_exist \
-                                if os.path.exists(os.path.join(models_save_path, sub_model_name, filename)) else False,
-                            # local_dir_use_symlinks=False if not use_sdk_cache else "auto",
-                            # resume_download=True,
-                            force_download=force_download
-                        )
-                    elif model_site == "modelscope":
-                        logger.info(f'Will download "{filename}" from modelscope repo: "{sub_model_info["repo_id"]}".')
-                        sub_model_path = model_file_download(
-                            model_id=sub_model_info["repo_id"],
-                            file_path=filename if sub_model_info["subfolder"] == ""
-                            else os.path.join(sub_model_info["subfolder"], filename),
-                            revision=sub_model_info["revision"],
-                            local_files_only=skip_local_file_exist,
-                            local_dir=os.path.join(models_save_path, sub_model_name) if not use_sdk_cache else None,
-                        )
-                else:
-                    model_url = sub_model_info["file_list"][filename]
-                    logger.info(f'Will download model from url: {model_url}')
-                    sub_model_path = url_download(
-                        logger=logger,
-                        url=model_url,
-                        local_dir=os.path.join(models_save_path, sub_model_name) if sub_model_info["subfolder"] == ""
-                        else os.path.join(models_save_path, sub_model_name, sub_model_info["subfolder"]),
-                        force_filename=filename,
-                        skip_local_file_exist=skip_local_file_exist,
+            if download_method.lower() == 'sdk':
+                if model_site == "huggingface":
+                    logger.info(f'Will download "{filename}" from huggingface repo: "{sub_model_info["repo_id"]}".')
+                    return hf_hub_download(
+                        repo_id=sub_model_info["repo_id"],
+                        filename=filename,
+                        subfolder=sub_model_info["subfolder"] if sub_model_info["subfolder"] != "" else None,
+                        repo_type=sub_model_info["repo_type"],
+                        revision=sub_model_info["revision"],
+                        local_dir=os.path.join(models_save_path, sub_model_name) if not use_sdk_cache else None,
+                        local_files_only=skip_local_file_exist \
+                            if os.path.exists(os.path.join(models_save_path, sub_model_name, filename)) else False,
+                        # local_dir_use_symlinks=False if not use_sdk_cache else "auto",
+                        # resume_download=True,
                         force_download=force_download
                     )
-            models_path.append(sub_model_path)
-        return models_path
-
-    models_path = download_choice(
-        model_info=model_info,
-        model_site=str(args['model_site']),
-        models_save_path=Path(models_save_path),
-        download_method=str(args['download_method']).lower(),
-        use_sdk_cache=args['use_sdk_cache'],
-        skip_local_file_exist=args['skip_download'],
-        force_download=args['force_download']
-    )
+                elif model_site == "modelscope":
+                    logger.info(f'Will download "{filename}" from modelscope repo: "{sub_model_info["repo_id"]}".')
+                    return model_file_download(
+                        model_id=sub_model_info["repo_id"],
+                        file_path=filename if sub_model_info["subfolder"] == ""
+                        else os.path.join(sub_model_info["subfolder"], filename),
+                        revision=sub_model_info["revision"],
+                        local_files_only=skip_local_file_exist,
+                        local_dir=os.path.join(models_save_path, sub_model_name) if not use_sdk_cache else None,
+                    )
+            else:
+                model_url = sub_model_info["file_list"][filename]
+                logger.info(f'Will download model from url: {model_url}')
+                return url_download(
+                    logger=logger,
+                    url=model_url,
+                    local_dir=os.path.join(models_save_path, sub_model_name) if sub_model_info["subfolder"] == ""
+                    else os.path.join(models_save_path, sub_model_name, sub_model_info["subfolder"]),
+                    force_filename=filename,
+                    skip_local_file_exist=skip_local_file_exist,
+                    force_download=force_download,
+                    connections=connections,
+                    session=session,
+                    progress=progress,
+                    mirrors=[model_info[site][sub_model_name]["file_list"][filename] for site in mirror_sites
+                             if filename in model_info[site].get(sub_model_name, {}).get("file_list", {})]
+                )
+
+        tasks = [(sub_model_name, filename)
+                 for sub_model_name in model_site_info
+                 for filename in model_site_info[sub_model_name]["file_list"]]
+        try:
+            files_path = run_download_tasks(logger, tasks, download_file, download_workers)
+        finally:
+            if progress is not None:
+                progress.close()
+            if session is not None:
+                session.close()
+        return download_method.lower(), files_path
+
+    model_site = str(args['model_site'])
+    # `auto` keeps files of the first site in manifest
+    info_site = next((site for site in MODEL_SITES if site in model_info), model_site) \
+        if model_site == "auto" else model_site
+    manifest_path = Path(os.path.join(models_save_path, MANIFEST_FILE))
+    files_path = None
+    if info_site in model_info and not args['force_download'] and not args.get('refresh_models', False):
+        files_path = check_manifest(logger, manifest_path, model_site, model_info[info_site])
+        if files_path is not None:
+            logger.info(f'All files of {model_name} match with {str(manifest_path)}, skip checking them online.')
+
+    if files_path is None:
+        download_method, files_path = download_choice(
+            model_info=model_info,
+            model_site=model_site,
+            models_save_path=Path(models_save_path),
+            download_method=str(args['download_method']).lower(),
+            use_sdk_cache=args['use_sdk_cache'],
+            skip_local_file_exist=args['skip_download'],
+            force_download=args['force_download']
+        )
+        write_manifest(logger, manifest_path, model_site, download_method, model_info[info_site], files_path)
+    models_path = get_models_path(model_info[info_site], files_path)
 
     if models_type == "wd":
         models_path = os.path.dirname(models_path[0])
@@ -218,6 +817,6 @@ def download_models(
         clip_path = Path(os.path.dirname(models_path[1]))
         llm_path = Path(os.path.dirname(models_path[2]))
         return image_adapter_path, clip_path, llm_path
-    elif models_type == "llama":
+    elif models_type in ["llama", "assistant"]:
         llm_path = Path(os.path.dirname(models_path[0]))
         return llm_path
@@ -1,6 +1,7 @@
 import base64
 import glob
 import os
+import time
 from pathlib import Path
 from typing import List
 
@@ -10,8 +11,16 @@ from io import BytesIO
 from PIL import Image
 
 from utils.logger import Logger
+from utils.metrics import METRICS
 
 SUPPORT_IMAGE_FORMATS = ("bmp", "jpg", "jpeg", "png","webp")
+# Folders written into data_path by default(tag index and its copies while saving), never searched for images
+EXCLUDED_DIR_NAMES = ("tag_index", "tag_index.new", "tag_index.old")
+
+
+def is_excluded_path(path: str, root: Path) -> bool:
+    # Only folders below root count, root itself may be anywhere
+    return any(part in EXCLUDED_DIR_NAMES for part in Path(os.path.relpath(path, root)).parts[:-1])
 
 
 def get_image_paths(
@@ -20,12 +29,15 @@ def get_image_paths(
         recursive:bool = False,
 ) -> List[str]:
     # Get image paths
+    start_time = time.monotonic()
     path_to_find = os.path.join(path, '**') if recursive else os.path.join(path, '*')
     image_paths = sorted(set(
         [image for image in glob.glob(path_to_find, recursive=recursive)
-         if image.lower().endswith(SUPPORT_IMAGE_FORMATS)]), key=lambda filename: (os.path.splitext(filename)[0])
+         if image.lower().endswith(SUPPORT_IMAGE_FORMATS) and not is_excluded_path(image, path)]),
+        key=lambda filename: (os.path.splitext(filename)[0])
     ) if not os.path.isfile(path) else [str(path)] \
         if str(path).lower().endswith(SUPPORT_IMAGE_FORMATS) else None
+    METRICS.observe("discovery", time.monotonic() - start_time)
 
     logger.debug(f"Path for inference: \"{path}\"")
 
@@ -36,7 +48,16 @@ def get_image_paths(
     logger.info(f'Found {len(image_paths)} image(s).')
     return image_paths
 
+def load_image(image_path: str) -> Image.Image:
+    # Decode now, so decode time isn't counted as preprocess
+    start_time = time.monotonic()
+    image = Image.open(image_path)
+    image.load()
+    METRICS.observe("decode", time.monotonic() - start_time)
+    return image
+
 def image_process(image: Image.Image, target_size: int) -> numpy.ndarray:
+    start_time = time.monotonic()
     # make alpha to white
     image = image.convert('RGBA')
     new_image = Image.new('RGBA', image.size, 'WHITE')
@@ -82,6 +103,7 @@ def image_process(image: Image.Image, target_size: int) -> numpy.ndarray:
             interpolation=cv2.INTER_LANCZOS4
         )
 
+    METRICS.observe("preprocess", time.monotonic() - start_time)
     return padded_image
 
 def image_process_image(
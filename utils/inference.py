@@ -1,15 +1,26 @@
+import copy
 import csv
+import hashlib
+import json
 import os
+import platform
+import threading
 import time
 from argparse import Namespace
 from pathlib import Path
+from typing import Optional
 
 import numpy
 from PIL import Image
-from tqdm import tqdm
 
-from utils.image import image_process, image_process_gbr, image_process_image, get_image_paths
+from utils.cache import EmbeddingCache, ResultCache, TagStore, get_files_fingerprint
+from utils.download import get_file_sha256
+from utils.image import image_process, image_process_gbr, image_process_image, get_image_paths, load_image
 from utils.logger import Logger
+from utils.metrics import METRICS
+from utils.pipeline import Pipeline, Stage
+from utils.profiler import PROFILER
+from utils.tag_index import TagIndex
 
 kaomojis = [
     "0_0",
@@ -70,19 +81,389 @@ def get_caption_file_path(
     return caption_file
 
 
+def write_caption_file(
+        logger: Logger,
+        caption_file: Path,
+        caption: str,
+        file_action: str,
+        image_path: str,
+        caption_type: str = "LLM",
+):
+    # caption_type is "WD" or "LLM", matching the `wd_file_action` and `llm_file_action` options
+    start_time = time.monotonic()
+    if file_action == "overwrite":
+        with open(caption_file, "wt", encoding="utf-8") as f:
+            f.write(caption)
+            logger.warning(f'{caption_type.lower()}_file_action is set to overwrite!!!')
+    elif file_action == "prepend":
+        with open(caption_file, "rt", encoding="utf-8") as f:
+            existing_content = f.read()
+        with open(caption_file, "wt", encoding="utf-8") as f:
+            f.write(caption + existing_content)
+            logger.warning(f'{caption_type.lower()}_file_action is set to prepend!!!')
+    elif file_action == "append":
+        with open(caption_file, "at", encoding="utf-8") as f:
+            f.write(caption)
+            logger.warning(f'{caption_type.lower()}_file_action is set to append!!!')
+    elif file_action == "skip" and not os.path.isfile(caption_file):
+        with open(caption_file, "wt", encoding="utf-8") as f:
+            f.write(caption)
+    else:
+        return
+    METRICS.observe("write", time.monotonic() - start_time)
+    logger.debug(f"Image path: {image_path}")
+    logger.debug(f"{caption_type} Caption path: {caption_file}")
+    logger.debug(f"{caption_type} Caption content: {caption}")
+
+
+def get_llm_prompt_variants(args: Namespace) -> list[dict]:
+    # Without `llm_prompt_variants`, caption with `llm_user_prompt` into `llm_caption_extension` only
+    variants = args.get('llm_prompt_variants') or [{}]
+    prompt_variants = []
+    for variant in variants:
+        with_wd = bool(variant.get("with_wd", True))
+        user_prompt = variant.get("user_prompt") or ""
+        if not user_prompt:
+            user_prompt = DEFAULT_USER_PROMPT_WITHOUT_WD \
+                if not with_wd and args['llm_user_prompt'] == DEFAULT_USER_PROMPT_WITH_WD else args['llm_user_prompt']
+        prompt_variants.append({
+            "user_prompt": user_prompt,
+            "caption_extension": variant.get("caption_extension") or args['llm_caption_extension'],
+            "with_wd": with_wd
+        })
+    return prompt_variants
+
+
+def get_llm_caption_extension(
+        caption_extension: str,
+        sample_index: int,
+) -> str:
+    # First sample keeps the extension, others are saved like `image.1.txt`, `image.2.txt`...
+    return caption_extension if sample_index == 0 else f'.{sample_index}{caption_extension}'
+
+
+def get_models_save_path(args: Namespace) -> Path:
+    # Same folder `download_models` saves models into, relative paths are under this repo
+    return Path(args['models_save_path'] if os.path.exists(args['models_save_path'])
+                else os.path.join(Path(__file__).parent.parent, args['models_save_path']))
+
+
+def get_llm_models_dir(args: Namespace) -> Path:
+    return Path(os.path.join(get_models_save_path(args), args['llm_model_name']))
+
+
+def get_prepared_model_info(
+        args: Namespace,
+        source_paths: list[Path],
+) -> tuple[Path, dict]:
+    # Prepared models are only valid for the same source weights, quantization, dtype and transformers version
+    try:
+        import transformers
+        transformers_version = transformers.__version__
+    except ImportError:
+        transformers_version = None
+    if args['llm_use_cpu']:
+        # bitsandbytes is not used on CPU, int8 CPU models are quantized from fp32 weights after loading
+        llm_qnt = "none"
+        llm_dtype = "bf16" if str(args.get('llm_cpu_dtype', "fp32")).lower() == "bf16" else "fp32"
+        prepared_dir = get_llm_models_dir(args) / f'prepared_cpu_{llm_dtype}'
+    else:
+        llm_qnt = args['llm_qnt']
+        llm_dtype = args['llm_dtype']
+        prepared_dir = get_llm_models_dir(args) / f'prepared_{llm_qnt}_{llm_dtype}'
+    prepared_info = {
+        "source": get_files_fingerprint(source_paths, extensions=(".safetensors", ".bin", ".pt", ".json")),
+        "llm_use_cpu": args['llm_use_cpu'],
+        "llm_qnt": llm_qnt,
+        "llm_dtype": llm_dtype,
+        "transformers": transformers_version
+    }
+    return prepared_dir, prepared_info
+
+
+def is_prepared_model(
+        logger: Logger,
+        prepared_dir: Path,
+        prepared_info: dict,
+) -> bool:
+    info_file = prepared_dir / "prepared.json"
+    if not os.path.isfile(info_file):
+        return False
+    try:
+        with open(info_file, 'r', encoding='utf-8') as f:
+            if json.load(f) == prepared_info:
+                return True
+    except (OSError, ValueError) as e:
+        logger.warning(f'Prepared model info {info_file} is broken.\nerror info: {e}')
+    logger.warning(f'Prepared model in {prepared_dir} is outdated, will prepare it again.')
+    return False
+
+
+def save_prepared_info(
+        prepared_dir: Path,
+        prepared_info: dict,
+):
+    # Written last, so an interrupted prepare is never loaded
+    info_file = prepared_dir / "prepared.json"
+    temp_info_file = info_file.with_suffix(".json.tmp")
+    with open(temp_info_file, 'w', encoding='utf-8') as f:
+        json.dump(prepared_info, f, indent=4)
+    os.replace(temp_info_file, info_file)
+
+
+def set_cpu_threads(
+        logger: Logger,
+        args: Namespace,
+):
+    # Import torch
+    try:
+        import torch
+    except ImportError as ie:
+        logger.error(f'Import torch Failed!\nDetails: {ie}')
+        raise ImportError
+
+    num_threads = int(args.get('llm_cpu_threads', 0))
+    num_interop_threads = int(args.get('llm_cpu_interop_threads', 0))
+    if num_interop_threads > 0:
+        try:
+            # Only allowed before torch runs any inter-op parallel work
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            logger.warning(f'Failed to set CPU interop threads.\nerror info: {e}')
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    logger.info(f'CPU threads: {torch.get_num_threads()}, interop threads: {torch.get_num_interop_threads()}')
+
+
+def get_cpu_llm_dtype(
+        logger: Logger,
+        args: Namespace,
+):
+    # Import torch
+    try:
+        import torch
+    except ImportError as ie:
+        logger.error(f'Import torch Failed!\nDetails: {ie}')
+        raise ImportError
+
+    cpu_dtype = str(args.get('llm_cpu_dtype', "fp32")).lower()
+    if cpu_dtype == "bf16":
+        if torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return torch.bfloat16
+        logger.warning('This CPU has no native bf16 support, LLM will use fp32.')
+    elif cpu_dtype not in ["fp32", "int8"]:
+        logger.warning(f'Invalid llm_cpu_dtype "{cpu_dtype}", LLM will use fp32.')
+    # int8 loads fp32 weights, linear layers are quantized after loading
+    return torch.float32
+
+
+def quantize_cpu_llm(
+        logger: Logger,
+        args: Namespace,
+        model,
+):
+    if not args['llm_use_cpu'] or str(args.get('llm_cpu_dtype', "fp32")).lower() != "int8":
+        return model
+    # Import torch
+    try:
+        import torch
+    except ImportError as ie:
+        logger.error(f'Import torch Failed!\nDetails: {ie}')
+        raise ImportError
+
+    # Weights of linear layers are stored in int8, activations are quantized on the fly
+    start_time = time.monotonic()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    logger.info(f'Linear layers quantized to dynamic int8 in {time.monotonic() - start_time:.1f}s.')
+    return model
+
+
+def load_assistant_model(
+        logger: Logger,
+        args: Namespace,
+        assistant_path: Path,
+):
+    if not os.path.exists(assistant_path):
+        logger.error(f'{str(assistant_path)} NOT FOUND!')
+        raise FileNotFoundError
+    # Import torch
+    try:
+        import torch
+    except ImportError as ie:
+        logger.error(f'Import torch Failed!\nDetails: {ie}')
+        raise ImportError
+    # Import transformers
+    try:
+        from transformers import AutoModelForCausalLM
+    except ImportError as ie:
+        logger.error(f'Import transformers Failed!\nDetails: {ie}')
+        raise ImportError
+
+    logger.info(f'Loading assistant model `{args["llm_assistant_model_name"]}` '
+                f'with {"CPU" if args["llm_use_cpu"] else "GPU"}...')
+    start_time = time.monotonic()
+    assistant_dtype = get_cpu_llm_dtype(logger, args) if args['llm_use_cpu'] else torch.float16 \
+        if args['llm_dtype'] == "fp16" else torch.bfloat16
+    # Draft model is small, never quantize it with bitsandbytes
+    assistant_model = AutoModelForCausalLM.from_pretrained(assistant_path,
+                                                           device_map="cuda" if not args['llm_use_cpu'] else "cpu",
+                                                           low_cpu_mem_usage=True,
+                                                           torch_dtype=assistant_dtype)
+    assistant_model = quantize_cpu_llm(logger, args, assistant_model)
+    assistant_model.eval()
+    assistant_model.generation_config.num_assistant_tokens = int(args.get('llm_assistant_tokens', 5))
+
+    # transformers copies every generate kwarg of the main model to the assistant,
+    # drop Mllama vision inputs and map tokens the draft vocab doesn't have (`<|image|>`) to its eos.
+    assistant_generate = assistant_model.generate
+    assistant_vocab_size = assistant_model.get_input_embeddings().num_embeddings
+    assistant_eos_token_id = assistant_model.generation_config.eos_token_id
+    if isinstance(assistant_eos_token_id, list):
+        assistant_eos_token_id = assistant_eos_token_id[0]
+
+    def generate_text_only(input_ids=None, **kwargs):
+        for key in ("pixel_values", "aspect_ratio_ids", "aspect_ratio_mask", "cross_attention_mask"):
+            kwargs.pop(key, None)
+        if input_ids is not None:
+            input_ids = input_ids.masked_fill(input_ids >= assistant_vocab_size, assistant_eos_token_id or 0)
+        return assistant_generate(input_ids=input_ids, **kwargs)
+
+    assistant_model.generate = generate_text_only
+    logger.info(f'Assistant model Loaded in {time.monotonic() - start_time:.1f}s.')
+    return assistant_model
+
+
+class AssistantStats:
+    def __init__(
+            self,
+            llm,
+            assistant_model,
+    ):
+        self.generate_calls = 0
+        self.new_tokens = 0
+        self.decode_time = 0.0
+        self.target_passes = 0
+        self.target_time = 0.0
+        self.draft_passes = 0
+        # Only count forward passes made inside assisted `generate`, not prefill
+        self.counting = False
+        self.target_start_time = None
+        self.hook_handles = [
+            llm.register_forward_pre_hook(self.target_pre_hook),
+            llm.register_forward_hook(self.target_hook),
+            assistant_model.register_forward_hook(self.draft_hook)
+        ]
+
+    def target_pre_hook(self, module, inputs):
+        if self.counting:
+            self.target_start_time = time.monotonic()
+
+    def target_hook(self, module, inputs, outputs):
+        if self.counting and self.target_start_time is not None:
+            self.target_passes += 1
+            self.target_time += time.monotonic() - self.target_start_time
+            self.target_start_time = None
+
+    def draft_hook(self, module, inputs, outputs):
+        if self.counting:
+            self.draft_passes += 1
+
+    def log(self, logger: Logger):
+        if self.generate_calls == 0 or self.target_passes == 0:
+            return
+        # Every target pass keeps the accepted draft tokens plus one token of its own,
+        # and every draft pass proposes one token.
+        accepted_tokens = self.new_tokens - self.target_passes
+        acceptance_rate = accepted_tokens / self.draft_passes if self.draft_passes > 0 else 0.0
+        # Without the assistant every new token costs one target pass. Verifying several tokens costs about
+        # the same as one when decoding is memory bound (GPU), so this is optimistic on CPU.
+        speedup = self.new_tokens * (self.target_time / self.target_passes) / self.decode_time \
+            if self.decode_time > 0 else 0.0
+        logger.info(f'Assisted generation: {self.generate_calls} call(s), {self.new_tokens} token(s) '
+                    f'in {self.target_passes} target pass(es) and {self.draft_passes} draft pass(es).')
+        logger.info(f'Assisted generation: acceptance rate {acceptance_rate:.1%}, '
+                    f'{self.new_tokens / self.target_passes:.2f} tokens per target pass, '
+                    f'{self.new_tokens / self.decode_time:.1f} tokens/s, estimated speedup {speedup:.2f}x.')
+
+    def remove(self):
+        for hook_handle in self.hook_handles:
+            hook_handle.remove()
+        self.hook_handles = []
+
+
+class RepetitionStoppingCriteria:
+    def __init__(
+            self,
+            prompt_length: int,
+            ngram_size: int,
+    ):
+        self.prompt_length = prompt_length
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated_ids = input_ids[:, self.prompt_length:]
+        if generated_ids.shape[-1] <= self.ngram_size:
+            return input_ids.new_zeros(input_ids.shape[0]).bool()
+        # Stop a sequence once its last n-gram already appeared in its generated tokens, it is looping
+        ngrams = generated_ids.unfold(-1, self.ngram_size, 1)
+        return (ngrams[:, :-1] == ngrams[:, -1:]).all(dim=-1).any(dim=-1)
+
+
+def get_stopping_criteria(
+        logger: Logger,
+        prompt_length: int,
+        ngram_size: int,
+):
+    if ngram_size <= 0:
+        return None
+    # Import transformers
+    try:
+        from transformers import StoppingCriteriaList
+    except ImportError as ie:
+        logger.error(f'Import transformers Failed!\nDetails: {ie}')
+        raise ImportError
+
+    return StoppingCriteriaList([RepetitionStoppingCriteria(prompt_length, ngram_size)])
+
+
+def trim_repetition(
+        token_ids: list[int],
+        ngram_size: int,
+) -> tuple[list[int], Optional[int]]:
+    # Cut generated tokens before the first repeated n-gram, also return where that n-gram ends
+    if ngram_size <= 0:
+        return token_ids, None
+    seen_ngrams = set()
+    for end in range(ngram_size - 1, len(token_ids)):
+        ngram = tuple(token_ids[end - ngram_size + 1:end + 1])
+        if ngram in seen_ngrams:
+            return token_ids[:end - ngram_size + 1], end
+        seen_ngrams.add(ngram)
+    return token_ids, None
+
+
 class Llama:
     def __init__(
             self,
             logger: Logger,
             args: Namespace,
             llm_path: Path,
+            assistant_path: Optional[Path] = None,
     ):
         self.logger = logger
         self.args = args
         self.llm_path = llm_path
+        self.assistant_path = assistant_path
         self.llm = None
         self.llm_processor = None
         # self.llm_tokenizer = None
+        self.assistant_model = None
+        self.assistant_stats = None
+        self.repetition_ngram = int(self.args.get('llm_repetition_ngram', 0))
+        self.repetition_stopped = 0
+        self.repetition_tokens_saved = 0
+        self.prefix_cache = bool(self.args.get('llm_prefix_cache', False))
+        self.prefix_tokens_saved = 0
 
     def load_model(self):
         if not os.path.exists(self.llm_path):
@@ -105,13 +486,21 @@ class Llama:
             self.logger.error(f'Import transformers Failed!\nDetails: {ie}')
             raise ImportError
 
+        if self.args['llm_use_cpu']:
+            set_cpu_threads(self.logger, self.args)
+
         # Load LLM
         self.logger.info(f'Loading LLM `{self.args["llm_model_name"]}` with {"CPU" if self.args["llm_use_cpu"] else "GPU"}...')
         start_time = time.monotonic()
-        llm_dtype = torch.float32 if self.args['llm_use_cpu'] else torch.float16 \
+        llm_dtype = get_cpu_llm_dtype(self.logger, self.args) if self.args['llm_use_cpu'] else torch.float16 \
             if self.args['llm_dtype'] == "fp16" else torch.bfloat16
         self.logger.info(f'LLM dtype: {llm_dtype}')
-        if self.args['llm_qnt'] == "4bit":
+        if self.args['llm_use_cpu']:
+            if self.args['llm_qnt'] != "none":
+                self.logger.warning(f'bitsandbytes {self.args["llm_qnt"]} quantization needs GPU, ignored on CPU. '
+                                    f'Set llm_cpu_dtype to "int8" or "bf16" instead.')
+            qnt_config = None
+        elif self.args['llm_qnt'] == "4bit":
             qnt_config = BitsAndBytesConfig(load_in_4bit=True,
                                             bnb_4bit_quant_type="nf4",
                                             llm_int8_enable_fp32_cpu_offload=True,
@@ -125,11 +514,35 @@ class Llama:
             self.logger.info(f'LLM 8bit quantization: Enabled')
         else:
             qnt_config = None
-        self.llm = MllamaForConditionalGeneration.from_pretrained(self.llm_path,
-                                                                  device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
-                                                                  low_cpu_mem_usage=True if not self.args['llm_use_cpu'] else False,
-                                                                  torch_dtype=llm_dtype if self.args['llm_qnt'] == "none" else None,
-                                                                  quantization_config=qnt_config)
+        prepared_dir = prepared_info = None
+        if self.args.get('llm_prepared_models', False):
+            prepared_dir, prepared_info = get_prepared_model_info(self.args, [self.llm_path])
+        if prepared_dir is not None and is_prepared_model(self.logger, prepared_dir, prepared_info):
+            # Quantization config is saved with the prepared model, weights are memory mapped from safetensors
+            self.logger.info(f'Loading prepared LLM from {str(prepared_dir)}...')
+            self.llm = MllamaForConditionalGeneration.from_pretrained(prepared_dir,
+                                                                      device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
+                                                                      low_cpu_mem_usage=True,
+                                                                      torch_dtype=llm_dtype if qnt_config is None else None)
+        else:
+            self.llm = MllamaForConditionalGeneration.from_pretrained(self.llm_path,
+                                                                      device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
+                                                                      low_cpu_mem_usage=True,
+                                                                      torch_dtype=llm_dtype if qnt_config is None else None,
+                                                                      quantization_config=qnt_config)
+            if prepared_dir is not None:
+                # Save quantized weights once, later starts skip loading full precision weights and quantizing
+                try:
+                    self.logger.info(f'Saving prepared LLM to {str(prepared_dir)}...')
+                    save_start_time = time.monotonic()
+                    os.makedirs(prepared_dir, exist_ok=True)
+                    self.llm.save_pretrained(prepared_dir, safe_serialization=True)
+                    save_prepared_info(prepared_dir, prepared_info)
+                    self.logger.info(f'Prepared LLM saved in {time.monotonic() - save_start_time:.1f}s.')
+                except Exception as e:
+                    self.logger.warning(f'Failed to save prepared LLM, will load original model next time.\n'
+                                        f'error info: {e}')
+        self.llm = quantize_cpu_llm(self.logger, self.args, self.llm)
         self.llm.eval()
         # self.llm_tokenizer = AutoTokenizer.from_pretrained(self.llm_path)
         self.logger.info(f'LLM Loaded in {time.monotonic() - start_time:.1f}s.')
@@ -140,6 +553,52 @@ class Llama:
         self.llm_processor = AutoProcessor.from_pretrained(self.llm_path)
         self.logger.info(f'Processor Loaded in {time.monotonic() - start_time:.1f}s.')
 
+        # Load assistant model
+        if self.assistant_path is not None:
+            self.assistant_model = load_assistant_model(self.logger, self.args, self.assistant_path)
+            self.assistant_stats = AssistantStats(self.llm, self.assistant_model)
+
+        if self.args.get('llm_compile', False) and not getattr(self.llm, "_supports_static_cache", False):
+            # Mllama keeps cross attention states in its KV cache, transformers has no static cache for it
+            self.logger.warning('Llama-3.2 Vision models don\'t support static KV cache, llm_compile is ignored.')
+
+    def collate_inputs(self, rows: list):
+        # Import torch
+        try:
+            import torch
+            from transformers import BatchFeature
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
+
+        if len(rows) == 1:
+            return rows[0]
+
+        pad_token_id = self.llm_processor.tokenizer.pad_token_id \
+            if self.llm_processor.tokenizer.pad_token_id is not None else self.llm_processor.tokenizer.eos_token_id
+        max_length = max(row["input_ids"].shape[-1] for row in rows)
+        max_tiles = max(row["cross_attention_mask"].shape[-1] for row in rows) \
+            if "cross_attention_mask" in rows[0] else 0
+
+        batch = {}
+        for key in rows[0].keys():
+            values = []
+            for row in rows:
+                value = row[key]
+                pad_length = max_length - row["input_ids"].shape[-1]
+                if key in ("input_ids", "attention_mask"):
+                    # Generation continues from the right, so pad prompts on the left
+                    value = torch.nn.functional.pad(value, (pad_length, 0),
+                                                    value=pad_token_id if key == "input_ids" else 0)
+                elif key == "cross_attention_mask":
+                    # (batch, seq_len, num_images, num_tiles)
+                    value = torch.nn.functional.pad(value, (0, max_tiles - value.shape[-1], 0, 0, pad_length, 0),
+                                                    value=0)
+                values.append(value)
+            batch[key] = torch.cat(values, dim=0)
+
+        return BatchFeature(data=batch)
+
     def get_caption(
             self,
             image: Image.Image,
@@ -148,6 +607,23 @@ class Llama:
             temperature: float = 0.5,
             max_new_tokens: int = 512,
     ) -> str:
+        return self.get_caption_batch(
+            images=[image],
+            system_prompt=system_prompt,
+            user_prompts=[user_prompt],
+            temperature=temperature,
+            max_new_tokens=max_new_tokens
+        )[0]
+
+    def get_caption_batch(
+            self,
+            images: list[Image.Image],
+            system_prompt: str,
+            user_prompts: list[str],
+            temperature: float = 0.5,
+            max_new_tokens: int = 512,
+            num_samples: int = 1,
+    ) -> list[str]:
         # Import torch
         try:
             import torch
@@ -160,151 +636,319 @@ class Llama:
         if not self.args['llm_use_cpu']:
             self.logger.info(f'Will empty cuda device cache...')
             torch.cuda.empty_cache()
-        if system_prompt is not None or system_prompt != "":
-            messages = [
-                {"role": "system", "content": f"{system_prompt}"},
-                {"role": "user", "content": [
-                    {"type": "image"},
-                    {"type": "text", "text": f"{user_prompt}"}]
-                }
-            ]
-        else:
-            messages = [
-                {"role": "user", "content": [
-                    {"type": "image"},
-                    {"type": "text", "text": f"{user_prompt}"}]
-                }
-            ]
 
-        self.logger.debug(f"\nChat_template:\n{messages}")
+        input_texts = []
+        for user_prompt in user_prompts:
+            if system_prompt is not None or system_prompt != "":
+                messages = [
+                    {"role": "system", "content": f"{system_prompt}"},
+                    {"role": "user", "content": [
+                        {"type": "image"},
+                        {"type": "text", "text": f"{user_prompt}"}]
+                    }
+                ]
+            else:
+                messages = [
+                    {"role": "user", "content": [
+                        {"type": "image"},
+                        {"type": "text", "text": f"{user_prompt}"}]
+                    }
+                ]
+
+            self.logger.debug(f"\nChat_template:\n{messages}")
+            input_texts.append(self.llm_processor.apply_chat_template(messages, add_generation_prompt=True))
 
-        input_text = self.llm_processor.apply_chat_template(messages, add_generation_prompt=True)
-        inputs = self.llm_processor(image, input_text, return_tensors="pt").to(self.llm.device)
+        # Process rows one by one, then left pad them into a batch.
+        rows = [self.llm_processor(image, input_text, return_tensors="pt")
+                for image, input_text in zip(images, input_texts)]
+        inputs = self.collate_inputs(rows).to(self.llm.device)
 
         # Generate caption
+        self.logger.debug(f'LLM batch size is {len(images)}')
         self.logger.debug(f'LLM temperature is {temperature}')
         self.logger.debug(f'LLM max_new_tokens is {max_new_tokens}')
         # terminators = [
         #     self.llm_tokenizer.eos_token_id,
         #     self.llm_tokenizer.convert_tokens_to_ids("<|eot_id|>")
         # ]
+        start_time = time.monotonic()
+        generated_ids = None
+        if self.assistant_model is not None:
+            try:
+                generated_ids = self.generate_with_assistant(
+                    rows=rows,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    num_samples=num_samples
+                )
+            except Exception as e:
+                self.logger.warning(f'Assisted generation failed, will generate without assistant model.\n'
+                                    f'error info: {e}')
+                self.unload_assistant_model()
+
+        if generated_ids is None and self.prefix_cache:
+            generated_ids = self.generate_with_prefix_cache(
+                images=images,
+                rows=rows,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                num_samples=num_samples
+            )
+
+        if generated_ids is None:
+            generated_ids = self.generate_batch(
+                inputs=inputs,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                num_samples=num_samples
+            )
+        METRICS.observe("llm_inference", time.monotonic() - start_time)
+        METRICS.count("llm_prompt_tokens", int(inputs["attention_mask"].sum()))
+
+        start_time = time.monotonic()
+        stop_token_ids = self.llm.generation_config.eos_token_id
+        stop_token_ids = set(stop_token_ids if isinstance(stop_token_ids, list) else [stop_token_ids])
+        pad_token_id = self.llm.generation_config.pad_token_id
+        # Samples of the same row are next to each other
+        captions = []
+        for row_ids in generated_ids:
+            row_ids = row_ids.tolist()
+            if len(generated_ids) > 1 and pad_token_id not in stop_token_ids:
+                # Rows finished before the others in a batch are padded after their last token
+                while row_ids and row_ids[-1] == pad_token_id:
+                    row_ids.pop()
+            # Same ids as one image generated alone, ending with eos when the row finished
+            stop_index = next((index for index, token_id in enumerate(row_ids) if token_id in stop_token_ids),
+                              None)
+            if stop_index is not None:
+                row_ids = row_ids[:stop_index + 1]
+            generated_length = stop_index if stop_index is not None else len(row_ids)
+            METRICS.count("llm_generated_tokens", generated_length)
+            trimmed_ids, repetition_end = trim_repetition(row_ids[:generated_length], self.repetition_ngram)
+            # Only rows stopped by the repetition criteria are trimmed, rows ended by eos are left as they are
+            if repetition_end == generated_length - 1:
+                row_ids = trimmed_ids
+                self.repetition_stopped += 1
+                self.repetition_tokens_saved += max_new_tokens - generated_length
+            content = self.llm_processor.decode(row_ids)
+            content = content.rstrip("<|eot_id|>")
+
+            self.logger.debug(f'LLM Output:\n{content}')
+            content_list = str(content).split(".")
+            unique_content = list(dict.fromkeys(content_list))
+            unique_content = '.'.join(unique_content)
+            captions.append(unique_content)
+        METRICS.observe("llm_postprocess", time.monotonic() - start_time)
+        return captions
+
+    def generate_batch(
+            self,
+            inputs,
+            temperature: float = 0.5,
+            max_new_tokens: int = 512,
+            num_samples: int = 1,
+    ) -> list:
         output = self.llm.generate(**inputs,
                                    max_new_tokens=max_new_tokens,
                                    # eos_token_id=terminators,
                                    # do_sample=True, top_k=10,
                                    temperature=temperature,
                                    # suppress_tokens=None
+                                   stopping_criteria=get_stopping_criteria(self.logger,
+                                                                           inputs["input_ids"].shape[-1],
+                                                                           self.repetition_ngram),
+                                   **({"do_sample": True, "num_return_sequences": num_samples}
+                                      if num_samples > 1 else {})
                                    )
+        # Left padding puts every row's generated tokens right after the padded prompt length
+        return [output[i][inputs["input_ids"].shape[-1]:] for i in range(inputs["input_ids"].shape[0] * num_samples)]
 
-        content = self.llm_processor.decode(output[0][inputs["input_ids"].shape[-1]:])
-        content = content.rstrip("<|eot_id|>")
-
-        self.logger.debug(f'LLM Output:\n{content}')
-        content_list = str(content).split(".")
-        unique_content = list(dict.fromkeys(content_list))
-        unique_content = '.'.join(unique_content)
-        return unique_content
-
-    def inference(self):
-        image_paths = get_image_paths(logger=self.logger,path=Path(self.args['data_path']),recursive=self.args['recursive'])
-        system_prompt = str(self.args['llm_system_prompt'])
-        pbar = tqdm(total=len(image_paths), smoothing=0.0)
-        for image_path in image_paths:
-            try:
-                pbar.set_description('Processing: {}'.format(image_path if len(image_path) <= 40 else
-                                                             image_path[:15]) + ' ... ' + image_path[-20:])
-
-                llama_caption_file = get_caption_file_path(
-                    self.logger,
-                    data_path=self.args['data_path'],
-                    image_path=Path(image_path),
-                    custom_caption_save_path=self.args['custom_caption_save_path'],
-                    caption_extension=self.args['llm_caption_extension']
-                )
-
-                if self.args['llm_file_action'] == "skip" and os.path.isfile(llama_caption_file):
-                    self.logger.warning(f'llm_file_action is set to skip!!!'
-                                        f'LLM Caption file {llama_caption_file} already exists, Skip this caption.')
-                    continue
-
-                image = Image.open(image_path)
-                image = image_process(image, int(self.args['image_size']))
-                self.logger.debug(f"Resized image shape: {image.shape}")
-                image = image_process_image(image)
-
-                # Change user prompt
-                if (self.args['caption_method'] == "wd+llama"
-                    and not self.args['llm_caption_without_wd']
-                    and self.args['run_method'] == "queue") or (self.args['caption_method'] == "llama"
-                                                             and self.args['llm_read_wd_caption']):
-                    wd_caption_file = get_caption_file_path(
-                        self.logger,
-                        data_path=self.args['data_path'],
-                        image_path=Path(image_path),
-                        custom_caption_save_path=self.args['custom_caption_save_path'],
-                        caption_extension=self.args['wd_caption_extension']
-                    )
-                    if os.path.isfile(wd_caption_file):
-                        self.logger.debug(f'Loading WD caption file: {wd_caption_file}')
-                        with open(wd_caption_file, "r", encoding="utf-8") as wcf:
-                            tag_text = wcf.read()
-                        user_prompt = str(f'{self.args["llm_user_prompt"]}{tag_text}\n')
-                    else:
-                        self.logger.warning(f'WD caption file: {wd_caption_file} NOT FOUND!!! '
-                                            f'Inference without WD tags.')
-                        user_prompt = DEFAULT_USER_PROMPT_WITHOUT_WD
-                else:
-                    user_prompt = str(f'{self.args["llm_user_prompt"]}\n')
-
-                caption = self.get_caption(
-                    image=image,
-                    system_prompt=system_prompt,
-                    user_prompt=user_prompt,
-                    temperature=self.args['llm_temperature'],
-                    max_new_tokens=self.args['llm_max_tokens']
-                )
-                caption = caption.replace('\n', '')
-
-                if self.args['llm_file_action'] == "overwrite":
-                    with open(llama_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.warning(f'llm_file_action is set to overwrite!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {llama_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "prepend":
-                    with open(llama_caption_file, "rt", encoding="utf-8") as f:
-                        existing_content = f.read()
-                    with open(llama_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption + existing_content)
-                        self.logger.warning(f'llm_file_action is set to prepend!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {llama_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "append":
-                    with open(llama_caption_file, "at", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.warning(f'llm_file_action is set to append!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {llama_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "skip" and not os.path.isfile(llama_caption_file):
-                    with open(llama_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {llama_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
+    def generate_with_prefix_cache(
+            self,
+            images: list[Image.Image],
+            rows: list,
+            temperature: float = 0.5,
+            max_new_tokens: int = 512,
+            num_samples: int = 1,
+    ) -> Optional[list]:
+        # Import torch
+        try:
+            import torch
+            from transformers import DynamicCache
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
 
-            except Exception as e:
-                self.logger.error(f"Failed to caption image: {image_path}, skip it.\nerror info: {e}")
+        # Rows of one image(its prompt variants) share system turn, image and the start of user prompt.
+        # That prefix is prefilled once with the image and its KV cache is copied into each row's generation,
+        # samples of a row continue from one copy. Rows of different images can't share the system turn:
+        # in Mllama, text tokens before `<|image|>` still attend to the vision states through
+        # the cross attention layers (with a zeroed mask, not a blocked one), so their KV depends on the image.
+        groups = {}
+        for row_index, image in enumerate(images):
+            groups.setdefault(id(image), []).append(row_index)
+        if all(len(row_indexes) == 1 for row_indexes in groups.values()) and num_samples == 1:
+            # Nothing is shared, batched generation is faster
+            return None
+
+        generated_ids = [None] * len(rows)
+        if num_samples == 1:
+            # Images with one prompt are still generated in one batch
+            single_indexes = [row_indexes[0] for row_indexes in groups.values() if len(row_indexes) == 1]
+            if single_indexes:
+                inputs = self.collate_inputs([rows[row_index] for row_index in single_indexes]).to(self.llm.device)
+                for row_index, row_ids in zip(single_indexes, self.generate_batch(inputs, temperature,
+                                                                                  max_new_tokens)):
+                    generated_ids[row_index] = [row_ids]
+        for row_indexes in groups.values():
+            if generated_ids[row_indexes[0]] is not None:
+                continue
+            group_rows = [rows[row_index].to(self.llm.device) for row_index in row_indexes]
+            # Longest common prefix of token ids, at least one token is left for `generate` to prefill
+            prefix_length = min(row["input_ids"].shape[-1] for row in group_rows) - 1
+            first_ids = group_rows[0]["input_ids"][0]
+            for row in group_rows[1:]:
+                different = (row["input_ids"][0, :prefix_length] != first_ids[:prefix_length]).nonzero()
+                if len(different) > 0:
+                    prefix_length = int(different[0])
+            if not (first_ids[:prefix_length] == self.llm.config.image_token_index).any():
+                # Vision states are computed with `<|image|>`, prefix can't be prefilled without it
+                self.logger.debug(f'Prompt prefix of {prefix_length} token(s) has no image, not cached.')
+                for row_index, row in zip(row_indexes, group_rows):
+                    generated_ids[row_index] = self.generate_batch(row, temperature, max_new_tokens, num_samples)
                 continue
 
-            pbar.update(1)
+            prefix_cache = DynamicCache()
+            with torch.no_grad():
+                self.llm(input_ids=first_ids[None, :prefix_length],
+                         attention_mask=group_rows[0]["attention_mask"][:, :prefix_length],
+                         pixel_values=group_rows[0]["pixel_values"],
+                         aspect_ratio_ids=group_rows[0]["aspect_ratio_ids"],
+                         aspect_ratio_mask=group_rows[0]["aspect_ratio_mask"],
+                         cross_attention_mask=group_rows[0]["cross_attention_mask"][:, :prefix_length],
+                         past_key_values=prefix_cache,
+                         use_cache=True,
+                         num_logits_to_keep=1)
+            tokens_saved = prefix_length * (len(group_rows) * num_samples - 1)
+            self.prefix_tokens_saved += tokens_saved
+            METRICS.count("llm_prefix_tokens_saved", tokens_saved)
+
+            for row_index, row in zip(row_indexes, group_rows):
+                prompt_length = row["input_ids"].shape[-1]
+                row_cache = copy.deepcopy(prefix_cache)
+                if num_samples > 1:
+                    row_cache.batch_repeat_interleave(num_samples)
+                # `generate` only prefills the tokens after cached prefix, the image is already in the cache
+                output = self.llm.generate(input_ids=row["input_ids"].repeat_interleave(num_samples, dim=0),
+                                           attention_mask=row["attention_mask"].repeat_interleave(num_samples, dim=0),
+                                           cross_attention_mask=row["cross_attention_mask"].repeat_interleave(
+                                               num_samples, dim=0),
+                                           past_key_values=row_cache,
+                                           max_new_tokens=max_new_tokens,
+                                           temperature=temperature,
+                                           stopping_criteria=get_stopping_criteria(self.logger, prompt_length,
+                                                                                   self.repetition_ngram),
+                                           **({"do_sample": True} if num_samples > 1 else {}))
+                generated_ids[row_index] = [output[i][prompt_length:] for i in range(num_samples)]
+
+        # Samples of the same row are next to each other
+        return [sample_ids for row_ids in generated_ids for sample_ids in row_ids]
+
+    def generate_with_assistant(
+            self,
+            rows: list,
+            temperature: float = 0.5,
+            max_new_tokens: int = 512,
+            num_samples: int = 1,
+    ) -> list:
+        # Import torch
+        try:
+            import torch
+            from transformers import DynamicCache
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
 
-        pbar.close()
+        # transformers only supports assisted generation for one sequence at a time
+        generated_ids = []
+        for row in rows:
+            row = row.to(self.llm.device)
+            prompt_length = row["input_ids"].shape[-1]
+            # Prefill the image and all but the last prompt token here, so that `generate` only sees text tokens,
+            # the vision states stay in the cross attention cache and the draft model never needs the image.
+            prompt_cache = DynamicCache()
+            with torch.no_grad():
+                self.llm(input_ids=row["input_ids"][:, :-1],
+                         attention_mask=row["attention_mask"][:, :-1],
+                         pixel_values=row["pixel_values"],
+                         aspect_ratio_ids=row["aspect_ratio_ids"],
+                         aspect_ratio_mask=row["aspect_ratio_mask"],
+                         cross_attention_mask=row["cross_attention_mask"][:, :-1],
+                         past_key_values=prompt_cache,
+                         use_cache=True,
+                         num_logits_to_keep=1)
+            # Mllama grows `cross_attention_mask` by one token per step, but a verify step adds several tokens.
+            # Text tokens after the image share the last row, so extend it to the max length up front.
+            cross_attention_mask = torch.cat([
+                row["cross_attention_mask"],
+                row["cross_attention_mask"][:, -1:].expand(-1, max_new_tokens, -1, -1)
+            ], dim=1)
+
+            for _ in range(num_samples):
+                start_time = time.monotonic()
+                self.assistant_stats.counting = True
+                try:
+                    output = self.llm.generate(input_ids=row["input_ids"],
+                                               attention_mask=row["attention_mask"],
+                                               cross_attention_mask=cross_attention_mask,
+                                               past_key_values=copy.deepcopy(prompt_cache),
+                                               assistant_model=self.assistant_model,
+                                               max_new_tokens=max_new_tokens,
+                                               temperature=temperature,
+                                               stopping_criteria=get_stopping_criteria(self.logger, prompt_length,
+                                                                                       self.repetition_ngram),
+                                               **({"do_sample": True} if num_samples > 1 else {}))
+                finally:
+                    self.assistant_stats.counting = False
+                self.assistant_stats.generate_calls += 1
+                self.assistant_stats.new_tokens += output.shape[-1] - prompt_length
+                self.assistant_stats.decode_time += time.monotonic() - start_time
+                generated_ids.append(output[0][prompt_length:])
+
+        return generated_ids
+
+    def inference(self, image_paths: Optional[list[str]] = None, tag_store: Optional[TagStore] = None):
+        if image_paths is None:
+            image_paths = get_image_paths(logger=self.logger,path=Path(self.args['data_path']),recursive=self.args['recursive'])
+        run_caption_pipeline(self.logger, self.args, image_paths, llama=self, tag_store=tag_store)
+
+    def unload_assistant_model(self):
+        # Hooks of assistant stats are removed from LLM, and draft model is freed from GPU memory
+        if self.assistant_stats is not None:
+            self.assistant_stats.log(self.logger)
+            self.assistant_stats.remove()
+            self.assistant_stats = None
+        if self.assistant_model is not None:
+            self.logger.info(f'Unloading assistant model...')
+            start = time.monotonic()
+            del self.assistant_model
+            self.assistant_model = None
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+            self.logger.info(f'Assistant model unloaded in {time.monotonic() - start:.1f}s.')
 
     def unload_model(self) -> bool:
         image_adapter_unloaded = llm_unloaded = clip_model_unloaded = False
+        if self.repetition_stopped > 0:
+            self.logger.info(f'Repetition stopping: {self.repetition_stopped} caption(s) stopped early, '
+                             f'{self.repetition_tokens_saved} token(s) saved.')
+        if self.prefix_tokens_saved > 0:
+            self.logger.info(f'Prefix cache: {self.prefix_tokens_saved} prefill token(s) saved.')
+        self.unload_assistant_model()
         # Unload LLM
         if self.llm is not None:
             self.logger.info(f'Unloading LLM...')
@@ -325,17 +969,29 @@ class Joy:
             image_adapter_path: Path,
             clip_path: Path,
             llm_path: Path,
+            assistant_path: Optional[Path] = None,
     ):
         self.logger = logger
         self.args = args
         self.image_adapter_path = image_adapter_path
         self.clip_path = clip_path
         self.llm_path = llm_path
+        self.assistant_path = assistant_path
         self.image_adapter = None
         self.clip_processor = None
         self.clip_model = None
         self.llm_tokenizer = None
         self.llm = None
+        self.embedding_cache = None
+        self.embedding_model_id = None
+        self.assistant_model = None
+        self.assistant_stats = None
+        self.repetition_ngram = int(self.args.get('llm_repetition_ngram', 0))
+        self.repetition_stopped = 0
+        self.repetition_tokens_saved = 0
+        self.compiled = False
+        self.static_cache = None
+        self.compile_bucket_size = max(int(self.args.get('llm_compile_bucket_size', 64)), 1)
 
     def load_model(self):
         if not os.path.exists(self.image_adapter_path):
@@ -363,6 +1019,9 @@ class Joy:
             self.logger.error(f'Import transformers Failed!\nDetails: {ie}')
             raise ImportError
 
+        if self.args['llm_use_cpu']:
+            set_cpu_threads(self.logger, self.args)
+
         class ImageAdapter(nn.Module):
             def __init__(self, input_features: int, output_features: int):
                 super().__init__()
@@ -394,10 +1053,15 @@ class Joy:
         assert (isinstance(self.llm_tokenizer, PreTrainedTokenizer) or
                 isinstance(self.llm_tokenizer, PreTrainedTokenizerFast)), \
             f"Tokenizer is of type {type(self.llm_tokenizer)}"
-        llm_dtype = torch.float32 if self.args['llm_use_cpu'] else torch.float16 \
+        llm_dtype = get_cpu_llm_dtype(self.logger, self.args) if self.args['llm_use_cpu'] else torch.float16 \
             if self.args['llm_dtype'] == "fp16" else torch.bfloat16
         self.logger.info(f'Joy LLM dtype: {llm_dtype}')
-        if self.args['llm_qnt'] == "4bit":
+        if self.args['llm_use_cpu']:
+            if self.args['llm_qnt'] != "none":
+                self.logger.warning(f'bitsandbytes {self.args["llm_qnt"]} quantization needs GPU, ignored on CPU. '
+                                    f'Set llm_cpu_dtype to "int8" or "bf16" instead.')
+            qnt_config = None
+        elif self.args['llm_qnt'] == "4bit":
             qnt_config = BitsAndBytesConfig(load_in_4bit=True,
                                             bnb_4bit_quant_type="nf4",
                                             llm_int8_enable_fp32_cpu_offload=True,
@@ -411,11 +1075,23 @@ class Joy:
             self.logger.info(f'LLM 8bit quantization: Enabled')
         else:
             qnt_config = None
-        self.llm = AutoModelForCausalLM.from_pretrained(self.llm_path,
-                                                        device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
-                                                        low_cpu_mem_usage=True if not self.args['llm_use_cpu'] else False,
-                                                        torch_dtype=llm_dtype if self.args['llm_qnt'] == "none" else None,
-                                                        quantization_config=qnt_config)
+        prepared_dir = prepared_info = None
+        if self.args.get('llm_prepared_models', False):
+            prepared_dir, prepared_info = get_prepared_model_info(self.args, [self.llm_path, self.image_adapter_path])
+        use_prepared = prepared_dir is not None and is_prepared_model(self.logger, prepared_dir, prepared_info)
+        if use_prepared:
+            # Quantization config is saved with the prepared model, weights are memory mapped from safetensors
+            self.logger.info(f'Loading prepared LLM from {str(prepared_dir)}...')
+            self.llm = AutoModelForCausalLM.from_pretrained(prepared_dir,
+                                                            device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
+                                                            low_cpu_mem_usage=True,
+                                                            torch_dtype=llm_dtype if qnt_config is None else None)
+        else:
+            self.llm = AutoModelForCausalLM.from_pretrained(self.llm_path,
+                                                            device_map="cuda" if not self.args['llm_use_cpu'] else "cpu",
+                                                            low_cpu_mem_usage=True,
+                                                            torch_dtype=llm_dtype if qnt_config is None else None,
+                                                            quantization_config=qnt_config)
         self.llm.eval()
         self.logger.info(f'LLM Loaded in {time.monotonic() - start_time:.1f}s.')
 
@@ -423,18 +1099,149 @@ class Joy:
         self.logger.info(f'Loading Image Adapter with {"CPU" if self.args["llm_use_cpu"] else "GPU"}...')
         start_time = time.monotonic()
         self.image_adapter = ImageAdapter(self.clip_model.config.hidden_size, self.llm.config.hidden_size)
-        self.image_adapter.load_state_dict(torch.load(self.image_adapter_path, map_location="cpu"))
+        if use_prepared:
+            try:
+                from safetensors.torch import load_file
+            except ImportError as ie:
+                self.logger.error(f'Import safetensors Failed!\nDetails: {ie}')
+                raise ImportError
+            self.image_adapter.load_state_dict(load_file(prepared_dir / "image_adapter.safetensors"))
+        else:
+            self.image_adapter.load_state_dict(torch.load(self.image_adapter_path, map_location="cpu"))
         self.image_adapter.eval()
         self.image_adapter.to(device)
         self.logger.info(f'Image Adapter Loaded in {time.monotonic() - start_time:.1f}s.')
 
-    def get_caption(
+        if prepared_dir is not None and not use_prepared:
+            # Save quantized LLM and safetensors adapter once, later starts skip quantizing and unpickling
+            try:
+                from safetensors.torch import save_file
+                self.logger.info(f'Saving prepared LLM and Image Adapter to {str(prepared_dir)}...')
+                start_time = time.monotonic()
+                os.makedirs(prepared_dir, exist_ok=True)
+                self.llm.save_pretrained(prepared_dir, safe_serialization=True)
+                save_file({key: value.detach().cpu().contiguous() for key, value in self.image_adapter.state_dict().items()},
+                          prepared_dir / "image_adapter.safetensors")
+                save_prepared_info(prepared_dir, prepared_info)
+                self.logger.info(f'Prepared models saved in {time.monotonic() - start_time:.1f}s.')
+            except Exception as e:
+                self.logger.warning(f'Failed to save prepared models, will load original models next time.\n'
+                                    f'error info: {e}')
+        # Prepared models keep unquantized weights, dynamic int8 modules can't be saved by save_pretrained
+        self.llm = quantize_cpu_llm(self.logger, self.args, self.llm)
+
+        # Load assistant model
+        if self.assistant_path is not None:
+            self.assistant_model = load_assistant_model(self.logger, self.args, self.assistant_path)
+            self.assistant_stats = AssistantStats(self.llm, self.assistant_model)
+
+        # Load image embedding cache
+        if self.args.get('llm_embedding_cache', False):
+            cache_dir = self.args.get('llm_embedding_cache_dir', "")
+            if not cache_dir:
+                cache_dir = os.path.join(get_llm_models_dir(self.args), 'embedding_cache')
+            self.embedding_cache = EmbeddingCache(
+                logger=self.logger,
+                cache_dir=cache_dir,
+                max_size_mb=self.args.get('llm_embedding_cache_max_mb', 4096)
+            )
+            self.embedding_model_id = get_files_fingerprint([self.clip_path, self.image_adapter_path],
+                                                            extensions=(".safetensors", ".bin", ".pt"))
+
+        # Compile LLM with static KV cache
+        if self.args.get('llm_compile', False):
+            self.compile_model()
+
+    def compile_model(self):
+        # Import torch
+        try:
+            import torch
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
+
+        if self.assistant_model is not None:
+            self.logger.warning('llm_compile is not used with assisted generation, LLM will not be compiled.')
+            return
+
+        # Per token latency before compiling
+        eager_latency = self.measure_token_latency()
+
+        self.logger.info(f'Compiling LLM with static KV cache...')
+        start_time = time.monotonic()
+        # CUDA graphs cut launch overhead on GPU, CPU uses default inductor mode
+        self.llm.forward = torch.compile(self.llm.forward,
+                                         mode="reduce-overhead" if not self.args['llm_use_cpu'] else None,
+                                         dynamic=False)
+        self.compiled = True
+        # First runs compile prefill of the prompt bucket and decode step, later ones replay them
+        for _ in range(max(int(self.args.get('llm_compile_warmup', 2)), 1)):
+            self.measure_token_latency()
+        self.logger.info(f'LLM compiled and warmed up in {time.monotonic() - start_time:.1f}s.')
+
+        compiled_latency = self.measure_token_latency()
+        if eager_latency and compiled_latency:
+            self.logger.info(f'LLM per token latency: {eager_latency * 1000:.1f}ms before compile, '
+                             f'{compiled_latency * 1000:.1f}ms after compile.')
+
+    def measure_token_latency(self) -> Optional[float]:
+        # Caption a blank image with configured prompt, time from first to last LLM forward.
+        # The blank image isn't a real caption, it's kept out of embedding cache, repetition stats and metrics.
+        embedding_cache = self.embedding_cache
+        repetition_stats = (self.repetition_stopped, self.repetition_tokens_saved)
+        self.embedding_cache = None
+        forward_times = []
+        hook = self.llm.register_forward_hook(lambda module, inputs, outputs: forward_times.append(time.monotonic()))
+        pre_hook = self.llm.register_forward_pre_hook(
+            lambda module, inputs: forward_times.append(time.monotonic()) if not forward_times else None)
+        try:
+            image_size = int(self.args.get('image_size', 1024))
+            with METRICS.suspend():
+                self.get_captions(
+                    image=Image.new("RGB", (image_size, image_size), "WHITE"),
+                    user_prompts=[str(self.args['llm_user_prompt'] or DEFAULT_USER_PROMPT_WITHOUT_WD)],
+                    temperature=self.args['llm_temperature'],
+                    max_new_tokens=self.args['llm_max_tokens']
+                )
+        finally:
+            hook.remove()
+            pre_hook.remove()
+            self.embedding_cache = embedding_cache
+            self.repetition_stopped, self.repetition_tokens_saved = repetition_stats
+        # First entry is the start of prefill, others are ends of each forward
+        if len(forward_times) < 2:
+            return None
+        return (forward_times[-1] - forward_times[0]) / (len(forward_times) - 1)
+
+    def get_static_cache(
+            self,
+            batch_size: int,
+            max_cache_len: int,
+    ):
+        # Import transformers
+        try:
+            from transformers import StaticCache
+        except ImportError as ie:
+            self.logger.error(f'Import transformers Failed!\nDetails: {ie}')
+            raise ImportError
+
+        # Cache only grows, so shapes seen by the compiled graph stay the same
+        if self.static_cache is None or self.static_cache.batch_size != batch_size \
+                or self.static_cache.max_cache_len < max_cache_len:
+            self.logger.debug(f'New static KV cache for batch size {batch_size}, length {max_cache_len}.')
+            self.static_cache = StaticCache(config=self.llm.config,
+                                            batch_size=batch_size,
+                                            max_cache_len=max_cache_len,
+                                            device=self.llm.device,
+                                            dtype=self.llm.dtype)
+        else:
+            self.static_cache.reset()
+        return self.static_cache
+
+    def get_image_embeddings(
             self,
             image: Image.Image,
-            user_prompt: str,
-            temperature: float = 0.5,
-            max_new_tokens: int = 300,
-    ) -> str:
+    ):
         # Import torch
         try:
             import torch
@@ -443,47 +1250,118 @@ class Joy:
             self.logger.error(f'Import torch Failed!\nDetails: {ie}')
             raise ImportError
         device = "cpu" if self.args['llm_use_cpu'] else "cuda"
-        # Cleaning VRAM cache
-        if not self.args['llm_use_cpu']:
-            self.logger.info(f'Will empty cuda device cache...')
-            torch.cuda.empty_cache()
+
+        embedding_key = None
+        if self.embedding_cache is not None:
+            # Key on the resized pixels, so image content and image_size both change it
+            key_hash = hashlib.sha256()
+            key_hash.update(self.embedding_model_id.encode("utf-8"))
+            key_hash.update(f'{self.args["image_size"]}:{image.mode}:{image.size}'.encode("utf-8"))
+            key_hash.update(image.tobytes())
+            embedding_key = key_hash.hexdigest()
+            embedded_images = self.embedding_cache.get(embedding_key)
+            if embedded_images is not None:
+                self.logger.debug(f'Image embedding cache hit: {embedding_key}')
+                return embedded_images.to(device)
+
         # Preprocess image
         image = self.clip_processor(images=image, return_tensors='pt').pixel_values
         image = image.to(device)
-        # Tokenize the prompt
-        self.logger.debug(f'Using user prompt:{user_prompt}')
-        prompt = self.llm_tokenizer.encode(user_prompt,
-                                           return_tensors='pt',
-                                           padding=False,
-                                           truncation=False,
-                                           add_special_tokens=False)
         # Embed image
         with torch.amp.autocast_mode.autocast(device, enabled=True):
             vision_outputs = self.clip_model(pixel_values=image, output_hidden_states=True)
             image_features = vision_outputs.hidden_states[-2]
             embedded_images = self.image_adapter(image_features)
             embedded_images = embedded_images.to(device)
-        # Embed prompt
-        prompt_embeds = self.llm.model.embed_tokens(prompt.to(device))
-        assert prompt_embeds.shape == (1, prompt.shape[1],
-                                       self.llm.config.hidden_size), \
-            f"Prompt shape is {prompt_embeds.shape}, expected {(1, prompt.shape[1], self.llm.config.hidden_size)}"
+
+        if self.embedding_cache is not None:
+            # Use the same fp16 values a cache hit would return
+            embedded_images = embedded_images.to(torch.float16)
+            self.embedding_cache.put(embedding_key, embedded_images)
+        return embedded_images
+
+    def get_caption(
+            self,
+            image: Image.Image,
+            user_prompt: str,
+            temperature: float = 0.5,
+            max_new_tokens: int = 300,
+    ) -> str:
+        return self.get_captions(
+            image=image,
+            user_prompts=[user_prompt],
+            temperature=temperature,
+            max_new_tokens=max_new_tokens
+        )[0][0]
+
+    def get_captions(
+            self,
+            image: Image.Image,
+            user_prompts: list[str],
+            temperature: float = 0.5,
+            max_new_tokens: int = 300,
+            num_samples: int = 1,
+    ) -> list[list[str]]:
+        # Import torch
+        try:
+            import torch
+            import torch.amp.autocast_mode
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
+        device = "cpu" if self.args['llm_use_cpu'] else "cuda"
+        # Cleaning VRAM cache
+        if not self.args['llm_use_cpu']:
+            self.logger.info(f'Will empty cuda device cache...')
+            torch.cuda.empty_cache()
+        # Embed image once, every prompt and sample shares it
+        start_time = time.monotonic()
+        embedded_images = self.get_image_embeddings(image)
+        METRICS.observe("llm_image_embedding", time.monotonic() - start_time)
         embedded_bos = self.llm.model.embed_tokens(torch.tensor([[self.llm_tokenizer.bos_token_id]],
                                                                 device=self.llm.device,
                                                                 dtype=torch.int64))
-        # Construct prompts
-        inputs_embeds = torch.cat([
-            embedded_bos.expand(embedded_images.shape[0], -1, -1),
-            embedded_images.to(dtype=embedded_bos.dtype),
-            prompt_embeds.expand(embedded_images.shape[0], -1, -1),
-        ], dim=1)
-
-        input_ids = torch.cat([
-            torch.tensor([[self.llm_tokenizer.bos_token_id]], dtype=torch.long),
-            torch.zeros((1, embedded_images.shape[1]), dtype=torch.long),
-            prompt,
-        ], dim=1).to(device)
-        attention_mask = torch.ones_like(input_ids)
+        rows_embeds = []
+        rows_input_ids = []
+        for user_prompt in user_prompts:
+            # Tokenize the prompt
+            self.logger.debug(f'Using user prompt:{user_prompt}')
+            prompt = self.llm_tokenizer.encode(user_prompt,
+                                               return_tensors='pt',
+                                               padding=False,
+                                               truncation=False,
+                                               add_special_tokens=False)
+            # Embed prompt
+            prompt_embeds = self.llm.model.embed_tokens(prompt.to(device))
+            assert prompt_embeds.shape == (1, prompt.shape[1],
+                                           self.llm.config.hidden_size), \
+                f"Prompt shape is {prompt_embeds.shape}, expected {(1, prompt.shape[1], self.llm.config.hidden_size)}"
+            # Construct prompts
+            rows_embeds.append(torch.cat([
+                embedded_bos.expand(embedded_images.shape[0], -1, -1),
+                embedded_images.to(dtype=embedded_bos.dtype),
+                prompt_embeds.expand(embedded_images.shape[0], -1, -1),
+            ], dim=1))
+            rows_input_ids.append(torch.cat([
+                torch.tensor([[self.llm_tokenizer.bos_token_id]], dtype=torch.long),
+                torch.zeros((1, embedded_images.shape[1]), dtype=torch.long),
+                prompt,
+            ], dim=1).to(device))
+
+        # Left pad prompts of different length into one batch
+        pad_token_id = self.llm_tokenizer.pad_token_id \
+            if self.llm_tokenizer.pad_token_id is not None else self.llm_tokenizer.eos_token_id
+        max_length = max(row.shape[1] for row in rows_input_ids)
+        if self.compiled:
+            # Pad to a bucket of prompt lengths, so compiled graphs are only built once per bucket
+            max_length = -(-max_length // self.compile_bucket_size) * self.compile_bucket_size
+        inputs_embeds = torch.cat([torch.nn.functional.pad(row, (0, 0, max_length - row.shape[1], 0), value=0)
+                                   for row in rows_embeds], dim=0)
+        input_ids = torch.cat([torch.nn.functional.pad(row, (max_length - row.shape[1], 0), value=pad_token_id)
+                               for row in rows_input_ids], dim=0)
+        attention_mask = torch.cat([torch.nn.functional.pad(torch.ones_like(row), (max_length - row.shape[1], 0),
+                                                            value=0)
+                                    for row in rows_input_ids], dim=0)
         # Generate caption
         self.logger.debug(f'LLM temperature is {temperature}')
         self.logger.debug(f'LLM max_new_tokens is {max_new_tokens}')
@@ -491,122 +1369,158 @@ class Joy:
         #     self.llm_tokenizer.eos_token_id,
         #     self.llm_tokenizer.convert_tokens_to_ids("<|eot_id|>")
         # ]
-        generate_ids = self.llm.generate(input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask,
-                                         max_new_tokens=max_new_tokens,
-                                         # eos_token_id=terminators,
-                                         do_sample=True, top_k=10,
-                                         temperature=temperature, suppress_tokens=None)
-        # Trim off the prompt
-        generate_ids = generate_ids[:, input_ids.shape[1]:]
-        if generate_ids[0][-1] == self.llm_tokenizer.eos_token_id:
-            generate_ids = generate_ids[:, :-1]
-
-        content = self.llm_tokenizer.batch_decode(generate_ids,
-                                                  skip_special_tokens=False,
-                                                  clean_up_tokenization_spaces=False)[0]
-        content = content.strip()
-        self.logger.debug(f'Joy Output:\n{content}')
-        content_list = str(content).split(".")
-        unique_content = list(dict.fromkeys(content_list))
-        unique_content = '.'.join(unique_content)
-        return unique_content
-
-    def inference(self):
-        image_paths = get_image_paths(logger=self.logger,path=Path(self.args['data_path']),recursive=self.args['recursive'])
-        pbar = tqdm(total=len(image_paths), smoothing=0.0)
-        for image_path in image_paths:
+        start_time = time.monotonic()
+        generate_ids = None
+        if self.assistant_model is not None:
             try:
-                pbar.set_description('Processing: {}'.format(image_path if len(image_path) <= 40 else
-                                                             image_path[:15]) + ' ... ' + image_path[-20:])
-                joy_caption_file = get_caption_file_path(
-                    self.logger,
-                    data_path=self.args['data_path'],
-                    image_path=Path(image_path),
-                    custom_caption_save_path=self.args['custom_caption_save_path'],
-                    caption_extension=self.args['llm_caption_extension']
-                )
-                # Skip exists
-                if self.args['llm_file_action'] == "skip" and os.path.isfile(joy_caption_file):
-                    self.logger.warning(f'llm_file_action is set to skip!!!'
-                                        f'LLM Caption file {joy_caption_file} already exists, Skip this caption.')
-                    continue
-                # Image process
-                image = Image.open(image_path)
-                image = image_process(image, int(self.args['image_size']))
-                self.logger.debug(f"Resized image shape: {image.shape}")
-                image = image_process_image(image)
-                # Change user prompt
-                if (self.args['caption_method'] == "wd+joy"
-                    and not self.args['llm_caption_without_wd']
-                    and self.args['run_method'] == "queue") or (self.args['caption_method'] == "joy"
-                                                             and self.args['llm_read_wd_caption']):
-                    wd_caption_file = get_caption_file_path(
-                        self.logger,
-                        data_path=self.args["data_path"],
-                        image_path=Path(image_path),
-                        custom_caption_save_path=self.args["custom_caption_save_path"],
-                        caption_extension=self.args["wd_caption_extension"]
-                    )
-                    if os.path.isfile(wd_caption_file):
-                        self.logger.debug(f'Loading WD caption file: {wd_caption_file}')
-                        with open(wd_caption_file, "r", encoding="utf-8") as wcf:
-                            tag_text = wcf.read()
-                        user_prompt = str(f'{self.args["llm_user_prompt"]}{tag_text}\n')
-                    else:
-                        self.logger.warning(f'WD caption file: {wd_caption_file} NOT FOUND!!! '
-                                            f'Inference without WD tags.')
-                        user_prompt = DEFAULT_USER_PROMPT_WITHOUT_WD
-                else:
-                    user_prompt = str(f'{self.args["llm_user_prompt"]}\n')
-
-                caption = self.get_caption(
-                    image=image,
-                    user_prompt=user_prompt,
-                    temperature=self.args["llm_temperature"],
-                    max_new_tokens=self.args["llm_max_tokens"]
+                generate_ids = self.generate_with_assistant(
+                    rows_embeds=rows_embeds,
+                    rows_input_ids=rows_input_ids,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    num_samples=num_samples
                 )
-                caption = caption.replace('\n', '')
-
-                if self.args['llm_file_action'] == "overwrite":
-                    with open(joy_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.warning(f'llm_file_action is set to overwrite!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {joy_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "prepend":
-                    with open(joy_caption_file, "rt", encoding="utf-8") as f:
-                        existing_content = f.read()
-                    with open(joy_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption + existing_content)
-                        self.logger.warning(f'llm_file_action is set to prepend!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {joy_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "append":
-                    with open(joy_caption_file, "at", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.warning(f'llm_file_action is set to append!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {joy_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-                elif self.args['llm_file_action'] == "skip" and not os.path.isfile(joy_caption_file):
-                    with open(joy_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(caption)
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"LLM Caption path: {joy_caption_file}")
-                        self.logger.debug(f"LLM Caption content: {caption}")
-
             except Exception as e:
-                self.logger.error(f"Failed to caption image: {image_path}, skip it.\nerror info: {e}")
-                continue
+                self.logger.warning(f'Assisted generation failed, will generate without assistant model.\n'
+                                    f'error info: {e}')
+                self.unload_assistant_model()
+
+        if generate_ids is None:
+            generate_ids = self.llm.generate(input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                             past_key_values=self.get_static_cache(
+                                                 input_ids.shape[0] * num_samples,
+                                                 max_length + max_new_tokens
+                                             ) if self.compiled else None,
+                                             max_new_tokens=max_new_tokens,
+                                             # eos_token_id=terminators,
+                                             do_sample=True, top_k=10,
+                                             temperature=temperature, suppress_tokens=None,
+                                             stopping_criteria=get_stopping_criteria(self.logger, input_ids.shape[1],
+                                                                                     self.repetition_ngram),
+                                             num_return_sequences=num_samples)
+            # Trim off the prompt
+            generate_ids = generate_ids[:, input_ids.shape[1]:].tolist()
+        METRICS.observe("llm_inference", time.monotonic() - start_time)
+        METRICS.count("llm_prompt_tokens", int(attention_mask.sum()))
 
-            pbar.update(1)
+        start_time = time.monotonic()
+        captions = []
+        for row_ids in generate_ids:
+            # Finished rows are padded after their eos token
+            if self.llm_tokenizer.eos_token_id in row_ids:
+                row_ids = row_ids[:row_ids.index(self.llm_tokenizer.eos_token_id)]
+            generated_length = len(row_ids)
+            METRICS.count("llm_generated_tokens", generated_length)
+            trimmed_ids, repetition_end = trim_repetition(row_ids, self.repetition_ngram)
+            # Only rows stopped by the repetition criteria are trimmed, rows ended by eos are left as they are
+            if repetition_end == generated_length - 1:
+                row_ids = trimmed_ids
+                self.repetition_stopped += 1
+                self.repetition_tokens_saved += max_new_tokens - generated_length
+            content = self.llm_tokenizer.decode(row_ids,
+                                                skip_special_tokens=False,
+                                                clean_up_tokenization_spaces=False)
+            content = content.strip()
+            self.logger.debug(f'Joy Output:\n{content}')
+            content_list = str(content).split(".")
+            unique_content = list(dict.fromkeys(content_list))
+            unique_content = '.'.join(unique_content)
+            captions.append(unique_content)
+        METRICS.observe("llm_postprocess", time.monotonic() - start_time)
+        # One list of samples per prompt
+        return [captions[i * num_samples:(i + 1) * num_samples] for i in range(len(user_prompts))]
+
+    def generate_with_assistant(
+            self,
+            rows_embeds: list,
+            rows_input_ids: list,
+            temperature: float = 0.5,
+            max_new_tokens: int = 300,
+            num_samples: int = 1,
+    ) -> list[list[int]]:
+        # Import torch
+        try:
+            import torch
+            from transformers import DynamicCache
+        except ImportError as ie:
+            self.logger.error(f'Import torch Failed!\nDetails: {ie}')
+            raise ImportError
 
-        pbar.close()
+        # transformers only supports assisted generation for one sequence at a time
+        generate_ids = []
+        for row_embeds, row_input_ids in zip(rows_embeds, rows_input_ids):
+            prompt_length = row_input_ids.shape[1]
+            # Assisted generation can't start from `inputs_embeds`, so prefill the image embeddings and
+            # all but the last prompt token here, then continue from token ids.
+            # The draft model sees the placeholder ids of the image, not the image itself.
+            prompt_cache = DynamicCache()
+            with torch.no_grad():
+                self.llm(inputs_embeds=row_embeds[:, :-1],
+                         attention_mask=torch.ones_like(row_input_ids[:, :-1]),
+                         past_key_values=prompt_cache,
+                         use_cache=True,
+                         num_logits_to_keep=1)
+
+            for _ in range(num_samples):
+                start_time = time.monotonic()
+                self.assistant_stats.counting = True
+                try:
+                    output = self.llm.generate(row_input_ids,
+                                               attention_mask=torch.ones_like(row_input_ids),
+                                               past_key_values=copy.deepcopy(prompt_cache),
+                                               assistant_model=self.assistant_model,
+                                               max_new_tokens=max_new_tokens,
+                                               # eos_token_id=terminators,
+                                               do_sample=True, top_k=10,
+                                               temperature=temperature, suppress_tokens=None,
+                                               stopping_criteria=get_stopping_criteria(self.logger, prompt_length,
+                                                                                       self.repetition_ngram))
+                finally:
+                    self.assistant_stats.counting = False
+                self.assistant_stats.generate_calls += 1
+                self.assistant_stats.new_tokens += output.shape[-1] - prompt_length
+                self.assistant_stats.decode_time += time.monotonic() - start_time
+                generate_ids.append(output[0][prompt_length:].tolist())
+
+        return generate_ids
+
+    def inference(self, image_paths: Optional[list[str]] = None, tag_store: Optional[TagStore] = None):
+        if image_paths is None:
+            image_paths = get_image_paths(logger=self.logger,path=Path(self.args['data_path']),recursive=self.args['recursive'])
+        run_caption_pipeline(self.logger, self.args, image_paths, joy=self, tag_store=tag_store)
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
+
+    def unload_assistant_model(self):
+        # Hooks of assistant stats are removed from LLM, and draft model is freed from GPU memory
+        if self.assistant_stats is not None:
+            self.assistant_stats.log(self.logger)
+            self.assistant_stats.remove()
+            self.assistant_stats = None
+        if self.assistant_model is not None:
+            self.logger.info(f'Unloading assistant model...')
+            start = time.monotonic()
+            del self.assistant_model
+            self.assistant_model = None
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+            self.logger.info(f'Assistant model unloaded in {time.monotonic() - start:.1f}s.')
 
     def unload_model(self) -> bool:
         image_adapter_unloaded = llm_unloaded = clip_model_unloaded = False
+        # Write pending image embeddings
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+            self.embedding_cache = None
+        if self.repetition_stopped > 0:
+            self.logger.info(f'Repetition stopping: {self.repetition_stopped} caption(s) stopped early, '
+                             f'{self.repetition_tokens_saved} token(s) saved.')
+        self.unload_assistant_model()
         # Unload Image Adapter
         if self.image_adapter is not None:
             self.logger.info(f'Unloading Image Adapter...')
@@ -633,6 +1547,18 @@ class Joy:
 
         return image_adapter_unloaded and llm_unloaded and clip_model_unloaded
 
+# Providers tried by autotune besides CPU, in the order load_model prefers them
+WD_GPU_PROVIDERS = ["CUDAExecutionProvider", "ROCMExecutionProvider", "OpenVINOExecutionProvider"]
+WD_PROVIDER_OPTIONS = {"OpenVINOExecutionProvider": {'device_type': "GPU_FP32"}}
+# Autotuned settings are saved beside the model, keyed by host
+WD_AUTOTUNE_FILE = "autotune.json"
+WD_AUTOTUNE_BATCH_SIZES = [1, 2, 4, 8, 16]
+# Untimed runs of each setting, then timed runs until both minimums are reached
+WD_AUTOTUNE_WARMUP_RUNS = 2
+WD_AUTOTUNE_MIN_RUNS = 3
+WD_AUTOTUNE_MIN_TIME = 1.0
+
+
 class Tagger:
     def __init__(
             self,
@@ -648,11 +1574,14 @@ class Tagger:
         self.model_path = model_path
         self.tags_csv_path = tags_csv_path
         self.model_shape_size = None
+        # Images per session call, from `wd_batch_size` or autotune
+        self.batch_size = max(int(self.args.get('wd_batch_size', 1)), 1)
 
         self.tag_freq = {}
         self.rating_tags = None
         self.character_tags = None
         self.general_tags = None
+        self.tag_index = None
 
     def load_model(self):
         if not os.path.exists(self.model_path):
@@ -690,14 +1619,35 @@ class Tagger:
                 self.args['wd_force_use_cpu'] = True
             providers = (['CPUExecutionProvider'])
 
+        threads = 0
+        if self.args.get('wd_autotune', False):
+            tuned = self.autotune(ort, [provider for provider in WD_GPU_PROVIDERS
+                                        if provider in ort.get_available_providers()
+                                        and not self.args['wd_force_use_cpu']] + ['CPUExecutionProvider'])
+            providers = [tuned["provider"]]
+            provider_options = [WD_PROVIDER_OPTIONS[tuned["provider"]]] \
+                if tuned["provider"] in WD_PROVIDER_OPTIONS else None
+            threads = tuned["threads"]
+            self.batch_size = tuned["batch_size"]
+            self.args['wd_force_use_cpu'] = tuned["provider"] == 'CPUExecutionProvider'
+
         self.logger.info(f'Loading {self.args["wd_model_name"]} with {"CPU" if self.args["wd_force_use_cpu"] else "GPU"}...')
         start_time = time.monotonic()
 
+        sess_options = ort.SessionOptions()
+        if threads > 0:
+            sess_options.intra_op_num_threads = threads
+        if PROFILER.enabled:
+            sess_options.enable_profiling = True
+            sess_options.profile_file_prefix = PROFILER.onnx_prefix("wd")
         self.ort_infer_sess = ort.InferenceSession(
             self.model_path,
+            sess_options=sess_options,
             providers=providers,
             provider_options=provider_options
         )
+        if PROFILER.enabled:
+            PROFILER.add_onnx_session("wd", self.ort_infer_sess)
         self.logger.info(f'{self.args["wd_model_name"]} Loaded in {time.monotonic() - start_time:.1f}s.')
         self.model_shape_size = self.ort_infer_sess.get_inputs()[0].shape[1]
         self.logger.debug(f'"{self.args["wd_model_name"]}" target shape is {self.model_shape_size}')
@@ -788,10 +1738,137 @@ class Tagger:
         self.character_tags = character_tags
         self.general_tags = general_tags
 
+        if self.args.get("wd_tag_index", False):
+            # Tag ids and probabilities of every image are written to posting lists for tag_query.py
+            tag_index_dir = self.args.get("wd_tag_index_dir", "") or os.path.join(self.args["data_path"], "tag_index")
+            self.tag_index = TagIndex(self.logger, tag_index_dir)
+            self.tag_index.set_tags([{"id": row[0], "name": row[1], "category": row[2]} for row in rows])
+
+    def autotune(
+            self,
+            ort,
+            providers: list[str]
+    ) -> dict:
+        # Images per second of every provider, CPU thread count and batch size on random images.
+        # The fastest setting is saved per model and host, later loads reuse it without tuning again.
+        autotune_file = Path(os.path.dirname(self.model_path)) / WD_AUTOTUNE_FILE
+        host = (f'{platform.node()}|{platform.machine()}|{os.cpu_count()} cpus|'
+                f'onnxruntime {ort.__version__}|{",".join(providers)}')
+        model_fingerprint = get_files_fingerprint([self.model_path])
+        try:
+            with open(autotune_file, "rt", encoding="utf-8") as f:
+                autotune_results = json.load(f)
+        except (OSError, ValueError):
+            autotune_results = {}
+        tuned = autotune_results.get(host)
+        if tuned is not None and tuned.get("model") == model_fingerprint:
+            self.logger.info(f'Using autotuned {tuned["provider"]}, {tuned["threads"] or "default"} thread(s), '
+                             f'batch size {tuned["batch_size"]} from {str(autotune_file)}')
+            return tuned
+
+        self.logger.info(f'Autotuning {self.args["wd_model_name"]} on {", ".join(providers)}, '
+                         f'this only runs once on this host...')
+        start_time = time.monotonic()
+        cpu_count = os.cpu_count() or 1
+        candidates = []
+        for provider in providers:
+            # Thread count only matters on CPU, 0 is onnxruntime default
+            thread_counts = sorted(set([max(cpu_count // 4, 1), max(cpu_count // 2, 1), cpu_count])) \
+                if provider == 'CPUExecutionProvider' else [0]
+            for threads in thread_counts:
+                sess_options = ort.SessionOptions()
+                if threads > 0:
+                    sess_options.intra_op_num_threads = threads
+                try:
+                    session = ort.InferenceSession(
+                        self.model_path,
+                        sess_options=sess_options,
+                        providers=[provider],
+                        provider_options=[WD_PROVIDER_OPTIONS[provider]] if provider in WD_PROVIDER_OPTIONS else None
+                    )
+                except Exception as e:
+                    self.logger.warning(f'Failed to load {self.args["wd_model_name"]} with {provider}, skip it.\n'
+                                        f'error info: {e}')
+                    break
+                model_input = session.get_inputs()[0]
+                label_name = session.get_outputs()[0].name
+                shape_size = model_input.shape[1]
+                # Models with a fixed batch dimension only run their own batch size
+                batch_sizes = [model_input.shape[0]] if isinstance(model_input.shape[0], int) \
+                    else WD_AUTOTUNE_BATCH_SIZES
+                images = numpy.random.default_rng(0).uniform(
+                    0, 255, (max(batch_sizes), shape_size, shape_size, 3)).astype(numpy.float32)
+                best_speed = 0.0
+                for batch_size in batch_sizes:
+                    batch = images[:batch_size]
+                    try:
+                        for _ in range(WD_AUTOTUNE_WARMUP_RUNS):
+                            session.run([label_name], {model_input.name: batch})
+                        runs = 0
+                        run_start = time.monotonic()
+                        while runs < WD_AUTOTUNE_MIN_RUNS or time.monotonic() - run_start < WD_AUTOTUNE_MIN_TIME:
+                            session.run([label_name], {model_input.name: batch})
+                            runs += 1
+                        speed = batch_size * runs / (time.monotonic() - run_start)
+                    except Exception as e:
+                        self.logger.warning(f'Failed to run {provider} with batch size {batch_size}, skip it.\n'
+                                            f'error info: {e}')
+                        break
+                    self.logger.info(f'Autotune {provider}, {threads or "default"} thread(s), '
+                                     f'batch size {batch_size}: {speed:.2f} images/s')
+                    candidates.append({"provider": provider, "threads": threads, "batch_size": batch_size,
+                                       "images_per_second": speed})
+                    # Larger batches won't get faster again once they are slower
+                    if speed < best_speed:
+                        break
+                    best_speed = speed
+                del session
+        if not candidates:
+            self.logger.error(f'Autotune failed, {self.args["wd_model_name"]} can\'t run on {", ".join(providers)}!')
+            raise RuntimeError
+
+        tuned = max(candidates, key=lambda candidate: candidate["images_per_second"])
+        tuned["model"] = model_fingerprint
+        self.logger.info(f'Autotuned in {time.monotonic() - start_time:.1f}s, using {tuned["provider"]}, '
+                         f'{tuned["threads"] or "default"} thread(s), batch size {tuned["batch_size"]} '
+                         f'({tuned["images_per_second"]:.2f} images/s).')
+        autotune_results[host] = tuned
+        try:
+            with open(autotune_file, "wt", encoding="utf-8") as f:
+                json.dump(autotune_results, f, indent=4)
+        except OSError as e:
+            self.logger.warning(f'Failed to save autotune result to {str(autotune_file)}.\nerror info: {e}')
+        return tuned
+
     def get_tags(
             self,
-            image:numpy.ndarray
+            image:numpy.ndarray,
+            image_path: Optional[str] = None
     ) -> tuple[str, str, str, str]:
+        return self.get_tags_batch([image], [image_path])[0]
+
+    def get_tags_batch(
+            self,
+            images: list[numpy.ndarray],
+            image_paths: Optional[list[Optional[str]]] = None
+    ) -> list[tuple[str, str, str, str]]:
+        # Images are run in one session call, `batch_size` of them with autotune
+        input_name = self.ort_infer_sess.get_inputs()[0].name
+        label_name = self.ort_infer_sess.get_outputs()[0].name
+        start_time = time.monotonic()
+        probs = self.ort_infer_sess.run([label_name], {input_name: numpy.stack(images)})[0]  # onnx output numpy
+        METRICS.observe("wd_inference", time.monotonic() - start_time)
+        image_paths = image_paths if image_paths is not None else [None] * len(images)
+        return [self.get_tags_from_prob(prob, image_path) for prob, image_path in zip(probs, image_paths)]
+
+    def get_tags_from_prob(
+            self,
+            prob: numpy.ndarray,
+            image_path: Optional[str] = None
+    ) -> tuple[str, str, str, str]:
+        start_time = time.monotonic()
+        if self.tag_index is not None and image_path is not None:
+            self.tag_index.add(image_path, prob, float(self.args.get("wd_tag_index_min_prob", 0.1)))
 
         rating_tags = self.rating_tags
         character_tags = self.character_tags
@@ -805,12 +1882,6 @@ class Tagger:
         always_first_tags = [tag for tag in self.args["wd_always_first_tags"].split(stripped_caption_separator)
                              if tag.strip() != ""] if self.args["wd_always_first_tags"] is not False else None
 
-        input_name = self.ort_infer_sess.get_inputs()[0].name
-        label_name = self.ort_infer_sess.get_outputs()[0].name
-        image = numpy.array([image])
-        prob = self.ort_infer_sess.run([label_name], {input_name: image})[0]  # onnx output numpy
-        prob = prob[:len([image])][0]
-
         # def mcut_threshold(probs):
         #     """
         #     Maximum Cut Thresholding (MCut)
@@ -929,80 +2000,24 @@ class Tagger:
 
         tag_text = caption_separator.join(combined_tags)
 
+        METRICS.observe("wd_postprocess", time.monotonic() - start_time)
         return tag_text, rating_tag_text, character_tag_text, general_tag_text
 
 
-    def inference(self):
-        image_paths = get_image_paths(logger=self.logger,path=Path(self.args["data_path"]),recursive=self.args["recursive"])
-        pbar = tqdm(total=len(image_paths), smoothing=0.0)
-        for image_path in image_paths:
-            try:
-                pbar.set_description('Processing: {}'.format(image_path if len(image_path) <= 40 else
-                                                             image_path[:15]) + ' ... ' + image_path[-20:])
-
-                wd_caption_file = get_caption_file_path(
-                    self.logger,
-                    data_path=self.args["data_path"],
-                    image_path=Path(image_path),
-                    custom_caption_save_path=self.args["custom_caption_save_path"],
-                    caption_extension=self.args["wd_caption_extension"]
-                )
-                # Skip exists
-                if self.args['wd_file_action'] == "skip" and os.path.isfile(wd_caption_file):
-                    self.logger.warning(f'wd_file_action is set to skip!!!'
-                                        f'WD Caption file {wd_caption_file} already exists, Skip this caption.')
-                    continue
-                # Image process
-                image = Image.open(image_path)
-                image = image_process(image, self.model_shape_size)
-                self.logger.debug(f"Resized image shape: {image.shape}")
-                image = image_process_gbr(image)
-                # Get tags
-                tag_text, rating_tag_text, character_tag_text, general_tag_text = self.get_tags(
-                    image=image
-                )
-
-                if self.args['wd_file_action'] == "overwrite":
-                    with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(tag_text)
-                        self.logger.warning(f'wd_file_action is set to overwrite!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"WD Caption path: {wd_caption_file}")
-                        self.logger.debug(f"WD Caption content: {tag_text}")
-                elif self.args['wd_file_action'] == "prepend":
-                    with open(wd_caption_file, "rt", encoding="utf-8") as f:
-                        existing_content = f.read()
-                    with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(tag_text + existing_content)
-                        self.logger.warning(f'wd_file_action is set to prepend!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"WD Caption path: {wd_caption_file}")
-                        self.logger.debug(f"WD Caption content: {tag_text}")
-                elif self.args['wd_file_action'] == "append":
-                    with open(wd_caption_file, "at", encoding="utf-8") as f:
-                        f.write(tag_text)
-                        self.logger.warning(f'wd_file_action is set to append!!!')
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"WD Caption path: {wd_caption_file}")
-                        self.logger.debug(f"WD Caption content: {tag_text}")
-                elif self.args['wd_file_action'] == "skip" and not os.path.isfile(wd_caption_file):
-                    with open(wd_caption_file, "wt", encoding="utf-8") as f:
-                        f.write(tag_text)
-                        self.logger.debug(f"Image path: {image_path}")
-                        self.logger.debug(f"WD Caption path: {wd_caption_file}")
-                        self.logger.debug(f"WD Caption content: {tag_text}")
-                if self.args['wd_model_name'].lower().startswith("wd"):
-                    self.logger.debug(f"WD Rating tags: {rating_tag_text}")
-                    self.logger.debug(f"WD Character tags: {character_tag_text}")
-                self.logger.debug(f"WD General tags: {general_tag_text}")
-
-            except Exception as e:
-                self.logger.error(f"Failed to caption image: {image_path}, skip it.\nerror info: {e}")
-                continue
+    def inference(
+            self,
+            image_paths: Optional[list[str]] = None,
+            tag_store: Optional[TagStore] = None,
+            log_tag_frequency: bool = True
+    ):
+        if image_paths is None:
+            image_paths = get_image_paths(logger=self.logger,path=Path(self.args["data_path"]),recursive=self.args["recursive"])
+        run_caption_pipeline(self.logger, self.args, image_paths, tagger=self, tag_store=tag_store)
 
-            pbar.update(1)
-        pbar.close()
+        if log_tag_frequency:
+            self.log_tag_frequency()
 
+    def log_tag_frequency(self):
         if self.args["wd_tags_frequency"]:
             sorted_tags = sorted(self.tag_freq.items(), key=lambda x: x[1], reverse=True)
             self.logger.info('Tag frequencies:')
@@ -1011,6 +2026,9 @@ class Tagger:
 
     def unload_model(self) -> bool:
         unloaded = False
+        if self.tag_index is not None:
+            self.tag_index.save()
+            self.tag_index = None
         if self.ort_infer_sess is not None:
             self.logger.info(f'Unloading model {self.args["wd_model_name"]}...')
             start = time.monotonic()
@@ -1028,4 +2046,381 @@ class Tagger:
 
             unloaded = True
 
-        return unloaded
\ No newline at end of file
+        return unloaded
+
+# Options changing WD tags or LLM captions, part of result cache keys besides model files and prompts
+WD_RESULT_ARGS = ["wd_remove_underscore", "wd_undesired_tags", "wd_add_rating_tags_to_first",
+                  "wd_add_rating_tags_to_last", "wd_character_tags_first", "wd_always_first_tags",
+                  "wd_caption_separator", "wd_tag_replacement", "wd_character_tag_expand", "wd_threshold",
+                  "wd_general_threshold", "wd_character_threshold"]
+LLM_RESULT_ARGS = ["image_size", "llm_use_cpu", "llm_dtype", "llm_cpu_dtype", "llm_qnt", "llm_temperature",
+                   "llm_max_tokens", "llm_repetition_ngram", "llm_assistant", "llm_assistant_model_name"]
+MODEL_FILE_EXTENSIONS = (".onnx", ".csv", ".safetensors", ".bin", ".pt", ".json")
+
+
+def get_wd_thresholds(args: dict) -> tuple[float, Optional[float]]:
+    # General and character thresholds as `Tagger.get_tags_from_prob` resolves them
+    wd_model = args['wd_model_name'].lower().startswith("wd")
+    general_threshold = args['wd_general_threshold'] if wd_model else None
+    character_threshold = args['wd_character_threshold'] if wd_model else None
+    if general_threshold is False or general_threshold is None:
+        general_threshold = args['wd_threshold']
+    if (character_threshold is False or character_threshold is None) and wd_model:
+        character_threshold = args['wd_threshold']
+    return general_threshold, character_threshold
+
+
+def run_caption_pipeline(
+        logger: Logger,
+        args: dict,
+        image_paths: list[str],
+        tagger: Optional[Tagger] = None,
+        joy: Optional[Joy] = None,
+        llama: Optional[Llama] = None,
+        tag_store: Optional[TagStore] = None
+):
+    # Caption images with given models as one stage graph: plan -> decode -> WD -> LLM -> write.
+    # Every caption method and run method goes through here, only the models given differ.
+    llm = joy if joy is not None else llama
+    first_failed_counter = "wd_failed" if tagger is not None else "llm_failed"
+    prompt_variants = get_llm_prompt_variants(args)
+    num_samples = max(int(args.get('llm_num_samples', 1)), 1)
+    system_prompt = str(args['llm_system_prompt'])
+    if tagger is not None:
+        # Tags come from WD stage in memory, WD caption file is only read when WD skipped the image
+        read_wd_caption = not args['llm_caption_without_wd']
+    else:
+        read_wd_caption = (args['caption_method'] in ["wd+joy", "wd+llama"]
+                           and not args['llm_caption_without_wd']
+                           and args['run_method'] == "queue") or (args['caption_method'] in ["joy", "llama"]
+                                                                  and args['llm_read_wd_caption'])
+
+    result_cache = None
+    wd_cache_id = llm_cache_id = None
+    if args.get('result_cache', False):
+        cache_dir = args.get('cache_dir', "") or os.path.join(get_models_save_path(args), 'result_cache')
+        result_cache = ResultCache(logger, cache_dir, args.get('result_cache_max_mb', 1024))
+        if tagger is not None:
+            general_threshold, character_threshold = get_wd_thresholds(args)
+            # Thresholds as the tagger uses them, unset ones are filled by the tagger after its first image
+            wd_cache_id = [get_files_fingerprint([tagger.model_path, tagger.tags_csv_path]),
+                           {**{name: args.get(name) for name in WD_RESULT_ARGS},
+                            "wd_general_threshold": general_threshold,
+                            "wd_character_threshold": character_threshold}]
+        if llm is not None:
+            llm_model_paths = [joy.image_adapter_path, joy.clip_path, joy.llm_path] if joy is not None \
+                else [llama.llm_path]
+            llm_cache_id = [type(llm).__name__, get_files_fingerprint(llm_model_paths, MODEL_FILE_EXTENSIONS),
+                            {name: args.get(name) for name in LLM_RESULT_ARGS},
+                            system_prompt if llama is not None else None]
+    # Content hash -> first image with it in this run, and images with same content waiting for its captions
+    duplicates = {}
+    duplicates_lock = threading.Lock()
+
+    def get_caption_file(image_path: str, caption_extension: str) -> Path:
+        return get_caption_file_path(
+            logger,
+            data_path=args['data_path'],
+            image_path=Path(image_path),
+            custom_caption_save_path=args['custom_caption_save_path'],
+            caption_extension=caption_extension
+        )
+
+    def get_needed_slots(item: dict) -> set:
+        # Captions an image needs, "wd" or (prompt variant index, sample index)
+        slots = {"wd"} if item["run_wd"] else set()
+        for variant_index, _, caption_files in item["llm_variants"]:
+            slots.update((variant_index, sample_index) for sample_index in range(len(caption_files)))
+        return slots
+
+    def hold_duplicate(item: dict) -> bool:
+        # Images with same content as one still in pipeline get its captions when it's written
+        with duplicates_lock:
+            first = duplicates.get(item["content_hash"])
+            if first is None:
+                duplicates[item["content_hash"]] = {"slots": get_needed_slots(item), "done": False,
+                                                    "duplicates": []}
+                return False
+            if first["done"] or not get_needed_slots(item) <= first["slots"]:
+                # Finished ones are found in result cache
+                return False
+            first["duplicates"].append(item)
+            METRICS.count("duplicates")
+            return True
+
+    def plan(item: dict) -> Optional[dict]:
+        # Caption files and skip checks, images with nothing to do are not decoded
+        image_path = item["image_path"]
+        item["captions"] = []
+        item["run_wd"] = False
+        item["llm_variants"] = []
+        if tagger is not None:
+            item["wd_caption_file"] = get_caption_file(image_path, args['wd_caption_extension'])
+            if args['wd_file_action'] == "skip" and os.path.isfile(item["wd_caption_file"]):
+                logger.warning(f'wd_file_action is set to skip!!! '
+                               f'WD Caption file {item["wd_caption_file"]} already exists, Skip this caption.')
+                METRICS.count("wd_skipped")
+            else:
+                item["run_wd"] = True
+        if llm is not None:
+            # One caption file per prompt variant and sample
+            llm_caption_files = [[get_caption_file(image_path,
+                                                   get_llm_caption_extension(variant["caption_extension"],
+                                                                             sample_index))
+                                  for sample_index in range(num_samples)] for variant in prompt_variants]
+            item["llm_variants"] = [(variant_index, variant, caption_files)
+                                    for variant_index, (variant, caption_files)
+                                    in enumerate(zip(prompt_variants, llm_caption_files))
+                                    if not (args['llm_file_action'] == "skip"
+                                            and all(os.path.isfile(caption_file) for caption_file in caption_files))]
+            if not item["llm_variants"]:
+                logger.warning(f'llm_file_action is set to skip!!! '
+                               f'LLM Caption file {llm_caption_files[0][0]} already exists, Skip this caption.')
+                METRICS.count("llm_skipped")
+        if not item["run_wd"] and not item["llm_variants"]:
+            return None
+
+        if result_cache is not None:
+            item["content_hash"] = get_file_sha256(image_path)
+            if hold_duplicate(item):
+                return None
+            if item["run_wd"]:
+                tag_text = result_cache.get(ResultCache.make_key("wd", wd_cache_id, item["content_hash"]))
+                if tag_text is not None:
+                    METRICS.count("wd_cache_hits")
+                    add_tags(item, tag_text)
+                    if tagger.tag_index is not None:
+                        # Cached tags have no probabilities
+                        tagger.tag_index.add_tag_text(item["image_path"], tag_text, args['wd_caption_separator'])
+                    item["run_wd"] = False
+            if item["llm_variants"] and not item["run_wd"]:
+                # WD tags are known, so are prompts
+                use_llm_cache(item)
+        return item
+
+    def decode(item: dict) -> dict:
+        if not item["run_wd"] and not item["llm_variants"]:
+            # All captions are from result cache
+            return item
+        image = load_image(item["image_path"])
+        if item["run_wd"]:
+            wd_image = image_process(image, tagger.model_shape_size)
+            logger.debug(f"Resized image shape: {wd_image.shape}")
+            item["wd_image"] = image_process_gbr(wd_image)
+        if item["llm_variants"]:
+            llm_image = image_process(image, int(args['image_size']))
+            logger.debug(f"Resized image shape: {llm_image.shape}")
+            item["llm_image"] = image_process_image(llm_image)
+        return item
+
+    def add_tags(item: dict, tag_text: str):
+        item["tag_text"] = tag_text
+        if tag_store is not None:
+            tag_store.put(item["image_path"], tag_text)
+        item["captions"].append((item["wd_caption_file"], tag_text, args['wd_file_action'], "WD", "wd"))
+
+    def tag(items: list[dict]) -> list[dict]:
+        # WD tags images in batches of tagger's `batch_size`
+        tag_items = [item for item in items if item["run_wd"]]
+        if not tag_items:
+            return items
+        tags = tagger.get_tags_batch(
+            images=[item.pop("wd_image") for item in tag_items],
+            image_paths=[item["image_path"] for item in tag_items]
+        )
+        for item, (tag_text, rating_tag_text, character_tag_text, general_tag_text) in zip(tag_items, tags):
+            add_tags(item, tag_text)
+            if result_cache is not None:
+                result_cache.put(ResultCache.make_key("wd", wd_cache_id, item["content_hash"]), tag_text)
+            if args['wd_model_name'].lower().startswith("wd"):
+                logger.debug(f"WD Rating tags: {rating_tag_text}")
+                logger.debug(f"WD Character tags: {character_tag_text}")
+            logger.debug(f"WD General tags: {general_tag_text}")
+        return items
+
+    def get_tag_text(item: dict) -> Optional[str]:
+        tag_text = item.get("tag_text")
+        if tag_text is None and tag_store is not None:
+            tag_text = tag_store.get(item["image_path"])
+        if tag_text is None:
+            wd_caption_file = get_caption_file(item["image_path"], args['wd_caption_extension'])
+            if os.path.isfile(wd_caption_file):
+                logger.debug(f'Loading WD caption file: {wd_caption_file}')
+                with open(wd_caption_file, "r", encoding="utf-8") as wcf:
+                    tag_text = wcf.read()
+            else:
+                logger.warning(f'WD caption file: {wd_caption_file} NOT FOUND!!! Inference without WD tags.')
+        return tag_text
+
+    def get_prompts(item: dict) -> list[tuple[int, str, list[Path]]]:
+        tag_text = get_tag_text(item) if read_wd_caption \
+            and any(variant["with_wd"] for _, variant, _ in item["llm_variants"]) else None
+        prompts = []
+        for variant_index, variant, caption_files in item["llm_variants"]:
+            if read_wd_caption and variant["with_wd"]:
+                user_prompt = str(f'{variant["user_prompt"]}{tag_text}\n') if tag_text is not None \
+                    else DEFAULT_USER_PROMPT_WITHOUT_WD
+            else:
+                user_prompt = str(f'{variant["user_prompt"]}\n')
+            prompts.append((variant_index, user_prompt, caption_files))
+        return prompts
+
+    def get_llm_cache_key(
+            item: dict,
+            user_prompt: str,
+            sample_index: int
+    ) -> str:
+        return ResultCache.make_key("llm", llm_cache_id, user_prompt, item["content_hash"], sample_index)
+
+    def use_llm_cache(item: dict):
+        # Captions of prompts found in result cache are added, only the others are left to generate
+        prompts = get_prompts(item)
+        if result_cache is not None:
+            missed_prompts = []
+            for variant_index, user_prompt, caption_files in prompts:
+                captions = [result_cache.get(get_llm_cache_key(item, user_prompt, sample_index))
+                            for sample_index in range(len(caption_files))]
+                if any(caption is None for caption in captions):
+                    missed_prompts.append((variant_index, user_prompt, caption_files))
+                    continue
+                METRICS.count("llm_cache_hits")
+                add_llm_captions(item, [(variant_index, user_prompt, caption_files)], captions, cache=False)
+            prompts = missed_prompts
+        item["prompts"] = prompts
+        item["llm_variants"] = [llm_variant for llm_variant in item["llm_variants"]
+                                if llm_variant[0] in set(prompt[0] for prompt in prompts)]
+
+    def add_llm_captions(
+            item: dict,
+            prompts: list[tuple[int, str, list[Path]]],
+            captions: list[str],
+            cache: bool = True
+    ):
+        # `captions` are ordered by prompt, then sample
+        for prompt_index, (variant_index, user_prompt, caption_files) in enumerate(prompts):
+            for sample_index, caption_file in enumerate(caption_files):
+                caption = captions[prompt_index * num_samples + sample_index].replace('\n', '')
+                item["captions"].append((caption_file, caption, args['llm_file_action'], "LLM",
+                                         (variant_index, sample_index)))
+                if cache and result_cache is not None:
+                    result_cache.put(get_llm_cache_key(item, user_prompt, sample_index), caption)
+
+    def caption_joy(item: dict) -> dict:
+        if "prompts" not in item:
+            use_llm_cache(item)
+        prompts = item.pop("prompts")
+        llm_image = item.pop("llm_image", None)
+        if not prompts:
+            return item
+        captions = joy.get_captions(
+            image=llm_image,
+            user_prompts=[user_prompt for _, user_prompt, _ in prompts],
+            temperature=args['llm_temperature'],
+            max_new_tokens=args['llm_max_tokens'],
+            num_samples=num_samples
+        )
+        add_llm_captions(item, prompts, [caption for variant_captions in captions for caption in variant_captions])
+        return item
+
+    def caption_llama(items: list[dict]) -> list[dict]:
+        # Llama captions are generated in batches of `llm_batch_size`, one row per image and prompt variant
+        rows = []
+        for item in items:
+            if "prompts" not in item:
+                use_llm_cache(item)
+            prompts = item.pop("prompts")
+            llm_image = item.pop("llm_image", None)
+            if prompts:
+                rows.append((item, llm_image, prompts))
+        images, user_prompts = [], []
+        for item, llm_image, prompts in rows:
+            for _, user_prompt, _ in prompts:
+                images.append(llm_image)
+                user_prompts.append(user_prompt)
+        if images:
+            captions = llama.get_caption_batch(
+                images=images,
+                system_prompt=system_prompt,
+                user_prompts=user_prompts,
+                temperature=args['llm_temperature'],
+                max_new_tokens=args['llm_max_tokens'],
+                num_samples=num_samples
+            )
+            offset = 0
+            for item, _, prompts in rows:
+                add_llm_captions(item, prompts, captions[offset:offset + len(prompts) * num_samples])
+                offset += len(prompts) * num_samples
+        return items
+
+    def write_captions(
+            item: dict,
+            captions: list[tuple]
+    ):
+        failed_types = set()
+        for caption_file, caption, file_action, caption_type in captions:
+            try:
+                write_caption_file(
+                    logger,
+                    caption_file=caption_file,
+                    caption=caption,
+                    file_action=file_action,
+                    image_path=item["image_path"],
+                    caption_type=caption_type
+                )
+            except Exception as e:
+                logger.error(f"Failed to caption image: {item['image_path']}, skip it.\nerror info: {e}")
+                failed_types.add(caption_type)
+        for caption_type in dict.fromkeys(caption_type for _, _, _, caption_type in captions):
+            METRICS.count(f'{caption_type.lower()}_failed' if caption_type in failed_types
+                          else f'{caption_type.lower()}_images')
+
+    def write(item: dict) -> dict:
+        captions = item.get("captions", [])
+        write_captions(item, [caption[:4] for caption in captions])
+        if "content_hash" not in item:
+            return item
+        with duplicates_lock:
+            first = duplicates.get(item["content_hash"])
+            if first is None or first["done"]:
+                return item
+            first["done"] = True
+            held_items = first["duplicates"]
+        slot_captions = {caption[4]: caption[1:4] for caption in captions}
+        for held_item in held_items:
+            # Caption files of the duplicate, filled with captions of this image
+            slot_files = {"wd": held_item["wd_caption_file"]} if held_item["run_wd"] else {}
+            for variant_index, _, caption_files in held_item["llm_variants"]:
+                for sample_index, caption_file in enumerate(caption_files):
+                    slot_files[(variant_index, sample_index)] = caption_file
+            held_captions = [(caption_file, *slot_captions[slot]) for slot, caption_file in slot_files.items()
+                             if slot in slot_captions]
+            write_captions(held_item, held_captions)
+            if "wd" in slot_files and "wd" in slot_captions and tagger.tag_index is not None:
+                tagger.tag_index.add_copy(held_item["image_path"], item["image_path"])
+            for caption_type in set("WD" if slot == "wd" else "LLM" for slot in slot_files
+                                    if slot not in slot_captions):
+                logger.error(f"Failed to caption image: {held_item['image_path']}, skip it.")
+                METRICS.count(f'{caption_type.lower()}_failed')
+        return item
+
+    stages = [
+        Stage("plan", plan, failed_counter=first_failed_counter),
+        # Decoding and resizing release GIL, so several images are prepared at the same time
+        Stage("decode", decode, workers=int(args.get('pipeline_decode_workers', 2)),
+              failed_counter=first_failed_counter),
+    ]
+    if tagger is not None:
+        stages.append(Stage("wd", tag, batch_size=tagger.batch_size, failed_counter="wd_failed", profile=True))
+    if joy is not None:
+        stages.append(Stage("llm", caption_joy, failed_counter="llm_failed", profile=True, torch_trace=True))
+    elif llama is not None:
+        stages.append(Stage("llm", caption_llama, batch_size=max(int(args.get('llm_batch_size', 1)), 1),
+                            failed_counter="llm_failed", profile=True, torch_trace=True))
+    stages.append(Stage("write", write, receive_failed=True))
+
+    queue_size = args.get('pipeline_queue_size', args.get('sync_queue_size', 4))
+    try:
+        Pipeline(logger, stages, queue_size).run([{"image_path": image_path} for image_path in image_paths])
+    finally:
+        if result_cache is not None:
+            result_cache.close()
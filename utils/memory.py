@@ -0,0 +1,122 @@
+import ctypes
+import gc
+import os
+import sys
+import threading
+import time
+
+from utils.logger import Logger
+
+# Limits shrink above this fraction of `max_memory_mb`, and grow back below the low one
+MEMORY_HIGH_FRACTION = 0.9
+MEMORY_LOW_FRACTION = 0.6
+# Seconds between two changes of the same limit, so memory freed by the last change can show up in RSS
+MEMORY_ADJUST_INTERVAL = 5.0
+# RSS is read at most this often(seconds)
+MEMORY_RSS_CACHE_TIME = 0.2
+
+try:
+    import psutil
+    _PROCESS = psutil.Process()
+except ImportError:
+    _PROCESS = None
+
+
+def get_rss_mb() -> float:
+    # psutil if installed, /proc on Linux, otherwise peak RSS is the best we have
+    if _PROCESS is not None:
+        return _PROCESS.memory_info().rss / 1024 / 1024
+    try:
+        with open("/proc/self/statm", "rt") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB on Linux
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def release_memory():
+    # Free python garbage and give freed heap back to OS, CUDA cache is left to torch
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class MemoryBudget:
+    def __init__(self):
+        self.logger = None
+        self.max_memory_mb = 0
+        # name -> (current limit, time of last change)
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.rss_mb = 0.0
+        self.rss_time = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_memory_mb > 0
+
+    def setup(
+            self,
+            logger: Logger,
+            args: dict
+    ):
+        self.logger = logger
+        self.max_memory_mb = max(float(args.get('max_memory_mb', 0) or 0), 0)
+        self.limits = {}
+        if self.enabled:
+            logger.info(f'Memory budget {self.max_memory_mb:.0f}MB, current RSS {get_rss_mb():.0f}MB. '
+                        f'Prefetch, batch sizes and in-memory caches will shrink above '
+                        f'{MEMORY_HIGH_FRACTION:.0%} of it.')
+
+    def get_rss_mb(self) -> float:
+        now = time.monotonic()
+        if now - self.rss_time >= MEMORY_RSS_CACHE_TIME:
+            self.rss_mb = get_rss_mb()
+            self.rss_time = now
+        return self.rss_mb
+
+    def under_pressure(self) -> bool:
+        return self.enabled and self.get_rss_mb() > self.max_memory_mb * MEMORY_HIGH_FRACTION
+
+    def limit(
+            self,
+            name: str,
+            value: int,
+            minimum: int = 1
+    ) -> int:
+        # Configured value when memory is fine, halved each time RSS is high, doubled back when it's low again
+        if not self.enabled:
+            return value
+        rss_mb = self.get_rss_mb()
+        now = time.monotonic()
+        with self.lock:
+            current, changed_time = self.limits.get(name, (value, 0.0))
+            if now - changed_time < MEMORY_ADJUST_INTERVAL:
+                return current
+            if rss_mb > self.max_memory_mb * MEMORY_HIGH_FRACTION and current > minimum:
+                current = max(current // 2, minimum)
+                self.limits[name] = (current, now)
+                self.logger.warning(f'RSS {rss_mb:.0f}MB is close to max_memory_mb {self.max_memory_mb:.0f}MB, '
+                                    f'{name} reduced to {current}.')
+                release_memory()
+            elif rss_mb < self.max_memory_mb * MEMORY_LOW_FRACTION and current < value:
+                current = min(current * 2, value)
+                self.limits[name] = (current, now)
+                self.logger.info(f'RSS {rss_mb:.0f}MB, {name} raised to {current}.')
+        return current
+
+
+# Budget of the whole process, configured once per run from `max_memory_mb`
+MEMORY_BUDGET = MemoryBudget()
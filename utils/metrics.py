@@ -0,0 +1,358 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from utils.logger import Logger
+from utils.memory import get_peak_rss_mb, get_rss_mb
+
+# Upper bounds(seconds) of latency histogram buckets, same for every stage so they can be summed across runs
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Stages in pipeline order, other stages are listed after them
+METRICS_STAGES = ("discovery", "decode", "preprocess", "wd_inference", "wd_postprocess",
+                  "llm_inference", "llm_postprocess", "write")
+METRICS_PREFIX = "wd_llm_caption"
+
+
+class StageHistogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # One more bucket for +Inf
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the quantile, +Inf bucket reports max
+        rank = q * self.count
+        total = 0
+        for index, bound in enumerate(METRICS_BUCKETS):
+            total += self.buckets[index]
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": round(self.sum, 6),
+            "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5) * 1000, 3),
+            "p90_ms": round(self.quantile(0.9) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "buckets": {str(bound): count for bound, count in zip(METRICS_BUCKETS + ("+Inf",), self.buckets)},
+        }
+
+
+class WorkerMemory:
+    def __init__(self):
+        # RSS of one worker thread, sampled after each call it makes. Process wide peaks(tracemalloc, CUDA)
+        # are left alone, workers of other stages are measuring at the same time.
+        self.calls = 0
+        self.rss_start_mb = self.rss_last_mb = self.rss_peak_mb = get_rss_mb()
+        self.rss_max_growth_mb = 0.0
+
+    def sample(self):
+        rss_mb = get_rss_mb()
+        self.calls += 1
+        self.rss_peak_mb = max(self.rss_peak_mb, rss_mb)
+        self.rss_max_growth_mb = max(self.rss_max_growth_mb, rss_mb - self.rss_last_mb)
+        self.rss_last_mb = rss_mb
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.start_time = time.monotonic()
+        # Depth of suspend() per thread while internal work(e.g. compile warm-up) runs, so it isn't counted as
+        # captioning. Other threads captioning at the same time are still counted.
+        self.suspended = threading.local()
+        self.logger = None
+        self.prometheus_file = ""
+        self.prometheus_interval = 15.0
+        self.prometheus_thread = None
+        self.prometheus_stop = threading.Event()
+
+        # Memory of coarse stages(load_models, wd, llm, sync...), kept by reset since models are loaded before a run,
+        # cleared by setup_memory instead
+        self.memory = {}
+        # stage -> number of callers inside it
+        self.memory_active = {}
+        self.memory_interval = 0.5
+        self.memory_thread = None
+
+    def setup_memory(self, args: dict):
+        # Called before models are loaded, so load_models is part of the run
+        with self.lock:
+            self.memory = {stage: entry for stage, entry in self.memory.items() if stage in self.memory_active}
+        self.memory_interval = max(float(args.get('memory_sample_interval', 0.5)), 0.05)
+        # tracemalloc slows python allocations down, only enabled on request
+        if args.get('memory_tracemalloc', False) and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def sample_memory(self):
+        # Peak RSS of active stages between their start and end
+        while True:
+            time.sleep(self.memory_interval)
+            rss_mb = get_rss_mb()
+            with self.lock:
+                if not self.memory_active:
+                    self.memory_thread = None
+                    return
+                for stage in self.memory_active.keys():
+                    self.memory[stage]["rss_peak_mb"] = max(self.memory[stage]["rss_peak_mb"], rss_mb)
+
+    def keep_active_peaks(self, use_cuda: bool, torch):
+        # Peaks are process wide, active stages keep them before another stage resets them, called with lock
+        tracemalloc_peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if tracemalloc.is_tracing() else None
+        cuda_peak_mb = torch.cuda.max_memory_allocated() / 1024 / 1024 if use_cuda else None
+        for stage in self.memory_active.keys():
+            entry = self.memory[stage]
+            if tracemalloc_peak_mb is not None:
+                entry["tracemalloc_peak_mb"] = max(entry.get("tracemalloc_peak_mb", 0.0), tracemalloc_peak_mb)
+            if cuda_peak_mb is not None:
+                entry["cuda_peak_mb"] = max(entry.get("cuda_peak_mb", 0.0), cuda_peak_mb)
+
+    @contextmanager
+    def memory_stage(self, stage: str):
+        # Stages may be nested(a pipeline stage inside `sync`) or run at the same time in other threads
+        rss_mb = get_rss_mb()
+        start_rss_mb = rss_mb
+        # Only look at CUDA when torch is already imported by a LLM
+        torch = sys.modules.get("torch")
+        use_cuda = torch is not None and torch.cuda.is_available()
+        with self.lock:
+            entry = self.memory.get(stage)
+            if entry is None:
+                entry = self.memory[stage] = {"calls": 0, "rss_start_mb": rss_mb, "rss_end_mb": rss_mb,
+                                              "rss_peak_mb": rss_mb, "rss_max_growth_mb": 0.0}
+            entry["calls"] += 1
+            entry["rss_start_mb"] = rss_mb
+            self.keep_active_peaks(use_cuda, torch)
+            self.memory_active[stage] = self.memory_active.get(stage, 0) + 1
+            if self.memory_thread is None:
+                self.memory_thread = threading.Thread(target=self.sample_memory, daemon=True)
+                self.memory_thread.start()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            if use_cuda:
+                torch.cuda.reset_peak_memory_stats()
+        try:
+            yield
+        finally:
+            rss_mb = get_rss_mb()
+            with self.lock:
+                entry["rss_end_mb"] = rss_mb
+                entry["rss_peak_mb"] = max(entry["rss_peak_mb"], rss_mb)
+                # Largest RSS growth of one call, shows which stage allocates when stages overlap
+                entry["rss_max_growth_mb"] = max(entry.get("rss_max_growth_mb", 0.0), rss_mb - start_rss_mb)
+                if tracemalloc.is_tracing():
+                    entry["tracemalloc_peak_mb"] = max(entry.get("tracemalloc_peak_mb", 0.0),
+                                                       tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+                if use_cuda:
+                    entry["cuda_peak_mb"] = max(entry.get("cuda_peak_mb", 0.0),
+                                                torch.cuda.max_memory_allocated() / 1024 / 1024)
+                self.memory_active[stage] -= 1
+                if self.memory_active[stage] == 0:
+                    del self.memory_active[stage]
+
+    def add_worker_memory(self, stage: str, worker_memory: WorkerMemory):
+        # Merge memory of a finished worker, workers of one stage share an entry
+        if worker_memory.calls == 0:
+            return
+        with self.lock:
+            entry = self.memory.get(stage)
+            if entry is None:
+                entry = self.memory[stage] = {"calls": 0, "rss_start_mb": worker_memory.rss_start_mb,
+                                              "rss_end_mb": worker_memory.rss_last_mb,
+                                              "rss_peak_mb": worker_memory.rss_peak_mb, "rss_max_growth_mb": 0.0}
+            entry["calls"] += worker_memory.calls
+            entry["rss_end_mb"] = worker_memory.rss_last_mb
+            entry["rss_peak_mb"] = max(entry["rss_peak_mb"], worker_memory.rss_peak_mb)
+            entry["rss_max_growth_mb"] = max(entry["rss_max_growth_mb"], worker_memory.rss_max_growth_mb)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.start_time = time.monotonic()
+
+    def is_suspended(self) -> bool:
+        return getattr(self.suspended, "depth", 0) > 0
+
+    @contextmanager
+    def suspend(self):
+        self.suspended.depth = getattr(self.suspended, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self.suspended.depth -= 1
+
+    def observe(self, stage: str, seconds: float):
+        if self.is_suspended():
+            return
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start_time)
+
+    def count(self, name: str, value: int = 1):
+        # Counters: wd/llm images, skipped, failed and llm prompt/generated tokens
+        if self.is_suspended():
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            stage_names = [stage for stage in METRICS_STAGES if stage in self.stages] + \
+                          sorted(stage for stage in self.stages if stage not in METRICS_STAGES)
+            stages = {stage: self.stages[stage].summary() for stage in stage_names}
+            counters = dict(self.counters)
+            memory = {stage: {key: round(value, 1) if isinstance(value, float) else value
+                              for key, value in entry.items()} for stage, entry in self.memory.items()}
+        llm_seconds = stages["llm_inference"]["seconds"] if "llm_inference" in stages else 0.0
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "wd_images_per_second": round(counters.get("wd_images", 0) / elapsed, 3) if elapsed > 0 else 0.0,
+            "llm_images_per_second": round(counters.get("llm_images", 0) / elapsed, 3) if elapsed > 0 else 0.0,
+            # Tokens per second of time spent in LLM generation, prompt tokens are the prefill
+            "llm_prompt_tokens_per_second":
+                round(counters.get("llm_prompt_tokens", 0) / llm_seconds, 3) if llm_seconds > 0 else 0.0,
+            "llm_generated_tokens_per_second":
+                round(counters.get("llm_generated_tokens", 0) / llm_seconds, 3) if llm_seconds > 0 else 0.0,
+            "counters": counters,
+            "stages": stages,
+            "memory": {
+                "process_peak_rss_mb": round(get_peak_rss_mb(), 1),
+                "stages": memory,
+            },
+        }
+
+    def log_summary(self, logger: Logger):
+        summary = self.summary()
+        counters = summary["counters"]
+        logger.info(f'Metrics of {summary["elapsed_seconds"]:.1f}s run: '
+                    f'WD {counters.get("wd_images", 0)} image(s) ({summary["wd_images_per_second"]:.2f}/s), '
+                    f'{counters.get("wd_skipped", 0)} skipped, {counters.get("wd_failed", 0)} failed; '
+                    f'LLM {counters.get("llm_images", 0)} image(s) ({summary["llm_images_per_second"]:.2f}/s), '
+                    f'{counters.get("llm_skipped", 0)} skipped, {counters.get("llm_failed", 0)} failed, '
+                    f'{summary["llm_generated_tokens_per_second"]:.1f} tokens/s.')
+        for stage, stage_summary in summary["stages"].items():
+            logger.info(f'{stage}: {stage_summary["count"]} call(s), {stage_summary["seconds"]:.2f}s, '
+                        f'mean {stage_summary["mean_ms"]:.1f}ms, p90 {stage_summary["p90_ms"]:.1f}ms, '
+                        f'max {stage_summary["max_ms"]:.1f}ms')
+        for stage, entry in summary["memory"]["stages"].items():
+            logger.info(f'{stage} memory: RSS {entry["rss_start_mb"]:.0f}MB -> {entry["rss_end_mb"]:.0f}MB, '
+                        f'peak {entry["rss_peak_mb"]:.0f}MB'
+                        + (f', max growth of {entry["calls"]} calls {entry["rss_max_growth_mb"]:.0f}MB'
+                           if entry["calls"] > 1 else "")
+                        + (f', tracemalloc peak {entry["tracemalloc_peak_mb"]:.0f}MB'
+                           if "tracemalloc_peak_mb" in entry else "")
+                        + (f', CUDA peak {entry["cuda_peak_mb"]:.0f}MB' if "cuda_peak_mb" in entry else ""))
+        logger.info(f'Process peak RSS {summary["memory"]["process_peak_rss_mb"]:.0f}MB.')
+
+    def save_summary(self, metrics_file: str):
+        summary = self.summary()
+        tmp_file = f'{metrics_file}.tmp'
+        with open(tmp_file, "wt", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
+        os.replace(tmp_file, metrics_file)
+
+    def prometheus_text(self) -> str:
+        with self.lock:
+            stages = {stage: (histogram.count, histogram.sum, list(histogram.buckets))
+                      for stage, histogram in self.stages.items()}
+            counters = dict(self.counters)
+            memory = {stage: dict(entry) for stage, entry in self.memory.items()}
+        lines = [f'# HELP {METRICS_PREFIX}_stage_seconds Latency of caption pipeline stages.',
+                 f'# TYPE {METRICS_PREFIX}_stage_seconds histogram']
+        for stage, (count, seconds, buckets) in stages.items():
+            cumulative = 0
+            for bound, bucket in zip(METRICS_BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append(f'{METRICS_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        for name in sorted(counters.keys()):
+            lines.append(f'# TYPE {METRICS_PREFIX}_{name}_total counter')
+            lines.append(f'{METRICS_PREFIX}_{name}_total {counters[name]}')
+        lines.append(f'# TYPE {METRICS_PREFIX}_memory_peak_megabytes gauge')
+        for stage, entry in memory.items():
+            for key in ("rss_peak_mb", "tracemalloc_peak_mb", "cuda_peak_mb"):
+                if key in entry:
+                    lines.append(f'{METRICS_PREFIX}_memory_peak_megabytes{{stage="{stage}",type="{key[:-8]}"}} '
+                                 f'{entry[key]:.1f}')
+        lines.append(f'{METRICS_PREFIX}_memory_rss_megabytes {get_rss_mb():.1f}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        # node_exporter textfile collector may read at any time, so replace the file atomically
+        if not self.prometheus_file:
+            return
+        try:
+            tmp_file = f'{self.prometheus_file}.tmp'
+            with open(tmp_file, "wt", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_file, self.prometheus_file)
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.warning(f'Failed to write metrics to {self.prometheus_file}.\nerror info: {e}')
+
+    def start_prometheus(
+            self,
+            logger: Logger,
+            prometheus_file: str,
+            prometheus_interval: float = 15.0
+    ):
+        self.logger = logger
+        self.prometheus_file = prometheus_file
+        self.prometheus_interval = max(float(prometheus_interval), 1.0)
+        if not prometheus_file or self.prometheus_thread is not None:
+            return
+        self.prometheus_stop.clear()
+
+        def write_periodically():
+            while not self.prometheus_stop.wait(self.prometheus_interval):
+                self.write_prometheus()
+
+        self.prometheus_thread = threading.Thread(target=write_periodically, daemon=True)
+        self.prometheus_thread.start()
+        logger.info(f'Writing Prometheus metrics to {prometheus_file} every {self.prometheus_interval:.0f}s.')
+
+    def stop_prometheus(self):
+        if self.prometheus_thread is not None:
+            self.prometheus_stop.set()
+            self.prometheus_thread.join()
+            self.prometheus_thread = None
+        self.write_prometheus()
+
+
+# Collector of the whole process, stages in different modules and threads report here
+METRICS = Metrics()
@@ -0,0 +1,285 @@
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+from tqdm import tqdm
+
+from utils.logger import Logger
+from utils.memory import MEMORY_BUDGET
+from utils.metrics import METRICS, WorkerMemory
+from utils.profiler import NULL_CONTEXT, PROFILER
+
+# Put in a stage's queue once per worker when all items before it are done
+_END = object()
+
+
+class Stage:
+    def __init__(
+            self,
+            name: str,
+            func: Callable,
+            workers: int = 1,
+            batch_size: Optional[int] = None,
+            failed_counter: Optional[str] = None,
+            profile: bool = False,
+            torch_trace: bool = False,
+            receive_failed: bool = False
+    ):
+        # `func` takes an item and returns it for next stage, or None when the item is done(e.g. skipped).
+        # With `batch_size`, it takes a list of up to `batch_size` items and returns the items to pass on.
+        # Items are dicts with an `image_path`, an item whose `func` raised is logged and counted in `failed_counter`.
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.batch_size = max(int(batch_size), 1) if batch_size is not None else None
+        self.failed_counter = failed_counter
+        # Sampled by profiler under stage name, `profile` should be set on model stages only
+        self.profile = profile
+        self.torch_trace = torch_trace
+        # Items failed in earlier stages come here too, e.g. to write WD caption of an image the LLM failed on
+        self.receive_failed = receive_failed
+
+        self.busy_time = 0.0
+
+
+class Pipeline:
+    def __init__(
+            self,
+            logger: Logger,
+            stages: list[Stage],
+            queue_size: int = 4
+    ):
+        # Stages run in their own threads, connected by bounded queues. A stage blocks when next one's queue is full,
+        # so decoded images don't pile up in front of a slow model. Models and PIL release GIL while they work.
+        self.logger = logger
+        self.stages = stages
+        self.queue_size = max(int(queue_size), 1)
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # Stages with several workers finish items out of order, their results are held back and passed on
+        # in arrival order, so every later stage(and caption files, tag index) sees images in input order.
+        self.reorder_conditions = [threading.Condition() for _ in stages]
+        self.arrival_locks = [threading.Lock() for _ in stages]
+        self.arrivals = [0 for _ in stages]
+        self.next_arrivals = [0 for _ in stages]
+        self.finished_arrivals = [{} for _ in stages]
+        self.pbar = None
+        # First exception escaped from a worker, raised again by `run` so a crashed stage doesn't look finished
+        self.error = None
+
+    def put(
+            self,
+            index: int,
+            item
+    ):
+        # With max_memory_mb, fewer items wait in queue when memory is high
+        stage_queue = self.queues[index]
+        while item is not _END and not self.stop_event.is_set() \
+                and stage_queue.qsize() >= MEMORY_BUDGET.limit(f'{self.stages[index].name}_queue_size',
+                                                               self.queue_size):
+            time.sleep(0.05)
+        while not self.stop_event.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(
+            self,
+            index: int
+    ):
+        stage_queue = self.queues[index]
+        while not self.stop_event.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def get_in_order(
+            self,
+            index: int
+    ) -> tuple:
+        # Item and its arrival number in stage, taken together so arrival numbers follow queue order
+        if self.stages[index].workers == 1:
+            return self.get(index), None
+        with self.arrival_locks[index]:
+            item = self.get(index)
+            if item is _END:
+                return item, None
+            arrival = self.arrivals[index]
+            self.arrivals[index] += 1
+            return item, arrival
+
+    def put_in_order(
+            self,
+            index: int,
+            batch: list,
+            arrivals: list,
+            results: list
+    ):
+        # Pass results of a batch on to next stage, after results of every item that arrived before them
+        if self.stages[index].workers == 1:
+            for result in results:
+                self.put(index + 1, result)
+            return
+        arrival_of_item = {id(item): arrival for item, arrival in zip(batch, arrivals)}
+        condition = self.reorder_conditions[index]
+        with condition:
+            finished = self.finished_arrivals[index]
+            for arrival in arrivals:
+                finished.setdefault(arrival, [])
+            for result in results:
+                finished[arrival_of_item.get(id(result), arrivals[-1])].append(result)
+            while self.next_arrivals[index] in finished:
+                for result in finished.pop(self.next_arrivals[index]):
+                    self.put(index + 1, result)
+                self.next_arrivals[index] += 1
+            condition.notify_all()
+            # Don't run ahead of a slow item, held results would pile up like an unbounded queue
+            while len(finished) >= self.queue_size and not self.stop_event.is_set():
+                condition.wait(timeout=0.1)
+
+    def done(
+            self,
+            items: list
+    ):
+        # Items finished, skipped or failed
+        if self.pbar is not None and items:
+            with self.lock:
+                image_path = str(items[-1]["image_path"])
+                self.pbar.set_description('Processing: {}'.format(image_path if len(image_path) <= 40 else
+                                                                  image_path[:15]) + ' ... ' + image_path[-20:])
+                self.pbar.update(len(items))
+
+    def run_func(
+            self,
+            stage: Stage,
+            items: list
+    ) -> tuple[list, bool]:
+        # Items to pass on, and whether `func` failed
+        start = time.monotonic()
+        try:
+            with PROFILER.region(stage.name, torch_trace=stage.torch_trace) if stage.profile else NULL_CONTEXT:
+                if stage.batch_size is None:
+                    result = stage.func(items[0])
+                    return ([result] if result is not None else []), False
+                return stage.func(items), False
+        except Exception as e:
+            for item in items:
+                self.logger.error(f"Failed to caption image: {item['image_path']}, skip it.\nerror info: {e}")
+            if stage.failed_counter is not None:
+                METRICS.count(stage.failed_counter, len(items))
+            return [], True
+        finally:
+            with self.lock:
+                stage.busy_time += time.monotonic() - start
+
+    def run_worker(
+            self,
+            index: int,
+            finished: list[int]
+    ):
+        stage = self.stages[index]
+        last_stage = index == len(self.stages) - 1
+        batch = []
+        arrivals = []
+        # Memory of each stage is reported as `pipeline_<name>`, so RSS growth of decode, WD and LLM can be told apart
+        worker_memory = WorkerMemory()
+        try:
+            while True:
+                item, arrival = self.get_in_order(index)
+                if item is not _END:
+                    batch.append(item)
+                    arrivals.append(arrival)
+                    batch_size = MEMORY_BUDGET.limit(f'{stage.name}_batch_size', stage.batch_size) \
+                        if stage.batch_size is not None else 1
+                    if len(batch) < batch_size:
+                        continue
+                if batch:
+                    results, failed = self.run_func(stage, batch)
+                    worker_memory.sample()
+                    failed_index = next((later_index for later_index in range(index + 1, len(self.stages))
+                                         if self.stages[later_index].receive_failed), None) if failed else None
+                    if failed_index is not None:
+                        for item in batch:
+                            self.put(failed_index, item)
+                    else:
+                        # Items not passed on are done here
+                        passed = set(id(result) for result in results)
+                        self.done([item for item in batch if id(item) not in passed])
+                    if last_stage:
+                        self.done(results)
+                    else:
+                        self.put_in_order(index, batch, arrivals, results)
+                    batch = []
+                    arrivals = []
+                if item is _END or self.stop_event.is_set():
+                    break
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.stop_event.set()
+        finally:
+            METRICS.add_worker_memory(f'pipeline_{stage.name}', worker_memory)
+            with self.lock:
+                finished[index] += 1
+                last_worker = finished[index] == stage.workers
+            if last_worker and not last_stage:
+                for _ in range(self.stages[index + 1].workers):
+                    self.put(index + 1, _END)
+
+    def run(
+            self,
+            items: list,
+            desc: Optional[str] = None
+    ):
+        if not items or not self.stages:
+            return
+        for stage in self.stages:
+            stage.busy_time = 0.0
+        self.stop_event.clear()
+        self.error = None
+        self.arrivals = [0 for _ in self.stages]
+        self.next_arrivals = [0 for _ in self.stages]
+        self.finished_arrivals = [{} for _ in self.stages]
+        finished = [0 for _ in self.stages]
+        threads = [threading.Thread(target=self.run_worker, args=(index, finished), daemon=True)
+                   for index, stage in enumerate(self.stages) for _ in range(stage.workers)]
+
+        pipeline_start = time.monotonic()
+        self.pbar = tqdm(total=len(items), smoothing=0.0, desc=desc)
+        try:
+            for thread in threads:
+                thread.start()
+            for item in items:
+                if self.stop_event.is_set():
+                    break
+                self.put(0, item)
+            for _ in range(self.stages[0].workers):
+                self.put(0, _END)
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            self.pbar.close()
+            self.pbar = None
+        if self.error is not None:
+            self.logger.error(f'Pipeline stopped, a stage worker failed.\nerror info: {self.error}')
+            raise self.error
+
+        pipeline_time = time.monotonic() - pipeline_start
+        if pipeline_time > 0 and len(self.stages) > 1:
+            stages_info = ", ".join(f'{stage.name} {stage.busy_time / stage.workers / pipeline_time:.0%}'
+                                    f'{f"(x{stage.workers})" if stage.workers > 1 else ""}'
+                                    for stage in self.stages)
+            self.logger.info(f'Pipeline finished in {pipeline_time:.1f}s, stages busy: {stages_info}.')
+
@@ -0,0 +1,184 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+
+from utils.logger import Logger
+
+NULL_CONTEXT = nullcontext()
+
+
+class RunProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.logger = None
+        self.profile_path = None
+        self.profile_images = 8
+        self.sample_every = 1
+
+        # Images seen and profiled per stage name
+        self.seen = {}
+        self.profiled = {}
+        self.lock = threading.Lock()
+        # cProfile can only run in one thread at a time, other stages are skipped while it's busy
+        self.python_profiler = cProfile.Profile()
+        self.python_lock = threading.Lock()
+        self.python_profiled = False
+        # stage name -> ONNX Runtime session with profiling enabled
+        self.onnx_sessions = {}
+
+    def setup(
+            self,
+            logger: Logger,
+            args: dict,
+            run_name: str = "caption"
+    ):
+        self.enabled = bool(args.get('profile', False))
+        if not self.enabled:
+            return
+        self.logger = logger
+        self.profile_images = max(int(args.get('profile_images', 8)), 1)
+        self.sample_every = max(int(args.get('profile_sample_every', 1)), 1)
+        profile_dir = args.get('profile_dir', "") or os.path.join(os.getcwd(), "profiles")
+        self.profile_path = Path(profile_dir) / f'{run_name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+        os.makedirs(self.profile_path, exist_ok=True)
+        logger.info(f'Profiling {self.profile_images} image(s) of each stage, every {self.sample_every} image(s), '
+                    f'results will be saved in {str(self.profile_path)}')
+
+    def onnx_prefix(self, name: str) -> str:
+        return str(self.profile_path / f'onnxruntime_{name}')
+
+    def add_onnx_session(self, name: str, session):
+        # Session was created with `enable_profiling`, it's ended after its stage's last sampled image
+        self.onnx_sessions[name] = session
+
+    def end_onnx_session(self, name: str):
+        session = self.onnx_sessions.pop(name, None)
+        if session is not None:
+            try:
+                profile_file = session.end_profiling()
+                self.logger.info(f'ONNX Runtime profile of {name} saved to {profile_file}')
+            except Exception as e:
+                self.logger.warning(f'Failed to save ONNX Runtime profile of {name}.\nerror info: {e}')
+
+    def should_profile(self, name: str) -> tuple[bool, int]:
+        with self.lock:
+            index = self.seen.get(name, 0)
+            self.seen[name] = index + 1
+            profiled = self.profiled.get(name, 0)
+            if profiled >= self.profile_images or index % self.sample_every != 0:
+                return False, index
+            self.profiled[name] = profiled + 1
+            return True, index
+
+    def region(
+            self,
+            name: str,
+            torch_trace: bool = False
+    ):
+        # No-op context when profiling is disabled
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self.profile_region(name, torch_trace)
+
+    @contextmanager
+    def profile_region(
+            self,
+            name: str,
+            torch_trace: bool
+    ):
+        sampled, index = self.should_profile(name)
+        if not sampled:
+            yield
+            return
+
+        python_profiling = self.python_lock.acquire(blocking=False)
+        torch_profiler = self.start_torch_profiler() if torch_trace else None
+        if python_profiling:
+            self.python_profiler.enable()
+        try:
+            yield
+        finally:
+            if python_profiling:
+                self.python_profiler.disable()
+                self.python_profiled = True
+                self.python_lock.release()
+            if torch_profiler is not None:
+                self.save_torch_profiler(torch_profiler, f'{name}_{index:05d}')
+            with self.lock:
+                last_sampled = self.profiled.get(name, 0) >= self.profile_images
+            if last_sampled:
+                self.end_onnx_session(name)
+
+    def iterate(
+            self,
+            items: list,
+            name: str,
+            torch_trace: bool = False
+    ):
+        # Profile loop bodies of sampled items, the list is returned as is when profiling is disabled
+        if not self.enabled:
+            return items
+        return self.iterate_profiled(items, name, torch_trace)
+
+    def iterate_profiled(
+            self,
+            items: list,
+            name: str,
+            torch_trace: bool
+    ):
+        for item in items:
+            with self.profile_region(name, torch_trace):
+                yield item
+
+    def start_torch_profiler(self):
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+        except ImportError as ie:
+            self.logger.warning(f'Import torch Failed, skip torch profiling!\nDetails: {ie}')
+            return None
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        torch_profiler = profile(activities=activities, record_shapes=True)
+        torch_profiler.start()
+        return torch_profiler
+
+    def save_torch_profiler(self, torch_profiler, trace_name: str):
+        try:
+            torch_profiler.stop()
+            torch_profiler.export_chrome_trace(str(self.profile_path / f'torch_{trace_name}.json'))
+            with open(self.profile_path / f'torch_{trace_name}.txt', "wt", encoding="utf-8") as f:
+                f.write(torch_profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=50))
+        except Exception as e:
+            self.logger.warning(f'Failed to save torch profile {trace_name}.\nerror info: {e}')
+
+    def finish(self):
+        if not self.enabled:
+            return
+        for name in list(self.onnx_sessions.keys()):
+            self.end_onnx_session(name)
+        if self.python_profiled:
+            self.python_profiler.dump_stats(str(self.profile_path / "python.prof"))
+            stats_text = io.StringIO()
+            stats = pstats.Stats(self.python_profiler, stream=stats_text)
+            stats.sort_stats("cumulative").print_stats(50)
+            with open(self.profile_path / "python.txt", "wt", encoding="utf-8") as f:
+                # Shorten absolute paths of this repo
+                f.write(re.sub(re.escape(str(Path(__file__).parent.parent)) + r'[/\\]?', '', stats_text.getvalue()))
+        profiled = ", ".join(f'{name}: {count}' for name, count in self.profiled.items())
+        self.logger.info(f'Profiled image(s) {profiled or "none"}, results saved in {str(self.profile_path)}')
+        self.python_profiler = cProfile.Profile()
+        self.python_profiled = False
+        self.seen = {}
+        self.profiled = {}
+
+
+# Profiler of the whole process, configured once per run from `profile` options
+PROFILER = RunProfiler()
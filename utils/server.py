@@ -0,0 +1,269 @@
+import base64
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+from utils.memory import MEMORY_BUDGET
+from utils.profiler import PROFILER
+
+# Options a job may override, everything else comes from config
+SERVER_OVERRIDE_KEYS = (
+    "wd_threshold",
+    "wd_general_threshold",
+    "wd_character_threshold",
+    "wd_undesired_tags",
+    "wd_always_first_tags",
+    "wd_add_rating_tags_to_first",
+    "wd_add_rating_tags_to_last",
+    "wd_character_tags_first",
+    "wd_caption_separator",
+    "llm_system_prompt",
+    "llm_user_prompt",
+    "llm_caption_without_wd",
+    "llm_temperature",
+    "llm_max_tokens",
+)
+# Images are only batched into one LLM call when these options are the same
+LLM_BATCH_KEYS = ("llm_system_prompt", "llm_temperature", "llm_max_tokens")
+
+
+class CaptionJob:
+    def __init__(
+            self,
+            names: list[str],
+            args: dict,
+    ):
+        self.names = names
+        self.args = args
+        self.batch_key = tuple(str(args.get(key)) for key in LLM_BATCH_KEYS)
+        self.results = []
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.start_time = time.monotonic()
+
+    def put_result(self, index: int, result: dict):
+        with self.condition:
+            self.results.append(dict(index=index, image=self.names[index], **result))
+            self.condition.notify_all()
+
+    def get_result(self, result_index: int) -> dict:
+        # Results are returned in the order they finish
+        with self.condition:
+            while len(self.results) <= result_index:
+                self.condition.wait()
+            return self.results[result_index]
+
+
+class CaptionServer:
+    def __init__(
+            self,
+            caption,
+            args: dict,
+    ):
+        self.caption = caption
+        self.args = args
+        self.logger = caption.my_logger
+        self.batch_size = max(int(args.get('llm_batch_size', 1)), 1)
+        self.batch_wait = max(float(args.get('server_batch_wait_ms', 20)), 0.0) / 1000
+        # Queued images of all jobs, (job, index, image)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.http_server = None
+
+    def submit(
+            self,
+            job: CaptionJob,
+            images: list,
+    ):
+        with self.condition:
+            for index, image in enumerate(images):
+                if image is not None:
+                    self.pending.append((job, index, image))
+            self.condition.notify_all()
+
+    def next_batch(self) -> list:
+        with self.condition:
+            while not self.pending and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return []
+            # Give concurrent requests a moment to queue, so their images share one LLM call
+            batch_size = MEMORY_BUDGET.limit("llm_batch_size", self.batch_size)
+            deadline = time.monotonic() + self.batch_wait
+            while len(self.pending) < batch_size and time.monotonic() < deadline and not self.stopped:
+                self.condition.wait(timeout=deadline - time.monotonic())
+
+            batch_key = self.pending[0][0].batch_key
+            batch = []
+            for item in list(self.pending):
+                if len(batch) >= batch_size:
+                    break
+                if item[0].batch_key == batch_key:
+                    batch.append(item)
+                    self.pending.remove(item)
+            return batch
+
+    def worker(self):
+        # Models are only used from this thread
+        while not self.stopped:
+            batch = [item for item in self.next_batch() if not item[0].cancelled]
+            if not batch:
+                continue
+            try:
+                with PROFILER.region("server", torch_trace=True):
+                    results = self.caption.caption_images(
+                        images=[image for _, _, image in batch],
+                        args_list=[job.args for job, _, _ in batch]
+                    )
+            except Exception as e:
+                self.logger.error(f'Failed to caption batch.\nerror info: {e}')
+                results = [{"wd_caption": None, "llm_caption": None, "error": str(e)} for _ in batch]
+            for (job, index, _), result in zip(batch, results):
+                job.put_result(index, result)
+
+    def create_job(
+            self,
+            request: dict,
+    ) -> tuple[CaptionJob, list]:
+        overrides = request.get("args") or {}
+        invalid_keys = [key for key in overrides.keys() if key not in SERVER_OVERRIDE_KEYS]
+        if invalid_keys:
+            raise ValueError(f'Options {invalid_keys} can\'t be overridden per job.')
+        job_args = dict(self.args)
+        job_args.update(overrides)
+        if "llm_system_prompt" in overrides or "llm_user_prompt" in overrides:
+            self.caption.set_llm_prompts(job_args)
+
+        names = []
+        images = []
+        for index, image_info in enumerate(request.get("images") or []):
+            names.append(str(image_info.get("path") or image_info.get("name") or f'image_{index}'))
+            images.append(image_info)
+        if not images:
+            raise ValueError('No images in request.')
+        return CaptionJob(names, job_args), images
+
+    def load_images(
+            self,
+            job: CaptionJob,
+            images_info: list[dict],
+    ) -> list:
+        # Decode in the request thread, the model thread only runs models
+        images = []
+        for index, image_info in enumerate(images_info):
+            try:
+                if image_info.get("data"):
+                    image = Image.open(BytesIO(base64.b64decode(image_info["data"])))
+                elif image_info.get("path"):
+                    image = Image.open(image_info["path"])
+                else:
+                    raise ValueError('Image needs "path" or base64 "data".')
+                image.load()
+                images.append(image)
+            except Exception as e:
+                self.logger.error(f'Failed to load image: {job.names[index]}, skip it.\nerror info: {e}')
+                job.put_result(index, {"wd_caption": None, "llm_caption": None, "error": str(e)})
+                images.append(None)
+        return images
+
+    def serve(self):
+        worker_thread = threading.Thread(target=self.worker, daemon=True)
+        worker_thread.start()
+
+        server_socket = self.args.get('server_socket', "")
+        if server_socket:
+            if os.path.exists(server_socket):
+                os.remove(server_socket)
+            self.http_server = UnixHTTPServer(server_socket, CaptionRequestHandler)
+            self.logger.info(f'Caption server listening on unix socket {server_socket}')
+        else:
+            server_address = (self.args.get('server_host', "127.0.0.1"), int(self.args.get('server_port', 8765)))
+            self.http_server = ThreadingHTTPServer(server_address, CaptionRequestHandler)
+            self.logger.info(f'Caption server listening on http://{server_address[0]}:{server_address[1]}')
+        self.http_server.daemon_threads = True
+        self.http_server.caption_server = self
+
+        try:
+            self.http_server.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info('Caption server stopping...')
+        finally:
+            self.http_server.server_close()
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            worker_thread.join()
+            if server_socket and os.path.exists(server_socket):
+                os.remove(server_socket)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CaptionRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        self.server.caption_server.logger.debug(f'{self.address_string()} - {format % args}')
+
+    def send_json(self, status: int, content: dict):
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, content: dict):
+        line = (json.dumps(content, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f'{len(line):x}\r\n'.encode("ascii") + line + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        caption_server = self.server.caption_server
+        if self.path != "/health":
+            self.send_json(404, {"error": "Not found."})
+            return
+        self.send_json(200, {"status": "ok", "pending": len(caption_server.pending)})
+
+    def do_POST(self):
+        caption_server = self.server.caption_server
+        if self.path != "/caption":
+            self.send_json(404, {"error": "Not found."})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job, images_info = caption_server.create_job(request)
+        except Exception as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        caption_server.submit(job, caption_server.load_images(job, images_info))
+
+        # Stream one JSON line per image as soon as it is captioned
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for result_index in range(len(job.names)):
+                self.write_chunk(job.get_result(result_index))
+            self.write_chunk({"done": True, "time": round(time.monotonic() - job.start_time, 3)})
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client is gone, drop its queued images
+            job.cancelled = True
+            caption_server.logger.warning(f'Client disconnected, cancelled job of {len(job.names)} image(s).')
@@ -0,0 +1,291 @@
+import csv
+import json
+import math
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Union
+
+import numpy
+
+from utils.logger import Logger
+
+TAG_INDEX_VERSION = 1
+# Probabilities are stored as uint8, tags read from caption files have none and are stored as 1.0
+TAG_INDEX_PROB_SCALE = 255
+# Parentheses, quoted tag names and bare words, a tag may end with a threshold like `outdoors>=0.5`.
+# A `(...)` right after a word character belongs to the word, e.g. `hatsune_miku_(vocaloid)`.
+QUERY_TOKEN = re.compile(r'\s*(?:([()])|"([^"]*)"((?:>=?)[0-9]*\.?[0-9]+)?|((?:[^\s()"]|(?<=\w)\([^\s()"]*\))+))')
+QUERY_THRESHOLD = re.compile(r'^(.+?)(>=?)([0-9]*\.?[0-9]+)$')
+
+
+def normalize_tag(tag: str) -> str:
+    # `long_hair` in selected_tags.csv is `long hair` in captions with wd_remove_underscore
+    return tag.strip().replace("_", " ")
+
+
+def read_selected_tags(
+        logger: Logger,
+        tags_csv_path: Union[str, Path]
+) -> list[dict]:
+    # Tags in model output order, with ids and categories of selected_tags.csv
+    if not os.path.exists(tags_csv_path):
+        logger.error(f'{str(tags_csv_path)} NOT FOUND!')
+        raise FileNotFoundError
+    with open(tags_csv_path, 'r', encoding='utf-8') as csv_file:
+        rows = [row for row in csv.reader(csv_file)]
+    header = rows[0]
+    if not (header[0] in ("tag_id", "id") and header[1] == "name" and header[2] == "category"):
+        logger.error(f'Unexpected csv header: {header}')
+        raise ValueError
+    return [{"id": row[0], "name": row[1], "category": row[2]} for row in rows[1:]]
+
+
+class TagIndex:
+    def __init__(
+            self,
+            logger: Logger,
+            index_dir: Union[str, Path]
+    ):
+        # Posting lists of every tag: sorted image ids and uint8 probabilities, one slice per tag in flat arrays.
+        # Arrays are memory-mapped, so a query only reads posting lists of its tags.
+        self.logger = logger
+        self.index_dir = Path(index_dir)
+        self.tags = []
+        self.tag_positions = {}
+        self.image_paths = []
+        self.offsets = numpy.zeros(1, dtype=numpy.int64)
+        self.postings = numpy.zeros(0, dtype=numpy.uint32)
+        self.probs = numpy.zeros(0, dtype=numpy.uint8)
+        # image path -> (tag positions, probabilities) added since load, written by `save`
+        self.pending = {}
+
+        if os.path.isfile(self.index_dir / "tags.json"):
+            self.load()
+
+    def load(self):
+        with open(self.index_dir / "tags.json", "rt", encoding="utf-8") as f:
+            tags_info = json.load(f)
+        if tags_info.get("version") != TAG_INDEX_VERSION:
+            self.logger.error(f'Tag index {str(self.index_dir)} version {tags_info.get("version")} '
+                              f'is not supported, please build it again.')
+            raise ValueError
+        with open(self.index_dir / "images.json", "rt", encoding="utf-8") as f:
+            self.image_paths = json.load(f)
+        self.set_tags(tags_info["tags"])
+        self.offsets = numpy.load(self.index_dir / "offsets.npy", mmap_mode="r")
+        self.postings = numpy.load(self.index_dir / "postings.npy", mmap_mode="r")
+        self.probs = numpy.load(self.index_dir / "probs.npy", mmap_mode="r")
+        self.logger.debug(f'Tag index: {len(self.image_paths)} images, {len(self.tags)} tags '
+                          f'loaded from {str(self.index_dir)}')
+
+    def set_tags(self, tags: list[dict]):
+        # Tags of selected_tags.csv keep their positions, so an index can be updated by another run of the same model
+        if self.tags and [tag["name"] for tag in tags[:len(self.tags)]] != \
+                [tag["name"] for tag in self.tags[:len(tags)]]:
+            self.logger.error(f'Tags of tag index {str(self.index_dir)} are from another model, '
+                              f'please use another index dir or build it again.')
+            raise ValueError
+        if len(tags) > len(self.tags):
+            self.tags = self.tags + tags[len(self.tags):] if self.tags else list(tags)
+        self.tag_positions = {}
+        for position, tag in enumerate(self.tags):
+            self.tag_positions.setdefault(normalize_tag(tag["name"]), position)
+
+    def get_tag_position(self, tag_name: str) -> int:
+        # Tags not in selected_tags.csv, e.g. replaced or expanded ones, are added after it
+        name = normalize_tag(tag_name)
+        if name not in self.tag_positions:
+            self.tag_positions[name] = len(self.tags)
+            self.tags.append({"id": "", "name": name, "category": ""})
+        return self.tag_positions[name]
+
+    def add(
+            self,
+            image_path: str,
+            prob: numpy.ndarray,
+            min_prob: float
+    ):
+        # Model output of an image, in selected_tags.csv order
+        positions = numpy.flatnonzero(prob >= min_prob).astype(numpy.uint32)
+        self.pending[str(image_path)] = (
+            positions,
+            numpy.rint(prob[positions] * TAG_INDEX_PROB_SCALE).astype(numpy.uint8)
+        )
+
+    def add_tag_text(
+            self,
+            image_path: str,
+            tag_text: str,
+            caption_separator: str = ", "
+    ):
+        # Tags of a caption file, without probabilities
+        tag_names = [tag for tag in tag_text.split(caption_separator.strip()) if tag.strip() != ""]
+        positions = numpy.unique(numpy.array([self.get_tag_position(tag) for tag in tag_names],
+                                             dtype=numpy.uint32))
+        self.pending[str(image_path)] = (
+            positions,
+            numpy.full(len(positions), TAG_INDEX_PROB_SCALE, dtype=numpy.uint8)
+        )
+
+    def add_copy(
+            self,
+            image_path: str,
+            source_image_path: str
+    ):
+        # Image with the same content as one added in this run
+        if str(source_image_path) in self.pending:
+            self.pending[str(image_path)] = self.pending[str(source_image_path)]
+
+    def save(self):
+        # Merge added images into the index, images added again replace their old tags
+        if not self.pending:
+            return
+        old_image_ids = numpy.flatnonzero(numpy.array([image_path not in self.pending
+                                                       for image_path in self.image_paths], dtype=bool))
+        image_paths = [self.image_paths[image_id] for image_id in old_image_ids] + list(self.pending.keys())
+        # Old image id -> new image id, -1 for replaced ones
+        image_id_map = numpy.full(len(self.image_paths), -1, dtype=numpy.int64)
+        image_id_map[old_image_ids] = numpy.arange(len(old_image_ids))
+
+        offsets = numpy.asarray(self.offsets)
+        old_positions = numpy.repeat(numpy.arange(len(offsets) - 1, dtype=numpy.int64), numpy.diff(offsets))
+        old_images = image_id_map[numpy.asarray(self.postings, dtype=numpy.int64)]
+        kept = old_images >= 0
+        pending = list(self.pending.values())
+        positions = numpy.concatenate([old_positions[kept]] +
+                                      [item_positions.astype(numpy.int64) for item_positions, _ in pending])
+        images = numpy.concatenate([old_images[kept]] +
+                                   [numpy.full(len(item_positions), len(old_image_ids) + index, dtype=numpy.int64)
+                                    for index, (item_positions, _) in enumerate(pending)])
+        probs = numpy.concatenate([numpy.asarray(self.probs)[kept]] + [item_probs for _, item_probs in pending])
+        # Posting lists are sorted by tag, then image
+        order = numpy.lexsort((images, positions))
+        counts = numpy.bincount(positions, minlength=len(self.tags))
+
+        # Write a new index next to the old one and swap them, so a failed save leaves the old index usable
+        new_dir = self.index_dir.with_name(f'{self.index_dir.name}.new')
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.makedirs(new_dir, exist_ok=True)
+        numpy.save(new_dir / "offsets.npy", numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64))
+        numpy.save(new_dir / "postings.npy", images[order].astype(numpy.uint32))
+        numpy.save(new_dir / "probs.npy", probs[order].astype(numpy.uint8))
+        with open(new_dir / "images.json", "wt", encoding="utf-8") as f:
+            json.dump(image_paths, f, ensure_ascii=False)
+        with open(new_dir / "tags.json", "wt", encoding="utf-8") as f:
+            json.dump({"version": TAG_INDEX_VERSION, "tags": self.tags}, f, ensure_ascii=False)
+
+        # Memory maps of old files are released before they are removed
+        self.offsets = self.postings = self.probs = None
+        old_dir = self.index_dir.with_name(f'{self.index_dir.name}.old')
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.isdir(self.index_dir):
+            os.replace(self.index_dir, old_dir)
+        os.replace(new_dir, self.index_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.logger.info(f'Tag index: {len(self.pending)} image(s) added, '
+                         f'{len(image_paths)} images in {str(self.index_dir)}')
+        self.pending = {}
+        self.load()
+
+    def get_tag_images(
+            self,
+            tag_name: str,
+            threshold: float = 0.0,
+            strict: bool = False
+    ) -> numpy.ndarray:
+        # Sorted ids of images with the tag at or above(above with `strict`) threshold
+        position = self.tag_positions.get(normalize_tag(tag_name))
+        if position is None:
+            self.logger.error(f'Tag `{tag_name}` NOT FOUND in tag index!')
+            raise ValueError
+        if position >= len(self.offsets) - 1:
+            return numpy.zeros(0, dtype=numpy.uint32)
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        postings = self.postings[start:end]
+        if threshold <= 0:
+            return numpy.asarray(postings)
+        scaled_threshold = threshold * TAG_INDEX_PROB_SCALE
+        min_prob = math.floor(scaled_threshold + 1e-6) + 1 if strict else math.ceil(scaled_threshold - 1e-6)
+        return numpy.asarray(postings[self.probs[start:end] >= min_prob])
+
+    def query(
+            self,
+            expression: str,
+            threshold: float = 0.0
+    ) -> numpy.ndarray:
+        # Boolean tag expression, e.g. `1girl and (outdoors or sky>=0.6) and not monochrome`.
+        # Adjacent tags are joined by `and`, `-tag` is `not tag`, `threshold` applies to tags without their own.
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = QUERY_TOKEN.match(expression, position)
+            if match is None or match.end() == position:
+                self.logger.error(f'Unexpected character at {position} of query: {expression}')
+                raise ValueError
+            position = match.end()
+            paren, quoted, quoted_threshold, word = match.groups()
+            if word is not None and "(" in word and word[:word.index("(")].lower() in ("and", "or", "not"):
+                # Operator right before a group like `not(sky)`, parse the group separately
+                position = match.start(4) + word.index("(")
+                word = word[:word.index("(")]
+            if paren is not None:
+                tokens.append(paren)
+            elif quoted is not None:
+                tokens.append(("tag", quoted + (quoted_threshold or "")))
+            elif word.lower() in ("and", "or", "not"):
+                tokens.append(word.lower())
+            elif word == "-":
+                tokens.append("not")
+            elif word.startswith("-"):
+                tokens.extend(["not", ("tag", word[1:])])
+            else:
+                tokens.append(("tag", word))
+        all_images = numpy.arange(len(self.image_paths), dtype=numpy.uint32)
+
+        def parse_or(index: int) -> tuple[numpy.ndarray, int]:
+            images, index = parse_and(index)
+            while index < len(tokens) and tokens[index] == "or":
+                other_images, index = parse_and(index + 1)
+                images = numpy.union1d(images, other_images)
+            return images, index
+
+        def parse_and(index: int) -> tuple[numpy.ndarray, int]:
+            images, index = parse_not(index)
+            while index < len(tokens) and tokens[index] not in ("or", ")"):
+                if tokens[index] == "and":
+                    index += 1
+                other_images, index = parse_not(index)
+                images = numpy.intersect1d(images, other_images, assume_unique=True)
+            return images, index
+
+        def parse_not(index: int) -> tuple[numpy.ndarray, int]:
+            if index >= len(tokens):
+                self.logger.error(f'Query ends unexpectedly: {expression}')
+                raise ValueError
+            token = tokens[index]
+            if token == "not":
+                images, index = parse_not(index + 1)
+                return numpy.setdiff1d(all_images, images, assume_unique=True), index
+            if token == "(":
+                images, index = parse_or(index + 1)
+                if index >= len(tokens) or tokens[index] != ")":
+                    self.logger.error(f'Missing `)` in query: {expression}')
+                    raise ValueError
+                return images, index + 1
+            if not isinstance(token, tuple):
+                self.logger.error(f'Unexpected `{token}` in query: {expression}')
+                raise ValueError
+            threshold_match = QUERY_THRESHOLD.match(token[1])
+            if threshold_match is not None:
+                tag_name, operator, tag_threshold = threshold_match.groups()
+                return self.get_tag_images(tag_name, float(tag_threshold), strict=operator == ">"), index + 1
+            return self.get_tag_images(token[1], threshold), index + 1
+
+        images, index = parse_or(0)
+        if index < len(tokens):
+            self.logger.error(f'Unexpected `{tokens[index]}` in query: {expression}')
+            raise ValueError
+        return images
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+from utils.image import EXCLUDED_DIR_NAMES, SUPPORT_IMAGE_FORMATS, is_excluded_path
+from utils.logger import Logger
+
+# With inotify events, still rescan the whole tree this often in case events were dropped
+WATCH_RESCAN_INTERVAL = 300
+
+
+class FolderWatcher:
+    def __init__(
+            self,
+            logger: Logger,
+            path: Path,
+            recursive: bool = False,
+            debounce: float = 2.0,
+    ):
+        self.logger = logger
+        self.path = Path(path)
+        self.recursive = recursive
+        self.debounce = debounce
+
+        # image path -> (size, mtime) when it was captioned
+        self.done = {}
+        # image path -> ((size, mtime), time first seen with this signature), waiting to be stable
+        self.candidates = {}
+        # Paths reported by inotify since last poll
+        self.events = set()
+        self.events_lock = threading.Lock()
+        self.observer = None
+        self.last_rescan = 0.0
+
+    def start(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            self.logger.warning('watchdog not installed, watching for new images by polling...')
+            return
+
+        watcher = self
+
+        class ImageEventHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                with watcher.events_lock:
+                    watcher.events.add(str(event.src_path))
+                    if getattr(event, "dest_path", ""):
+                        watcher.events.add(str(event.dest_path))
+
+        self.observer = Observer()
+        self.observer.schedule(ImageEventHandler(), str(self.path), recursive=self.recursive)
+        self.observer.start()
+        self.logger.info(f'Watching {str(self.path)} with file system events.')
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def is_image(self, path: str) -> bool:
+        if not path.lower().endswith(SUPPORT_IMAGE_FORMATS):
+            return False
+        if not self.recursive and os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.path):
+            return False
+        return not is_excluded_path(path, self.path)
+
+    def scan(self) -> set[str]:
+        if os.path.isfile(self.path):
+            return {str(self.path)}
+        if self.recursive:
+            paths = set()
+            for root, dirs, names in os.walk(self.path):
+                dirs[:] = [name for name in dirs if name not in EXCLUDED_DIR_NAMES]
+                paths.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith(SUPPORT_IMAGE_FORMATS))
+            return paths
+        return {entry.path for entry in os.scandir(self.path)
+                if entry.is_file() and entry.name.lower().endswith(SUPPORT_IMAGE_FORMATS)}
+
+    def poll(self) -> list[str]:
+        # Return new or changed images that are completely written
+        now = time.monotonic()
+        if self.observer is None or now - self.last_rescan >= WATCH_RESCAN_INTERVAL:
+            paths = self.scan()
+            # Forget deleted images, they will be captioned again if they come back
+            for path in set(self.done.keys()) - paths:
+                del self.done[path]
+            self.last_rescan = now
+        else:
+            paths = set()
+        with self.events_lock:
+            paths |= {path for path in self.events if self.is_image(path)}
+            self.events = set()
+        paths |= set(self.candidates.keys())
+
+        ready = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.candidates.pop(path, None)
+                self.done.pop(path, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if stat.st_size == 0 or self.done.get(path) == signature:
+                self.candidates.pop(path, None)
+                continue
+            candidate = self.candidates.get(path)
+            if candidate is None or candidate[0] != signature:
+                # Still being written, wait until size and mtime stop changing
+                self.candidates[path] = (signature, now)
+                if time.time() - stat.st_mtime < self.debounce:
+                    continue
+            elif now - candidate[1] < self.debounce and time.time() - stat.st_mtime < self.debounce:
+                continue
+            ready.append(path)
+
+        return sorted(ready, key=lambda filename: (os.path.splitext(filename)[0]))
+
+    def mark_done(self, image_paths: list[str]):
+        for path in image_paths:
+            candidate = self.candidates.pop(path, None)
+            if candidate is not None:
+                self.done[path] = candidate[0]